@@ -73,10 +73,21 @@ from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import numpy as np 
 import sys
-import struct as sct
+import os
+import socket
+import select
 import platform
-from scipy.signal import find_peaks_cwt
-from scipy.optimize import leastsq
+import threading
+import time
+import multiprocessing
+from MakeMyGate_engine import gatingEngine, readMatrixFile, \
+    readMattypeFile, scanMatrix, storageReport, \
+    readRoiList, writeRoiList, readSpe, writeSpe, benchmarkPeakFind, \
+    decimateSteps, matrixPyramid, matTypeSymmetry, streamMatrixFile, \
+    compression, matrixFormatRegistry, readFileSample, isTextSample, \
+    readTextMatrix, matrixFileDelta, parseEvents, histogramListMode, \
+    writeMatrixFile, openCubeFile, histogramListModeCube, \
+    energyCalibration, gainMatch, symmetrisedFileDelta
 
 
 ### roi information ##
@@ -89,6 +100,7 @@ class roi(object):
         self.roiType = roiType
         self.addRoiToPlot()
         self.addLabelToPlot()
+        window.requestGateUpdate()
        
     def addRoiToPlot(self):
         self.roiRegion = pg.LinearRegionItem([
@@ -99,6 +111,7 @@ class roi(object):
             self.roiRegion.setZValue(-5)
         window.vbUpper.addItem(self.roiRegion)
         self.roiRegion.sigRegionChanged.connect(self.removeThisRoiOnShake)
+        self.roiRegion.sigRegionChanged.connect(window.requestGateUpdate)
         
     def askWidth(self):
         a = int(self.roiRegion.getRegion()[0])
@@ -123,6 +136,7 @@ class roi(object):
     def removeThisRoi(self):
         window.vbUpper.removeItem(self.roiRegion)
         window.vbUpper.removeItem(self.roiLabel)
+        window.requestGateUpdate()
         
     def removeThisRoiOnShake(self):
         if window.isShakeRemoveActive == True:
@@ -136,9 +150,7 @@ class roi(object):
                 window.groupRoiList.remove(self)
         
     def sliceMatrix(self):
-        a = int(self.roiRegion.getRegion()[0])
-        b = int(self.roiRegion.getRegion()[1] + 1)
-        return np.sum(window.matrix[:,a:b], axis = 1)
+        return window.engine.sliceMatrix(self.roiRegion.getRegion())
         
     def isInRegion(self, region):
         if (self.roiRegion.getRegion()[0] > region[0] and \
@@ -147,6 +159,64 @@ class roi(object):
         else:
             return False
 
+### spectrum curve drawing only visible channels, decimated to min/max
+### per pixel, so long spectra pan and zoom at display frame rate
+class lodCurveItem(pg.PlotCurveItem):
+    def __init__(self, spectrum, **kargs):
+        pg.PlotCurveItem.__init__(self, stepMode=True, **kargs)
+        self.setSpectrum(spectrum)
+
+    def setSpectrum(self, spectrum, **kargs): #kargs go to setData, e.g. name
+        self.spectrum = np.asarray(spectrum)
+        self.boundsCache = {}
+        self.lastView = None
+        self.updateView(**kargs)
+
+    def updateView(self, **kargs):
+        length = len(self.spectrum)
+        viewBox = self.getViewBox()
+        if viewBox is None: #not displayed yet
+            view = (0, length, length)
+        else:
+            xRange = viewBox.viewRange()[0]
+            start = int(np.clip(np.floor(xRange[0]), 0, length))
+            stop = int(np.clip(np.ceil(xRange[1]) + 1, start, length))
+            view = (start, stop, max(int(viewBox.width()), 1))
+        if view == self.lastView and not kargs:
+            return
+        self.lastView = view
+        x, y = decimateSteps(self.spectrum, *view)
+        self.setData(x, y, **kargs)
+
+    def viewRangeChanged(self):
+        pg.PlotCurveItem.viewRangeChanged(self)
+        self.updateView()
+
+    def viewTransformChanged(self): #e.g. window resized
+        pg.PlotCurveItem.viewTransformChanged(self)
+        self.updateView()
+
+    ## bounds of whole spectrum, not only drawn part, for auto range
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        length = len(self.spectrum)
+        if length == 0:
+            return (None, None)
+        if ax == 0:
+            return (0, length)
+        key = None if orthoRange is None else tuple(orthoRange)
+        if key not in self.boundsCache:
+            if len(self.boundsCache) > 64: #many ranges while panning
+                self.boundsCache.clear()
+            spectrum = self.spectrum
+            if orthoRange is not None: #only visible channels
+                start = int(np.clip(np.floor(orthoRange[0]), 0, length))
+                stop = int(np.clip(np.ceil(orthoRange[1]) + 1, 0, length))
+                spectrum = spectrum[start:stop]
+            if len(spectrum) == 0:
+                return (None, None)
+            self.boundsCache[key] = (np.min(spectrum), np.max(spectrum))
+        return self.boundsCache[key]
+
 ### Additional Spectrum Object ###
 class SubWindow(QtGui.QWidget):
     def __init__(self, parent=None):
@@ -157,10 +227,9 @@ class SubWindow(QtGui.QWidget):
         self.scalingFactorUpper = 1.0
         self.scalingFactorLower = 1.0
         self.nameToDisplay = 'name'
-        self.newSpectrumUpper = pg.PlotCurveItem(
-            np.arange(0,4097), np.zeros(4096), stepMode = True)
-        self.newSpectrumLower = pg.PlotCurveItem(
-            np.arange(0,4097), np.zeros(4096), stepMode = True)
+        self.calibration = None #of loaded spectrum, None - as plots
+        self.newSpectrumUpper = lodCurveItem(np.zeros(4096))
+        self.newSpectrumLower = lodCurveItem(np.zeros(4096))
         self.createWindow()
         self.p.sigTreeStateChanged.connect(self.change)
 
@@ -180,6 +249,26 @@ class SubWindow(QtGui.QWidget):
     def removeFromMenu(self):
         window.spectrumMenu.removeAction(self.spectrumButton)
 
+    ## loaded spectrum in channels of plot calibration (gain matched,
+    ## if spectrum has own calibration), as long as plotted spectrum
+    def matchedSpectrum(self, target, plotted):
+        if self.calibration is None:
+            return self.loadedSpe
+        length = len(self.loadedSpe) if plotted is None else len(plotted)
+        try:
+            return gainMatch(self.loadedSpe, self.calibration, target, length)
+        except ValueError as error:
+            print 'gain match: ' + str(error)
+            return self.loadedSpe
+
+    def upperSpectrum(self):
+        return self.matchedSpectrum(window.engine.calibrationX,
+                                    window.engine.matrixProjectionX)
+
+    def lowerSpectrum(self):
+        return self.matchedSpectrum(window.engine.calibrationY,
+                                    window.engine.matrixProjectionY)
+
     def okButtonFunct(self):
         buttonText = 'remove ' + str(self.nameToDisplay)
         self.spectrumButton = QtGui.QAction(
@@ -187,13 +276,11 @@ class SubWindow(QtGui.QWidget):
         self.spectrumButton.setText(buttonText)
         window.spectrumMenu.addAction(self.spectrumButton)
         self.ifSave = True
-        self.newSpectrumUpper.setData(
-            np.arange(0,len(self.loadedSpe) + 1), 
-            self.loadedSpe*self.scalingFactorUpper,
+        self.newSpectrumUpper.setSpectrum(
+            self.upperSpectrum()*self.scalingFactorUpper,
             name = self.nameToDisplay)
-        self.newSpectrumLower.setData(
-            np.arange(0,len(self.loadedSpe) + 1), 
-            self.loadedSpe*self.scalingFactorLower,
+        self.newSpectrumLower.setSpectrum(
+            self.lowerSpectrum()*self.scalingFactorLower,
             name = self.nameToDisplay)
         self.close()
     
@@ -229,6 +316,9 @@ class SubWindow(QtGui.QWidget):
                 {'name': 'Spectrum scaling Lower', 'type': 'str', 
                  'value': self.scalingFactorLower, 
                  'tip': "multiply lower spectrum. 'auto' is an option."},
+                {'name': 'Calibration', 'type': 'str', 'value': '',
+                 'tip': "a0 a1 a2 ... of this spectrum, it is gain matched \
+                 to plot calibrations. Empty - same as plots"},
                 {'name': 'Color', 'type': 'color', 'value': "FFFFFF", 
                  'tip': "Pick spectrum's color"},
                 {'name': 'Upper', 'type': 'bool', 'value': False, 
@@ -258,39 +348,33 @@ class SubWindow(QtGui.QWidget):
                     self, "Open file","",
                     "Radware SPE (*.spe);;Text file(*.txt);;Any file(*)")
                 if (fileName[-4:] == '.spe' or fileName[-4:] == '.err'):
-                    with open(fileName,'rb') as f:
-                        loadedSpeRaw = f.read()
-                    self.loadedSpe = np.array(
-                        sct.unpack('<'+4096*'f',loadedSpeRaw[36:-4]))
+                    self.loadedSpe = readSpe(fileName)
                 elif(fileName[-4:] == '.txt'):
                     with open(fileName, 'r') as f:                            
-                        self.loadedSpe = f.read().split()
+                        self.loadedSpe = np.array(f.read().split(), 
+                                                  dtype=float)
                 else:
                     print 'unknown format'
-                self.newSpectrumUpper.setData(
-                    np.arange(0,len(self.loadedSpe) + 1), 
-                    self.loadedSpe, name = self.nameToDisplay)
-                self.newSpectrumLower.setData(
-                    np.arange(0,len(self.loadedSpe) + 1), 
-                    self.loadedSpe, name = self.nameToDisplay)
+                self.newSpectrumUpper.setSpectrum(
+                    self.upperSpectrum(), name = self.nameToDisplay)
+                self.newSpectrumLower.setSpectrum(
+                    self.lowerSpectrum(), name = self.nameToDisplay)
                 self.nameToDisplay = fileName
                      
             ### Display name
             elif path[1] == 'Display name':
                 self.nameToDisplay = str(data)
-                self.newSpectrumLower.setData(
-                    np.arange(0,len(self.loadedSpe) + 1), 
-                    self.loadedSpe*self.scalingFactorLower,
+                self.newSpectrumLower.setSpectrum(
+                    self.lowerSpectrum()*self.scalingFactorLower,
                     name = self.nameToDisplay)
-                self.newSpectrumUpper.setData(
-                    np.arange(0,len(self.loadedSpe) + 1), 
-                    self.loadedSpe*self.scalingFactorUpper,
+                self.newSpectrumUpper.setSpectrum(
+                    self.upperSpectrum()*self.scalingFactorUpper,
                     name = self.nameToDisplay)    
             ### Scaling factors
             elif path[1] == 'Spectrum scaling Upper':
                 if data == 'auto':
-                    originalSpeMax = float(np.max(window.matrixProjectionX))
-                    newSpeMax = float(np.max(self.loadedSpe))
+                    originalSpeMax = float(np.max(window.engine.matrixProjectionX))
+                    newSpeMax = float(np.max(self.upperSpectrum()))
                     self.scalingFactorUpper = originalSpeMax/newSpeMax
                     print 'Auto scaling factor for projection spectrum: ' 
                     + str(self.scalingFactorUpper)
@@ -300,15 +384,14 @@ class SubWindow(QtGui.QWidget):
                     except:
                         print 'Input error: must be number(float) or "auto"'
                         return
-                self.newSpectrumUpper.setData(
-                    np.arange(0,len(self.loadedSpe) + 1), 
-                    self.loadedSpe*self.scalingFactorUpper,
+                self.newSpectrumUpper.setSpectrum(
+                    self.upperSpectrum()*self.scalingFactorUpper,
                     name = self.nameToDisplay)
 
             elif path[1] == 'Spectrum scaling Lower':
                 if data == 'auto':
                     originalSpeMax = float(np.max(window.dataToPlot))
-                    newSpeMax = float(np.max(self.loadedSpe))
+                    newSpeMax = float(np.max(self.lowerSpectrum()))
                     self.scalingFactorLower = originalSpeMax/newSpeMax
                     print 'Auto scaling factor for gated spectrum: ' 
                     + str(self.scalingFactorLower)
@@ -318,11 +401,25 @@ class SubWindow(QtGui.QWidget):
                     except:
                         print 'Input error: must be number(float) or "auto"'
                         return
-                self.newSpectrumLower.setData(
-                    np.arange(0,len(self.loadedSpe) + 1), 
-                    self.loadedSpe*self.scalingFactorLower,
+                self.newSpectrumLower.setSpectrum(
+                    self.lowerSpectrum()*self.scalingFactorLower,
                     name = self.nameToDisplay)
                 
+            ### Calibration of loaded spectrum
+            elif path[1] == 'Calibration':
+                try:
+                    self.calibration = energyCalibration.fromText(data) \
+                        if str(data).strip() else None
+                except ValueError:
+                    print 'Input error: calibration must be "a0 a1 a2 ..."'
+                    return
+                self.newSpectrumUpper.setSpectrum(
+                    self.upperSpectrum()*self.scalingFactorUpper,
+                    name = self.nameToDisplay)
+                self.newSpectrumLower.setSpectrum(
+                    self.lowerSpectrum()*self.scalingFactorLower,
+                    name = self.nameToDisplay)
+
             ### Color
             elif path[1] == 'Color':
                 self.spectrumColor = data.getRgb()[:3]
@@ -355,9 +452,10 @@ class pfParamsWindow(QtGui.QWidget):
     def __init__(self, parent=None):
         QtGui.QMainWindow.__init__(self, parent)
         self.ifSave = False
-        self.fwhmLow = window.minPeakWidth
-        self.fwhmHigh = window.maxPeakWidth
-        self.noiseLevel = window.noisePeakWidth
+        self.fwhmLow = window.engine.minPeakWidth
+        self.fwhmHigh = window.engine.maxPeakWidth
+        self.noiseLevel = window.engine.noisePeakWidth
+        self.method = window.engine.peakFindMethod
         self.createWindow()
         self.p.sigTreeStateChanged.connect(self.change)
         
@@ -366,9 +464,10 @@ class pfParamsWindow(QtGui.QWidget):
         window.peakFindFunct()
 
     def okButtonFunct(self):
-        window.minPeakWidth = self.fwhmLow
-        window.maxPeakWidth = self.fwhmHigh
-        window.noisePeakWidth = self.noiseLevel
+        window.engine.minPeakWidth = self.fwhmLow
+        window.engine.maxPeakWidth = self.fwhmHigh
+        window.engine.noisePeakWidth = self.noiseLevel
+        window.engine.peakFindMethod = self.method
         self.close()
     
     def cancelButtonFunct(self):
@@ -390,7 +489,11 @@ class pfParamsWindow(QtGui.QWidget):
                  'tip': "highest possible FWHM given in channels"},
                 {'name': 'Noise level', 'type': 'float', 
                  'value': self.noiseLevel, 'step' : 0.05, 
-                 'tip': "Cuts off noises. Higher value = more peaks"}]}]
+                 'tip': "Cuts off noises. Higher value = more peaks"},
+                {'name': 'Method', 'type': 'list', 
+                 'values': ['cwt', 'derivative'], 'value': self.method, 
+                 'tip': "cwt - scipy find_peaks_cwt, derivative - "
+                 "much faster smoothed second derivative search"}]}]
         self.p = Parameter.create(name='params', type='group', children=params)      
         self.t = ParameterTree()
         self.t.setParameters(self.p, showTop=False)
@@ -408,18 +511,22 @@ class pfParamsWindow(QtGui.QWidget):
         for param, change, data in changes:
             path = self.p.childPath(param)
                                 
-            ### Display name
-            if path[1] == 'FWHM low (channels)':
+            ### lowest width
+            if path[1] == 'min expected FWHM (channels)':
                 self.fwhmLow = data
                 
-            ### Upper chekbox
-            elif path[1] == 'FWHM high (channels)':
+            ### highest width
+            elif path[1] == 'max expected FWHM (channels)':
                 self.fwhmHigh = data
     
-            ### Lower checkbox
+            ### noise
             elif path[1] == 'Noise level':
                 self.noiseLevel = data
 
+            ### peak search method
+            elif path[1] == 'Method':
+                self.method = str(data)
+
 ### loading custom matrix
 class loadCustomMatrix(QtGui.QWidget): #under development
     def __init__(self, parent=None):
@@ -452,6 +559,12 @@ class loadCustomMatrix(QtGui.QWidget): #under development
             'name': 'Load custom matrix', 'type': 'group',
             'children': [
                 {'name': 'Load matrix', 'type': 'action'},
+                {'name': 'Detect format', 'type': 'bool', 'value': True,
+                 'tip': "fill settings below from file size and first KB"},
+                {'name': 'Text layout', 'type': 'list',
+                 'values': ['auto', 'dense', 'sparse'], 'value': 'auto',
+                 'tip': "text matrix: dense - matrix row per line, \
+                 sparse - x y count lines, auto - sparse if 3 columns"},
                 {'name': 'Dimension X', 'type': 'int', 
                  'value': self.matSizeX, 'step' : 1, 
                  'tip': "matrix X length"},
@@ -496,25 +609,30 @@ class loadCustomMatrix(QtGui.QWidget): #under development
         self.layout.addWidget(okButton)
         self.layout.addWidget(cancelButton)  
 
-    def readBinaryMatrix(self, f):
-        f.seek(0)
-        dataFormat = self.dataEndian + self.dataType
-        self.matrix = np.fromfile(f, dtype=dataFormat)
-        self.matrix = self.matrix[:]
-        if self.skipFirstBytes:
-            self.matrix = self.matrix[self.skipFirstBytes:]
-        if self.skipLastBytes:
-            self.matrix = self.matrix[:-self.skipLastBytes]          
-        if self.dataOrder == 'F':
-            self.matrix = self.matrix.reshape(
-                (self.matSizeX,self.matSizeY), order="F")
-        else:
-            self.matrix.shape = (self.matSizeX,self.matSizeY)
-        window.matrix = self.matrix
-        window.showMatrix(1)
+    def readBinaryMatrix(self, fileName):
+        window.openMatrixFile(
+            fileName, self.matSizeX, self.matSizeY, self.dataOrder,
+            self.dataType, self.dataEndian, self.skipFirstBytes,
+            self.skipLastBytes)
         
-    def readNonBinaryMatrix(self, f):
-        print 'under construction'
+    def readNonBinaryMatrix(self, fileName): #sizes from file if detected
+        detect = self.p.param('Load custom matrix', 'Detect format').value()
+        layout = self.p.param('Load custom matrix', 'Text layout').value()
+        if detect:
+            window.openTextMatrix(fileName, layout=str(layout))
+        else:
+            window.openTextMatrix(
+                fileName, self.matSizeX, self.matSizeY, str(layout))
+
+    def setMatType(self, matType): #detected format shown in tree
+        for name, value in (('Dimension X', int(matType[2])),
+                            ('Dimension Y', int(matType[3])),
+                            ('Order', str(matType[4]).split()[0]),
+                            ('Data type', str(matType[5])),
+                            ('Endian type', str(matType[6])),
+                            ('Skip ... first bytes', int(matType[7])),
+                            ('Skip ... last bytes', int(matType[8]))):
+            self.p.param('Load custom matrix', name).setValue(value)
                         
     def change(self, param, changes):
         for param, change, data in changes:
@@ -522,20 +640,25 @@ class loadCustomMatrix(QtGui.QWidget): #under development
             
             ### Load Matrix button clicked
             if path[1] == 'Load matrix':
-                fileName = QtGui.QFileDialog.getOpenFileName(
-                    self, "Open file","", "Any file(*)")
-                ### checking if file is binary or text type
-                with open(fileName,'rb') as f:
-                    isBinary = False
-                    for block in f:
-                        if '\0' in block:
-                            isBinary = True
-                            break      
-                    if isBinary:
-                        self.readBinaryMatrix(f)
+                fileName = str(QtGui.QFileDialog.getOpenFileName(
+                    self, "Open file","", "Any file(*)"))
+                if not fileName:
+                    continue
+                ### binary or text type from first few KB of file
+                isBinary = not isTextSample(readFileSample(fileName))
+                print 'is ' + fileName + ' binary: ' + str(isBinary)
+                if not isBinary:
+                    self.readNonBinaryMatrix(fileName)
+                    continue
+                detect = self.p.param('Load custom matrix', 'Detect format')
+                if detect.value():
+                    matType = window.formatRegistry.bestFormat(fileName)
+                    if matType is None:
+                        print 'Format not detected, using settings below'
                     else:
-                        self.readNonBinaryMatrix(f)
-                print 'is ' + str(fileName) + ' binary: ' + str(isBinary)
+                        print 'Detected format: ' + str(matType[0])
+                        self.setMatType(matType)
+                self.readBinaryMatrix(fileName)
                      
             ### Dimension X
             elif path[1] == 'Dimension X':
@@ -555,7 +678,7 @@ class loadCustomMatrix(QtGui.QWidget): #under development
             
             ### Endian type
             elif path[1] == 'Endian type':
-                self.endianType = str(data)
+                self.dataEndian = str(data)
     
             ### skip first bytes of file
             elif path[1] == 'Skip ... first bytes':
@@ -565,12 +688,647 @@ class loadCustomMatrix(QtGui.QWidget): #under development
             elif path[1] == 'Skip ... last bytes':
                 self.skipLastBytes = int(data)
                                                       
+### list-mode file histogrammed into matrix, shown and/or saved
+class listModeWindow(QtGui.QWidget):
+    def __init__(self, parent=None):
+        QtGui.QWidget.__init__(self, parent)
+        self.histogramThread = None
+        self.layout = QtGui.QGridLayout()
+        self.setLayout(self.layout)
+        params = [{
+            'name': 'List-mode file', 'type': 'group',
+            'children': [
+                {'name': 'Histogram file', 'type': 'action'},
+                {'name': 'Event length', 'type': 'int', 'value': 2,
+                 'limits': (2, 64),
+                 'tip': "channels (detectors) in one event"},
+                {'name': 'Data type', 'type': 'str', 'value': 'H',
+                 'tip': "type of single channel, as in Load custom matrix"},
+                {'name': 'Endian type', 'type': 'str', 'value': '<'},
+                {'name': 'Skip ... first bytes', 'type': 'int', 'value': 0,
+                 'tip': "file header"},
+                {'name': 'Matrix size', 'type': 'int', 'value': 4096},
+                {'name': 'Symmetrise', 'type': 'bool', 'value': True,
+                 'tip': "count every pair in both orders"},
+                {'name': 'Gain file', 'type': 'str', 'value': '',
+                 'tip': "text file, line 'a0 a1 a2 ...' for every detector \
+                 (or one line for all), empty - no calibration"},
+                {'name': 'Show matrix', 'type': 'bool', 'value': True},
+                {'name': 'Save matrix as', 'type': 'str', 'value': '',
+                 'tip': "empty - not saved"},
+                {'name': 'Saved data type', 'type': 'str', 'value': 'H',
+                 'tip': "H for .mat, I - 4byte cells"},
+                {'name': 'Build cube as', 'type': 'str', 'value': '',
+                 'tip': "symmetric uint32 cube file from event triples, \
+                 empty - no cube"}]}]
+        self.p = Parameter.create(name='params', type='group',
+                                  children=params)
+        self.p.param('List-mode file', 'Histogram file').sigActivated.connect(
+            self.histogramFile)
+        self.t = ParameterTree()
+        self.t.setParameters(self.p, showTop=False)
+        self.layout.addWidget(self.t)
+        self.status = QtGui.QLabel(' ')
+        self.layout.addWidget(self.status)
+        self.resize(450, 420)
+
+    def value(self, name):
+        return self.p.param('List-mode file', name).value()
+
+    def histogramFile(self):
+        fileName = str(QtGui.QFileDialog.getOpenFileName(
+            self, "Open list-mode file", "", "Any file(*)"))
+        if not fileName:
+            return
+        gains = None
+        if self.value('Gain file'):
+            try:
+                gains = np.loadtxt(str(self.value('Gain file')),
+                                   ndmin=2).tolist()
+            except (IOError, ValueError) as error:
+                print 'gain file: ' + str(error)
+                return
+        if self.histogramThread is not None:
+            self.histogramThread.cancel()
+        self.histogramThread = listModeHistogram(
+            (fileName, int(self.value('Event length')),
+             int(self.value('Matrix size')), str(self.value('Data type')),
+             str(self.value('Endian type')),
+             int(self.value('Skip ... first bytes')), gains,
+             bool(self.value('Symmetrise'))), str(self.value('Build cube as')))
+        self.histogramThread.sigProgress.connect(self.progress)
+        self.histogramThread.sigDone.connect(self.histogramDone)
+        self.status.setText('histogramming ' + fileName)
+        self.histogramThread.start()
+
+    def progress(self, done, total, projectionX):
+        self.status.setText('%d of %d events' % (done, total))
+
+    def histogramDone(self, matrix, cube):
+        self.histogramThread = None
+        if cube is not None:
+            window.setCube(cube)
+        self.status.setText('%d counts' % matrix.sum())
+        if self.value('Save matrix as'):
+            writeMatrixFile(str(self.value('Save matrix as')), matrix,
+                            str(self.value('Saved data type')))
+        if self.value('Show matrix'):
+            window.matrixFileArgs = None
+            window.currentNameStatus.setText('list-mode matrix')
+            window.showMatrix(matrix, 'auto')
+
+    def closeEvent(self, event):
+        if self.histogramThread is not None:
+            self.histogramThread.cancel()
+            self.histogramThread = None
+
+### list-mode histogramming in workerPool processes, driven from this
+### thread. After cancel only few queued ranges are still histogrammed
+class listModeHistogram(QtCore.QThread):
+    sigProgress = QtCore.Signal(object, object, object) #done, all, None
+    sigDone = QtCore.Signal(object, object) #matrix, cube or None
+
+    def __init__(self, listModeArgs, cubeFile='', parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.listModeArgs = listModeArgs #histogramListMode args to symmetrise
+        self.cubeFile = cubeFile
+        self.isCanceled = False
+
+    def run(self):
+        try:
+            matrix = histogramListMode(*self.listModeArgs, pool=workerPool,
+                isCanceled=lambda: self.isCanceled,
+                progress=self.sigProgress.emit)
+        except (IOError, ValueError) as error:
+            print 'list-mode: ' + str(error)
+            return
+        if matrix is None:
+            return
+        cube = None
+        if self.cubeFile: #event triples, read again in this process
+            fileName, eventLength, size, dataType, dataEndian, \
+                skipFirstBytes, gains = self.listModeArgs[:7]
+            try:
+                cube = openCubeFile(self.cubeFile, size, 'I', mode='w+')
+                if histogramListModeCube(fileName, cube, eventLength,
+                        dataType, dataEndian, skipFirstBytes, gains,
+                        isCanceled=lambda: self.isCanceled,
+                        progress=self.sigProgress.emit) is None:
+                    return
+                cube.cells.flush()
+            except (IOError, ValueError) as error:
+                print 'cube: ' + str(error)
+                cube = None
+        self.sigDone.emit(matrix, cube)
+
+    def cancel(self):
+        self.isCanceled = True
+        self.wait()
+
+### projections of memory mapped matrix, computed in background
+### matrix is also collected into sparse form while occupancy is low
+class projectionScan(QtCore.QThread):
+    sigScanDone = QtCore.Signal(object, object, object)
+    sigProgress = QtCore.Signal(object, object, object) #done, all, proj X
+    
+    def __init__(self, matrix, sparseThreshold=0., symmetry='off',
+                 parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.matrix = matrix
+        self.sparseThreshold = sparseThreshold
+        self.symmetry = symmetry
+        self.isCanceled = False
+        self.blockSize = 256 #rows (or columns for F order) read at once
+        self.lastProgress = 0. #time of last progress signal
+        
+    def run(self):
+        scanResult = scanMatrix(
+            self.matrix, self.sparseThreshold, self.blockSize, 
+            lambda: self.isCanceled, self.symmetry, self.progress)
+        if scanResult is not None:
+            self.sigScanDone.emit(*scanResult)
+
+    def progress(self, done, total, projectionX):
+        if done < total and time.time() - self.lastProgress < 0.1:
+            return #GUI does not need to redraw after every block
+        self.lastProgress = time.time()
+        if projectionX is not None: #copy, scan goes on adding to it
+            projectionX = np.array(projectionX)
+        self.sigProgress.emit(done, total, projectionX)
+        
+    def cancel(self):
+        self.isCanceled = True
+        self.wait()
+
+### reads matrix into memory in worker thread, projections are summed
+### from every block just read (one pass over the file)
+class matrixStreamLoad(projectionScan):
+    sigLoaded = QtCore.Signal(object, object) #matrix, scan result
+
+    def __init__(self, fileArgs, sparseThreshold=0., symmetry='off',
+                 parent=None):
+        projectionScan.__init__(self, None, sparseThreshold, symmetry, parent)
+        self.fileArgs = fileArgs #file name and format, as readMatrixFile
+
+    def run(self):
+        try:
+            loaded = streamMatrixFile(*self.fileArgs,
+                sparseThreshold=self.sparseThreshold, symmetry=self.symmetry,
+                blockSize=self.blockSize,
+                isCanceled=lambda: self.isCanceled, progress=self.progress)
+        except (IOError, ValueError) as error:
+            print 'loading failed: ' + str(error)
+            return
+        if loaded is not None:
+            self.sigLoaded.emit(*loaded)
+
+### text matrix is parsed in worker thread, scanned when shown
+class textMatrixLoad(matrixStreamLoad):
+    def run(self):
+        try:
+            matrix = readTextMatrix(*self.fileArgs,
+                isCanceled=lambda: self.isCanceled, progress=self.progress)
+        except (IOError, ValueError) as error:
+            print 'loading failed: ' + str(error)
+            return
+        if matrix is not None:
+            self.sigLoaded.emit(matrix, None)
+
+### live acquisition: matrix file is polled for changed cells, or
+### (x, y, count) uint32 events are received on local socket. Changes
+### are merged for interval seconds and emitted, next poll waits until
+### GUI has added them to the matrix
+class liveAcquisition(QtCore.QThread):
+    sigDelta = QtCore.Signal(object, object, object) #rows, columns, counts
+
+    def __init__(self, matrix, fileArgs=None, port=None, interval=1.,
+                 symmetrise=False, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.matrix = matrix #engine.liveMatrix, read only here
+        self.fileArgs = fileArgs #as readMatrixFile, None for socket
+        self.symmetrise = symmetrise #file raw, engine matrix symmetrised
+        self.rawMatrix = None #file snapshot, diffed when symmetrise
+        self.port = port
+        self.interval = interval
+        self.applied = threading.Event()
+        self.isStopped = False
+
+    def run(self):
+        if self.fileArgs is not None:
+            self.watchFile()
+        else:
+            self.listen()
+
+    def watchFile(self):
+        lastStamp = None
+        while not self.isStopped:
+            try:
+                fileStat = os.stat(self.fileArgs[0])
+                stamp = (fileStat.st_mtime, fileStat.st_size)
+                if stamp != lastStamp and self.symmetrise:
+                    if self.rawMatrix is None: #changes from now on
+                        self.rawMatrix = np.array(
+                            readMatrixFile(*self.fileArgs))
+                    delta = symmetrisedFileDelta(
+                        self.rawMatrix, self.fileArgs)
+                    lastStamp = stamp
+                    self.emitDelta(*delta)
+                elif stamp != lastStamp:
+                    delta = matrixFileDelta(self.matrix, self.fileArgs)
+                    lastStamp = stamp
+                    self.emitDelta(*delta)
+            except (IOError, OSError, ValueError) as error: #file rewritten
+                print 'live: ' + str(error)
+            self.sleep(self.interval)
+
+    def listen(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind(('127.0.0.1', self.port))
+        except socket.error as error:
+            print 'live: ' + str(error)
+            return
+        server.listen(4)
+        print 'live: listening on port ' + str(self.port)
+        received = {} #connection -> bytes of incomplete event
+        events = []
+        lastEmit = time.time()
+        while not self.isStopped:
+            readable = select.select([server] + received.keys(), [], [],
+                                     0.1)[0]
+            for connection in readable:
+                if connection is server:
+                    received[server.accept()[0]] = ''
+                    continue
+                data = connection.recv(2**16)
+                if not data: #sender closed
+                    del received[connection]
+                    connection.close()
+                    continue
+                triplets, received[connection] = parseEvents(
+                    received[connection] + data)
+                events.append(triplets)
+            if events and time.time() - lastEmit >= self.interval:
+                events = np.vstack(events)
+                self.emitDelta(events[:,0], events[:,1], events[:,2])
+                events = []
+                lastEmit = time.time()
+        for connection in received:
+            connection.close()
+        server.close()
+
+    def emitDelta(self, rows, columns, counts):
+        if len(counts) == 0 or self.isStopped:
+            return
+        self.applied.clear()
+        self.sigDelta.emit(rows, columns, counts)
+        self.applied.wait()
+
+    def sleep(self, seconds): #returns early when stopped
+        end = time.time() + seconds
+        while not self.isStopped and time.time() < end:
+            time.sleep(0.05)
+
+    def stop(self):
+        self.isStopped = True
+        self.applied.set()
+        self.wait()
+
+### sums stored levels of 2D matrix view in background
+class pyramidBuild(QtCore.QThread):
+    sigBuildDone = QtCore.Signal(object)
+
+    def __init__(self, pyramid, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.pyramid = pyramid
+        self.isCanceled = False
+
+    def run(self):
+        if self.pyramid.build(lambda: self.isCanceled):
+            self.sigBuildDone.emit(self.pyramid)
+
+    def cancel(self):
+        self.isCanceled = True
+        self.wait()
+
+### 2D view of matrix: X - gate axis (as projection), Y - gated spectrum.
+### Image is put together from pyramid tiles in view, so zooming does
+### not depend on matrix size. Gates are shown and can be moved here,
+### double click adds ROI+ (with Shift ROI-)
+class matrixMapWindow(QtGui.QWidget):
+    def __init__(self, parent=None):
+        QtGui.QWidget.__init__(self, parent)
+        self.setWindowTitle('Matrix 2D view')
+        self.pyramid = None
+        self.builder = None
+        self.lastView = None #(level, rectangle) of shown image
+        self.imageLevels = None #color scale, fixed after first image
+        self.roiRegions = {} #gate roi: its region on the map
+        self.layout = QtGui.QVBoxLayout()
+        self.setLayout(self.layout)
+        self.graphics = GraphicsLayoutWidget()
+        self.layout.addWidget(self.graphics)
+        self.plot = self.graphics.addPlot()
+        self.plot.setLabel('bottom', 'gate axis [channel]')
+        self.plot.setLabel('left', 'gated spectrum [channel]')
+        self.image = pg.ImageItem()
+        self.plot.addItem(self.image)
+        self.status = QtGui.QLabel('')
+        self.layout.addWidget(self.status)
+        self.plot.getViewBox().sigRangeChanged.connect(self.updateImage)
+        self.plot.scene().sigMouseClicked.connect(self.mouseClicked)
+        self.resize(700, 700)
+
+    def setMatrix(self, engine): #new matrix loaded
+        if self.builder is not None:
+            self.builder.cancel()
+        matrix = engine.matrix
+        if engine.ifTranspose: #levels are summed from rows as loaded
+            matrix = matrix.T
+        self.pyramid = matrixPyramid(matrix)
+        if engine.ifTranspose:
+            self.pyramid.transpose()
+        self.lastView = None
+        self.imageLevels = None
+        self.image.clear()
+        self.status.setText('summing matrix levels...')
+        self.builder = pyramidBuild(self.pyramid)
+        self.builder.sigBuildDone.connect(self.buildDone)
+        self.builder.start()
+
+    def buildDone(self, pyramid):
+        if pyramid is not self.pyramid: #other matrix loaded meanwhile
+            return
+        self.builder = None
+        self.status.setText(' ')
+        rows, columns = pyramid.matrix.shape
+        self.plot.setRange(xRange=(0, columns), yRange=(0, rows))
+        self.updateImage()
+
+    def transpose(self):
+        if self.pyramid is not None:
+            self.pyramid.transpose()
+            self.lastView = None
+            self.updateImage()
+
+    def updateImage(self, *args):
+        if self.pyramid is None or not self.pyramid.isBuilt():
+            return
+        viewBox = self.plot.getViewBox()
+        xRange, yRange = viewBox.viewRange()
+        level = self.pyramid.levelForView(
+            xRange, yRange, (viewBox.width(), viewBox.height()))
+        image, rectangle = self.pyramid.viewImage(level, xRange, yRange)
+        if (level, rectangle) == self.lastView: #same tiles
+            return
+        self.lastView = (level, rectangle)
+        #counts per channel, so color does not change with level
+        image = np.log10(1 + image.T/4**level)
+        if self.imageLevels is None:
+            self.imageLevels = (0, max(float(np.max(image)), 1.))
+        self.image.setImage(image, autoLevels=False, levels=self.imageLevels)
+        self.image.setRect(QtCore.QRectF(*rectangle))
+
+    def mouseClicked(self, event):
+        if not event.double():
+            return
+        x = self.plot.getViewBox().mapSceneToView(event.scenePos()).x()
+        xRange = self.plot.getViewBox().viewRange()[0]
+        if event.modifiers() & QtCore.Qt.ShiftModifier:
+            newRoi = roi(x, xRange[1] - xRange[0], (0,0,255,90), 0.03,
+                         'minus')
+            window.minusRoiList.append(newRoi)
+        else:
+            newRoi = roi(x, xRange[1] - xRange[0], (255,0,0,90), 0.03,
+                         'plus')
+            window.plusRoiList.append(newRoi)
+
+    ## map regions follow window rois, moved map region moves its roi
+    def syncRois(self):
+        gateRois = window.plusRoiList + window.minusRoiList \
+            + window.groupRoiList
+        for gateRoi in self.roiRegions.keys():
+            if gateRoi not in gateRois:
+                self.plot.removeItem(self.roiRegions.pop(gateRoi))
+        for gateRoi in gateRois:
+            region = gateRoi.roiRegion.getRegion()
+            if gateRoi not in self.roiRegions:
+                mapRegion = pg.LinearRegionItem(region, brush=gateRoi.color)
+                mapRegion.setZValue(10)
+                mapRegion.sigRegionChangeFinished.connect(
+                    lambda item, gateRoi=gateRoi:
+                        gateRoi.roiRegion.setRegion(item.getRegion()))
+                self.plot.addItem(mapRegion)
+                self.roiRegions[gateRoi] = mapRegion
+            elif tuple(self.roiRegions[gateRoi].getRegion()) != tuple(region):
+                mapRegion = self.roiRegions[gateRoi]
+                mapRegion.blockSignals(True)
+                mapRegion.setRegion(region)
+                mapRegion.blockSignals(False)
+
+### peak finding in background thread, spectrum is copied on request.
+### Newer request replaces the waiting one, result of request which
+### is no longer the newest is dropped
+class peakFindWorker(QtCore.QThread):
+    sigPeaksFound = QtCore.Signal(object, object, object) #id, spe, peaks
+    
+    def __init__(self, engine, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.engine = engine
+        self.condition = threading.Condition()
+        self.request = None #(id, spectrum) waiting for the worker
+        self.lastRequestId = 0
+        self.isStopped = False
+        
+    def findPeaks(self, spectrum): #called from GUI thread
+        with self.condition:
+            self.lastRequestId += 1
+            self.request = (self.lastRequestId, np.array(spectrum))
+            self.condition.notify()
+        return self.lastRequestId
+        
+    def isStale(self, requestId):
+        return requestId != self.lastRequestId
+        
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None and not self.isStopped:
+                    self.condition.wait()
+                if self.isStopped:
+                    return
+                requestId, spectrum = self.request
+                self.request = None
+            try:
+                peaks = self.engine.findPeaks(spectrum)
+            except Exception as error: #keep worker alive
+                print 'peak find failed: ' + str(error)
+                continue
+            if not self.isStale(requestId):
+                self.sigPeaksFound.emit(requestId, spectrum, peaks)
+                
+    def stop(self):
+        with self.condition:
+            self.isStopped = True
+            self.condition.notify()
+        self.wait()
+
+### fits windows around found peaks in workerPool processes (started
+### before Qt), results are emitted one by one as they finish
+class fitAllWorker(QtCore.QThread):
+    sigFitDone = QtCore.Signal(object, object, object) #id, fit, error
+    sigAllDone = QtCore.Signal(object) #id
+
+    def __init__(self, engine, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.engine = engine
+        self.condition = threading.Condition()
+        self.request = None #(id, spectrum, peaks) waiting for the worker
+        self.lastRequestId = 0
+        self.isStopped = False
+
+    def fitAll(self, spectrum, peaks): #called from GUI thread
+        with self.condition:
+            self.lastRequestId += 1
+            self.request = (self.lastRequestId, np.array(spectrum),
+                            list(peaks))
+            self.condition.notify()
+        return self.lastRequestId
+
+    def isStale(self, requestId):
+        return requestId != self.lastRequestId
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None and not self.isStopped:
+                    self.condition.wait()
+                if self.isStopped:
+                    return
+                requestId, spectrum, peaks = self.request
+                self.request = None
+            try:
+                for index, fit, error in self.engine.fitAllPeaks(
+                        spectrum, peaks, workerPool):
+                    if self.isStale(requestId): #new request, drop the rest
+                        break
+                    self.sigFitDone.emit(requestId, fit, error)
+            except Exception as error: #keep worker alive
+                print 'fit all failed: ' + str(error)
+            if not self.isStale(requestId):
+                self.sigAllDone.emit(requestId)
+
+    def stop(self):
+        with self.condition:
+            self.isStopped = True
+            self.condition.notify()
+        self.wait()
+
+### sortable table of fitted peaks, rows are added as fits finish
+class fitTableWindow(QtGui.QWidget):
+    columns = ['Centroid [keV]', 'Centroid err', 'Area', 'Area err',
+               'FWHM [keV]', 'Chi2/ndf']
+
+    def __init__(self, parent=None):
+        QtGui.QWidget.__init__(self, parent)
+        self.setWindowTitle('Fitted peaks')
+        self.table = QtGui.QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.table.setSortingEnabled(True)
+        self.table.cellDoubleClicked.connect(self.showPeak)
+        self.status = QtGui.QLabel('')
+        self.layout = QtGui.QVBoxLayout()
+        self.layout.addWidget(self.table)
+        self.layout.addWidget(self.status)
+        self.setLayout(self.layout)
+        self.resize(650, 500)
+        self.clear()
+
+    def clear(self):
+        self.table.setRowCount(0)
+        self.fitted = 0
+        self.failed = 0
+        self.status.setText('fitting...')
+
+    def addFit(self, fit, calibration):
+        self.fitted += 1
+        #rows inserted into sorted table would be moved while filled
+        self.table.setSortingEnabled(False)
+        for i in xrange(len(fit.centroids)):
+            slope = calibration.slope(fit.centroids[i]) #keV/channel
+            values = [calibration.energy(fit.centroids[i]),
+                      fit.centroidErrors[i]*slope,
+                      fit.areas[i], fit.areaErrors[i],
+                      fit.fwhms[i]*slope, fit.chiSquare]
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            for column in xrange(len(values)):
+                item = QtGui.QTableWidgetItem()
+                #numbers, not text, so columns are sorted by value
+                item.setData(QtCore.Qt.DisplayRole,
+                             round(float(values[column]), 2))
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+        self.showStatus()
+
+    def addError(self, error):
+        self.failed += 1
+        print 'fit failed: ' + error
+        self.showStatus()
+
+    def showStatus(self, done=False):
+        self.status.setText('%d peaks in %d fits, %d fits failed%s' % (
+            self.table.rowCount(), self.fitted, self.failed,
+            '' if done else ', fitting...'))
+
+    def showPeak(self, row, column): #zoom lower plot on double clicked peak
+        centroid = float(self.table.item(row, 0).text())
+        centroid = window.engine.calibrationY.channel(
+            centroid, window.engine.axisLengths()[1])
+        window.vbLower.setXRange(centroid - 50, centroid + 50)
+
+### top axis in keV of polynomial calibration: ticks are round energies
+### put at their channel positions
+class calibratedAxis(pg.AxisItem):
+    def __init__(self, orientation, calibration, length=4096, **kargs):
+        pg.AxisItem.__init__(self, orientation, **kargs)
+        self.calibration = calibration
+        self.length = length #channels of spectrum under axis
+
+    def setCalibration(self, calibration, length):
+        self.calibration = calibration
+        self.length = length
+        self.picture = None #drawn again
+        self.update()
+
+    def tickValues(self, minVal, maxVal, size):
+        if not self.calibration.grows(self.length): #no ticks, no errors
+            return []
+        low, high = sorted(self.calibration.energy([minVal, maxVal]))
+        lowest, highest = self.calibration.energy([0, self.length])
+        levels = []
+        for spacing, energies in pg.AxisItem.tickValues(
+                self, low, high, size):
+            energies = [e for e in energies if lowest <= e <= highest]
+            levels.append((spacing, list(
+                self.calibration.channel(energies, self.length))))
+        return levels
+
+    def tickStrings(self, values, scale, spacing):
+        return pg.AxisItem.tickStrings(
+            self, list(self.calibration.energy(values)), scale, spacing)
+
 ### Main window and functions ###
 class MainWindow(QtGui.QMainWindow):
     def __init__(self, parent=None):
         QtGui.QMainWindow.__init__(self, parent)
-        self.refreshTime = 200 #refresh interval in ms
-        self.energyCalibAxis = 0.5 #default energy calibration: 0.5keV/channel
+        self.engine = gatingEngine() #matrix, gates and numerics
+        self.refreshTime = 200 #gate changes within this time are merged, ms
+        self.gateDirty = False #gated spectrum needs recomputing
+        self.labelsDirty = False #roi labels need repositioning
+        self.gateResults = {} #gating results, cleared on gate change
         self.plusRoiList  = [] #list of plus rois
         self.minusRoiList = [] #list of minus rois
         self.groupRoiList = [] #list of groups
@@ -579,13 +1337,29 @@ class MainWindow(QtGui.QMainWindow):
         self.isShakeRemoveActive = False 
         self.legendVisible = False
         self.setupUserInterface() #creates GUI
-        self.minPeakWidth = 5 #for peak find
-        self.maxPeakWidth = 25 #for peak find
-        self.noisePeakWidth = 0.1 #for peak find
         self.peakFindActive = False #for peak find auto refresh
+        self.upperPeakWorker = peakFindWorker(self.engine)
+        self.upperPeakWorker.sigPeaksFound.connect(self.showPeaksUpper)
+        self.upperPeakWorker.start()
+        self.lowerPeakWorker = peakFindWorker(self.engine)
+        self.lowerPeakWorker.sigPeaksFound.connect(self.showPeaksLower)
+        self.lowerPeakWorker.start()
+        self.fitAllWorker = fitAllWorker(self.engine)
+        self.fitAllWorker.sigFitDone.connect(self.showFitAllResult)
+        self.fitAllWorker.sigAllDone.connect(self.fitAllDone)
+        self.fitAllWorker.start()
+        self.fitTable = None #created on first fit all
+        self.matrixMap = None #2D matrix view, created when first shown
         self.peaksLabelsUpper = [] #for peak find
         self.peaksLabelsLower = [] #for peak find
-        self.ifTranspose = False #start with untransposed matrix
+        self.peaksListLower = []
+        self.multipletItems = [] #curves and labels of multiplet fit
+        self.matrixFileArgs = None #file and format of loaded binary matrix
+        self.liveWorker = None #live acquisition thread
+        self.secondGateItems = [] #fixed regions of cube second gate
+        self.memoryMappedLoad = True #read matrix pages on demand
+        self.projectionScanThread = None #background projections
+        self.matrixLoadThread = None #reading matrix into memory
         self.additionalFunctionsMenu() #functions not usable for most users        
         
     def setupUserInterface(self):
@@ -601,9 +1375,10 @@ class MainWindow(QtGui.QMainWindow):
         # upper frame contents    
         self.viewUpper = GraphicsLayoutWidget()
         self.upperFrameLayout.addWidget(self.viewUpper)
-        self.vbUpper = pg.PlotItem(title='Matrix projection')
-        self.energyAxisUpper = self.vbUpper.axes["top"]["item"]#additional axis
-        self.energyAxisUpper.setScale(self.energyCalibAxis)
+        self.energyAxisUpper = calibratedAxis(
+            'top', self.engine.calibrationX) #additional axis, keV
+        self.vbUpper = pg.PlotItem(title='Matrix projection',
+                                   axisItems={'top': self.energyAxisUpper})
         self.energyAxisUpper.show()
         self.viewUpper.addItem(self.vbUpper)
                
@@ -618,9 +1393,10 @@ class MainWindow(QtGui.QMainWindow):
         # lower frame content        
         self.viewLower = GraphicsLayoutWidget()
         self.lowerFrameLayout.addWidget(self.viewLower)
-        self.vbLower = pg.PlotItem(title='Gated spectrum')
-        self.energyAxisLower = self.vbLower.axes["top"]["item"]#additional axis
-        self.energyAxisLower.setScale(self.energyCalibAxis)
+        self.energyAxisLower = calibratedAxis(
+            'top', self.engine.calibrationY) #additional axis, keV
+        self.vbLower = pg.PlotItem(title='Gated spectrum',
+                                   axisItems={'top': self.energyAxisLower})
         self.energyAxisLower.show()
         self.viewLower.addItem(self.vbLower)
         
@@ -646,14 +1422,17 @@ class MainWindow(QtGui.QMainWindow):
         # Status bar
         self.windowStatusBar = QtGui.QStatusBar()
         self.currentNameStatus = QtGui.QLabel(' ') #matrix name and path
+        self.loadStatus = QtGui.QLabel(' ') #reading or scanning progress
         self.transposeStatus = QtGui.QLabel(' ') #is transposed?
         self.moveToRemoveStatus = QtGui.QLabel(' ') #is move to remove ON?
         self.windowStatusBar.insertPermanentWidget(
             0, self.currentNameStatus, 2)
         self.windowStatusBar.insertPermanentWidget(
-            1, self.transposeStatus, 2)
+            1, self.loadStatus, 1)
+        self.windowStatusBar.insertPermanentWidget(
+            2, self.transposeStatus, 2)
         self.windowStatusBar.insertPermanentWidget(
-            2, self.moveToRemoveStatus, 2)               
+            3, self.moveToRemoveStatus, 2)               
         self.setStatusBar(self.windowStatusBar)
           
         # Application window
@@ -685,14 +1464,22 @@ class MainWindow(QtGui.QMainWindow):
         self.saveRoiListToFile = QtGui.QAction("Save ROIs to file", self)
         self.loadRoiList = QtGui.QAction("Load ROIs from file", self)
         self.loadCustomMatrix = QtGui.QAction("Load custom matrix", self)
+        self.liveWatchFile = QtGui.QAction("Live: watch matrix file", self)
+        self.liveListen = QtGui.QAction("Live: receive events", self)
+        self.stopLive = QtGui.QAction("Stop live acquisition", self)
+        self.histogramListMode = QtGui.QAction(
+            "Histogram list-mode file", self)
         fileMenuActions = [
             self.loadMatrix, self.exitAct, self.saveSpe, 
             self.saveRoiListToFile, self.loadRoiList,
-            self.loadCustomMatrix]
+            self.loadCustomMatrix, self.liveWatchFile, self.liveListen,
+            self.stopLive, self.histogramListMode]
         fileMenuActFuncs = [
             self.loadMatrixFunct, self.close, self.saveSpeFunct,
             self.saveRoiListToFileFunct, self.loadRoiListFunct,
-            self.loadCustomMatrixFunct]
+            self.loadCustomMatrixFunct, self.liveWatchFileFunct,
+            self.liveListenFunct, self.stopLiveFunct,
+            self.histogramListModeFunct]
         for i in xrange(len(fileMenuActions)):
             action = fileMenuActions[i]
             function = fileMenuActFuncs[i]
@@ -700,10 +1487,15 @@ class MainWindow(QtGui.QMainWindow):
         
         self.fileMenu.addAction(self.loadMatrix)
         self.fileMenu.addAction(self.loadCustomMatrix)
+        self.fileMenu.addAction(self.histogramListMode)
         self.fileMenu.addAction(self.saveSpe)
         self.fileMenu.addAction(self.saveRoiListToFile)
         self.fileMenu.addAction(self.loadRoiList)
         self.fileMenu.addSeparator()
+        self.fileMenu.addAction(self.liveWatchFile)
+        self.fileMenu.addAction(self.liveListen)
+        self.fileMenu.addAction(self.stopLive)
+        self.fileMenu.addSeparator()
         self.fileMenu.addAction(self.exitAct)
 
         # ROI menu
@@ -759,20 +1551,37 @@ class MainWindow(QtGui.QMainWindow):
             "Start/Stop refreshing", self, shortcut="Ctrl+X")
         self.setCalibration = QtGui.QAction("Set energy calibration", self)
         self.peakFind = QtGui.QAction("Peak find", self, shortcut="Ctrl+P")
+        self.autoPeakFind = QtGui.QAction("Auto peak find: OFF", self)
+        self.peakFindBenchmark = QtGui.QAction("Peak find benchmark", self)
         self.peakFindParams = QtGui.QAction(
             "Adjust peak find parameters", self)
         self.transposeMatrix = QtGui.QAction(
             "Transpose Matrix", self, shortcut="Ctrl+T")
         self.displayLegend = QtGui.QAction("Display legend", self)
+        self.setGateIndex = QtGui.QAction("Set gate index precision", self)
+        self.memoryMapped = QtGui.QAction("Memory-mapped loading: ON", self)
+        self.symmetricStorage = QtGui.QAction(
+            "Packed symmetric matrices: ON", self)
+        self.setSparseThreshold = QtGui.QAction(
+            "Set sparse storage threshold", self)
+        self.matrixStorageReport = QtGui.QAction(
+            "Matrix storage report", self)
         optionsMenuActions = [
             self.setRefreshInterval, self.startStopRefresh,
             self.setCalibration, self.peakFind, self.peakFindParams,
-            self.transposeMatrix, self.displayLegend]
+            self.transposeMatrix, self.displayLegend, self.setGateIndex,
+            self.memoryMapped, self.symmetricStorage, 
+            self.setSparseThreshold, self.matrixStorageReport, 
+            self.autoPeakFind, self.peakFindBenchmark]
         optionsMenuFuncs = [
             self.setRefreshIntervalFunct, self.startStopRefreshFunct,
             self.setCalibrationFunct, self.peakFindFunct, 
             self.peakFindParamsFunct,
-            self.transposeMatrixFunct, self.displayLegendFunct]
+            self.transposeMatrixFunct, self.displayLegendFunct,
+            self.setGateIndexFunct, self.memoryMappedFunct,
+            self.symmetricStorageFunct,
+            self.setSparseThresholdFunct, self.matrixStorageReportFunct,
+            self.autoPeakFindFunct, self.peakFindBenchmarkFunct]
         for i in xrange(len(optionsMenuActions)):
             action = optionsMenuActions[i]
             function = optionsMenuFuncs[i]
@@ -783,21 +1592,44 @@ class MainWindow(QtGui.QMainWindow):
         self.optionsMenu.addAction(self.displayLegend)
         self.optionsMenu.addAction(self.setCalibration)
         self.optionsMenu.addAction(self.transposeMatrix)
+        self.optionsMenu.addAction(self.setGateIndex)
+        self.optionsMenu.addAction(self.memoryMapped)
+        self.optionsMenu.addAction(self.symmetricStorage)
+        self.optionsMenu.addAction(self.setSparseThreshold)
+        self.optionsMenu.addAction(self.matrixStorageReport)
         self.optionsMenu.addSeparator()
         self.optionsMenu.addAction(self.peakFind)
+        self.optionsMenu.addAction(self.autoPeakFind)
+        self.optionsMenu.addAction(self.peakFindBenchmark)
         self.optionsMenu.addAction(self.peakFindParams)
 
         # Additional spectrums menu
         self.addSpectrum = QtGui.QAction("Display additional spectrum", self)
         self.removeSpectra = QtGui.QAction("Remove all spectra", self)
-        spectrumMenuActions = [self.addSpectrum, self.removeSpectra]
-        spectrumMenuFuncs = [self.addSpectrumFunct, self.removeSpectrumFunct]
+        self.showMatrixMap = QtGui.QAction(
+            "Matrix 2D view", self, shortcut="Ctrl+M")
+        self.loadCube = QtGui.QAction("Load cube", self)
+        self.setSecondGate = QtGui.QAction(
+            "Cube: ROIs as second gate", self, shortcut="Ctrl+G")
+        self.clearSecondGate = QtGui.QAction("Cube: clear second gate", self)
+        spectrumMenuActions = [
+            self.addSpectrum, self.removeSpectra, self.showMatrixMap,
+            self.loadCube, self.setSecondGate, self.clearSecondGate]
+        spectrumMenuFuncs = [
+            self.addSpectrumFunct, self.removeSpectrumFunct,
+            self.showMatrixMapFunct, self.loadCubeFunct,
+            self.setSecondGateFunct, self.clearSecondGateFunct]
         for i in xrange(len(spectrumMenuActions)):
             action = spectrumMenuActions[i]
             function = spectrumMenuFuncs[i]
             action.triggered[()].connect(function)
         
         self.spectrumMenu.addAction(self.addSpectrum)
+        self.spectrumMenu.addAction(self.showMatrixMap)
+        self.spectrumMenu.addSeparator()
+        self.spectrumMenu.addAction(self.loadCube)
+        self.spectrumMenu.addAction(self.setSecondGate)
+        self.spectrumMenu.addAction(self.clearSecondGate)
         self.spectrumMenu.addSeparator()
         self.spectrumMenu.addAction(self.removeSpectra)
         self.spectrumMenu.addSeparator()
@@ -807,6 +1639,10 @@ class MainWindow(QtGui.QMainWindow):
         self.utiRoiRemove = QtGui.QAction("Remove Fit ROI", self)
         self.fitPeak = QtGui.QAction("Fit peak in ROI", self, shortcut="F4")
         self.fitNextPeak = QtGui.QAction("Fit 2nd peak in ROI", self)
+        self.fitMultiplet = QtGui.QAction(
+            "Fit multiplet in ROI", self, shortcut="F6")
+        self.fitAllPeaks = QtGui.QAction(
+            "Fit all found peaks", self, shortcut="F7")
         self.areaUnderPeak = QtGui.QAction("Calculate area", self)
         self.bgRoi = QtGui.QAction("Add background ROI", self, shortcut="F3")
         self.bgRoiRemove = QtGui.QAction("Remove background ROI", self)
@@ -814,13 +1650,15 @@ class MainWindow(QtGui.QMainWindow):
         self.pasternakSingls = QtGui.QAction("Paternak Singlsh", self)
         utilitiesMenuActions = [
             self.utiRoiAdd, self.utiRoiRemove, 
-            self.fitPeak, self.fitNextPeak,
+            self.fitPeak, self.fitNextPeak, self.fitMultiplet,
+            self.fitAllPeaks,
             self.areaUnderPeak, self.bgRoi,
             self.bgRoiRemove, self.pasternakShap,
             self.pasternakSingls]
         utilitiesMenuFuncs = [
             self.utiRoiFunct, self.utiRoiRemoveFunct, 
-            self.fitPeakFunct, self.fitNextPeakFunct,
+            self.fitPeakFunct, self.fitNextPeakFunct, self.fitMultipletFunct,
+            self.fitAllPeaksFunct,
             self.areaUnderPeakFunct, self.bgRoiFunct,
             self.bgRoiRemoveFunct, self.pasternakShape,
             self.pasternakSinglsh]
@@ -836,6 +1674,8 @@ class MainWindow(QtGui.QMainWindow):
         self.utilitiesMenu.addSeparator()
         self.utilitiesMenu.addAction(self.fitPeak)
         self.utilitiesMenu.addAction(self.fitNextPeak)
+        self.utilitiesMenu.addAction(self.fitMultiplet)
+        self.utilitiesMenu.addAction(self.fitAllPeaks)
         self.utilitiesMenu.addAction(self.areaUnderPeak)
 #        self.utilitiesMenu.addAction(self.pasternakShap)
 #        self.utilitiesMenu.addAction(self.pasternakSingls)
@@ -851,26 +1691,8 @@ class MainWindow(QtGui.QMainWindow):
         self.utilitiesMenu.addAction(self.pasternakSingls)
         ## reading file with custom matrix data
         # MakeMyGate_mattype.inp
-        basicMatType = [['2byte uint matrix','mat',4096,4096,'C','H','<',0,0],
-                        ['4byte uint matrix','m4b',4096,4096,'C','I','<',0,0]]
-        try:
-            self.mattypeFile = basicMatType
-            with open ('MakeMyGate_mattype.inp','r') as f:
-                mattypeFile = np.loadtxt(f, dtype=str, delimiter='\n')
-            mattypeFile = np.array(mattypeFile).reshape(-1,9)
-            self.mattypeFile.extend(mattypeFile.tolist())
-        except IOError:
-            print (
-            'MakeMyGate_mattype.inp not found.\n'\
-            + 'Only basic type of matrices available.')
-        except ValueError:
-            print (
-            'MakeMyGate_mattype.inp structure not matching required pattern.\n'
-            +' Only basic types of matrices available')
-        except:
-            print (
-            'unknown error occurred while trying\n'\
-            +'to load MakeMyGate_mattype.inp')
+        self.mattypeFile = readMattypeFile()
+        self.formatRegistry = matrixFormatRegistry(self.mattypeFile)
             
     def onAbout(self):
         """ About message""" 
@@ -886,10 +1708,12 @@ class MainWindow(QtGui.QMainWindow):
 
     def loadMatrixFunct(self):
         fileTypes = ''
-        for fileType in self.mattypeFile:
-            fileTypes += str(fileType[0]) + ' *.' + str(fileType[1]) \
-                +'(*.' + str(fileType[1]) + ');;'
-        fileTypes = fileTypes[:-2] #removes last(harmful)";;" from string
+        for fileType in self.mattypeFile: #also compressed, e.g. *.mat.gz
+            extension = '*.' + str(fileType[1])
+            fileTypes += str(fileType[0]) + ' ' + extension + '(' \
+                + ' '.join([extension] + [extension + compressed
+                    for compressed in ('.gz', '.bz2', '.xz')]) + ');;'
+        fileTypes += 'Any matrix, detect format (*)'
         fileName, filter = QtGui.QFileDialog.getOpenFileNameAndFilter(
             self, "Load matrix", "", fileTypes)
         print 'Loading matrix:'
@@ -898,62 +1722,278 @@ class MainWindow(QtGui.QMainWindow):
         #Status bar and transpose flag update
         self.currentNameStatus.setText(str(fileName))
         self.transposeStatus.setText(' ')
-        self.ifTranspose = False
+
+        #format from file size and first few KB
+        if str(filter).startswith('Any matrix'):
+            if isTextSample(readFileSample(str(fileName))):
+                self.openTextMatrix(str(fileName))
+                return
+            matType = self.formatRegistry.bestFormat(str(fileName))
+            if matType is None:
+                print 'Matrix format not detected, use Load custom matrix'
+                return
+            print 'Detected format: ' + str(matType[0])
+            self.openMatrixFile(
+                str(fileName), int(matType[2]), int(matType[3]),
+                str(matType[4]).split()[0], str(matType[5]),
+                str(matType[6]), int(matType[7]), int(matType[8]),
+                matTypeSymmetry(matType))
+            return
 
         #matching filter with known matrix formats        
         for possibleFilter in self.mattypeFile:
             if (str(filter).startswith(possibleFilter[0])):
-                with open(fileName, 'rb') as f:
-                    dataType = possibleFilter[6]+possibleFilter[5]
-                    self.matrix = np.fromfile(f,dtype=dataType)
-                self.matrix.shape = (possibleFilter[2], possibleFilter[3])
-                self.showMatrix(1)
+                self.openMatrixFile(
+                    str(fileName), int(possibleFilter[2]),
+                    int(possibleFilter[3]), str(possibleFilter[4]).split()[0],
+                    str(possibleFilter[5]), str(possibleFilter[6]),
+                    int(possibleFilter[7]), int(possibleFilter[8]),
+                    matTypeSymmetry(possibleFilter))
+
+    ## memory mapped matrix is shown at once and scanned in background,
+    ## otherwise (or if compressed) it is read in worker thread, upper
+    ## projection grows as blocks are read
+    def openMatrixFile(self, fileName, sizeX, sizeY, dataOrder, dataType,
+                       dataEndian, skipFirstBytes, skipLastBytes,
+                       symmetry='auto'):
+        fileArgs = (fileName, sizeX, sizeY, dataOrder, dataType, dataEndian,
+                    skipFirstBytes, skipLastBytes)
+        if self.matrixLoadThread is not None:
+            self.matrixLoadThread.cancel()
+            self.matrixLoadThread = None
+        self.matrixFileArgs = fileArgs
+        if self.memoryMappedLoad and compression(fileName) is None:
+            self.showMatrix(readMatrixFile(*fileArgs), symmetry)
+            return
+        self.startMatrixLoad(matrixStreamLoad(
+            fileArgs, self.engine.sparseThreshold,
+            self.engine.storedSymmetry(symmetry)), sizeY, symmetry)
+
+    ## text matrix (dense grid or x y count lines), sizes of 0 from file
+    def openTextMatrix(self, fileName, sizeX=0, sizeY=0, layout='auto',
+                       symmetry='auto'):
+        self.currentNameStatus.setText(str(fileName))
+        self.transposeStatus.setText(' ')
+        if self.matrixLoadThread is not None:
+            self.matrixLoadThread.cancel()
+            self.matrixLoadThread = None
+        self.matrixFileArgs = None
+        self.startMatrixLoad(textMatrixLoad(
+            (fileName, sizeX, sizeY, layout)), sizeY, symmetry)
+
+    def startMatrixLoad(self, loadThread, sizeY, symmetry):
+        if self.projectionScanThread is not None:
+            self.projectionScanThread.cancel()
+            self.projectionScanThread = None
+        self.removeAllRoisFunct()
+        self.vbUpper.clear()
+        self.upperSpe = lodCurveItem(np.zeros(max(sizeY, 1)))
+        self.vbUpper.addItem(self.upperSpe)
+        self.matrixLoadThread = loadThread
+        self.matrixLoadThread.sigProgress.connect(self.matrixLoadProgress)
+        self.matrixLoadThread.sigLoaded.connect(
+            lambda matrix, scanResult:
+                self.matrixLoaded(matrix, symmetry, scanResult))
+        self.matrixLoadThread.start()
+
+    def matrixLoaded(self, matrix, symmetry, scanResult):
+        self.matrixLoadThread = None
+        self.loadStatus.setText(' ')
+        self.showMatrix(matrix, symmetry, scanResult)
+
+    def matrixLoadProgress(self, done, total, projectionX):
+        if self.matrixLoadThread is not None:
+            self.loadStatus.setText('reading %d%%' % (100*done//total))
+        else:
+            self.loadStatus.setText('scanning %d%%' % (100*done//total))
+        if projectionX is not None:
+            self.upperSpe.setSpectrum(projectionX)
                         
+    ## live acquisition keeps rois, only gates on changed channels
+    ## are summed again
+    def liveWatchFileFunct(self):
+        if self.matrixFileArgs is None or self.engine.matrix is None:
+            print 'live: load binary matrix file first'
+            return
+        self.startLive(fileArgs=self.matrixFileArgs)
+
+    def liveListenFunct(self):
+        if self.engine.matrix is None:
+            print 'live: load (or create empty) matrix first'
+            return
+        port, ok = QtGui.QInputDialog.getInteger(
+            self, "Live events", "Local port for x y count uint32 events",
+            5555, 1024, 65535)
+        if ok:
+            self.startLive(port=port)
+
+    def startLive(self, fileArgs=None, port=None):
+        self.stopLiveFunct()
+        if self.projectionScanThread is not None: #scan result comes first
+            print 'live: wait until matrix is scanned'
+            return
+        worker = liveAcquisition(self.engine.startLive(), fileArgs, port,
+            symmetrise=(self.engine.symmetry == 'symmetrise'))
+        worker.sigDelta.connect(lambda rows, columns, counts:
+            self.liveDelta(worker, rows, columns, counts))
+        self.liveWorker = worker
+        self.liveWorker.start()
+        self.loadStatus.setText('live')
+
+    def stopLiveFunct(self):
+        if self.liveWorker is not None:
+            self.liveWorker.stop()
+            self.liveWorker = None
+            self.loadStatus.setText(' ')
+
+    def liveDelta(self, worker, rows, columns, counts):
+        if worker is not self.liveWorker: #stopped, delta is stale
+            return
+        try:
+            changed = self.engine.addCounts(rows, columns, counts)
+        except ValueError as error:
+            print 'live: ' + str(error)
+            return
+        finally:
+            worker.applied.set()
+        self.loadStatus.setText('live: %d counts' % np.sum(counts))
+        self.upperSpe.setSpectrum(self.engine.matrixProjectionX)
+        if not self.plusRoiList and not self.groupRoiList:
+            self.dataToPlot = self.engine.matrixProjectionY
+            self.lowerSpe.setSpectrum(self.dataToPlot)
+        elif self.engine.gatesOverlap(changed):
+            self.requestGateUpdate()
+
+    def histogramListModeFunct(self):
+        self.listModeWindow = listModeWindow()
+        self.listModeWindow.show()
+
     def loadCustomMatrixFunct(self):
         self.customMatLoad = loadCustomMatrix()
         self.customMatLoad.show()
                 
-    ## show matrix projections after loading
+    ## show matrix projections after loading (matrix given as argument,
+    ## optionally its symmetry and scan result as in engine.setMatrix)
     def showMatrix(self, *args):
         if args: #load new matrix
-            self.matrixProjectionX = np.sum(self.matrix, axis = 0)
-            self.matrixProjectionY = np.sum(self.matrix, axis = 1)
+            self.stopLiveFunct()
+            if self.projectionScanThread is not None:
+                self.projectionScanThread.cancel()
+                self.projectionScanThread = None
+            matrix = args[0]
+            symmetry = args[1] if len(args) > 1 else 'auto'
+            scanResult = args[2] if len(args) > 2 else None
+            if isinstance(matrix, np.memmap): #fill in from background
+                self.engine.setMatrix(matrix, True, symmetry)
+                self.projectionScanThread = projectionScan(
+                    matrix, self.engine.sparseThreshold, 
+                    self.engine.symmetry)
+                self.projectionScanThread.sigScanDone.connect(
+                    self.projectionScanDone)
+                self.projectionScanThread.sigProgress.connect(
+                    self.matrixLoadProgress)
+            else:
+                self.engine.setMatrix(matrix, False, symmetry, scanResult)
             self.removeAllRoisFunct()
             self.vbUpper.clear()
+            self.drawSecondGate()
             self.vbLower.clear()
-            self.upperSpe = pg.PlotCurveItem(
-                np.arange(0, len(self.matrixProjectionX)+1), 
-                self.matrixProjectionX,stepMode=True,
-                name = 'mat proj')
+            self.upperSpe = lodCurveItem(
+                self.engine.matrixProjectionX, name = 'mat proj')
             try:
                 self.vbUpper.legend.removeItem('mat proj')
             except:
                 0
-            self.lowerSpe = pg.PlotCurveItem(
-                np.arange(0, len(self.matrixProjectionY)+1), 
-                self.matrixProjectionY,stepMode=True,
-                name = 'gated spe')
+            self.lowerSpe = lodCurveItem(
+                self.engine.matrixProjectionY, name = 'gated spe')
             try:
                 self.vbLower.legend.removeItem('gated spe')
             except:
                 0
             self.vbUpper.addItem(self.upperSpe)
             self.vbLower.addItem(self.lowerSpe)
-            self.dataToPlot = self.matrixProjectionY
+            self.dataToPlot = self.engine.matrixProjectionY
+            self.updateCalibrationAxes() #matrix may have other lengths
+            if self.projectionScanThread is not None:
+                self.projectionScanThread.start()
+            if self.matrixMap is not None:
+                self.matrixMap.setMatrix(self.engine)
         else: #just refresh the view after transpose
-            self.matrixProjectionX = np.sum(self.matrix, axis = 0)
             self.vbUpper.removeItem(self.upperSpe)
-            self.upperSpe = pg.PlotCurveItem(
-                np.arange(0, len(self.matrixProjectionX)+1), 
-                self.matrixProjectionX,stepMode=True)
+            self.upperSpe = lodCurveItem(self.engine.matrixProjectionX)
             self.vbUpper.addItem(self.upperSpe)          
-            self.matrixProjectionY = np.sum(self.matrix, axis = 1)
             self.vbLower.removeItem(self.lowerSpe)
-            self.lowerSpe = pg.PlotCurveItem(
-                np.arange(0, len(self.matrixProjectionY)+1), 
-                self.matrixProjectionY,stepMode=True)
+            self.lowerSpe = lodCurveItem(self.engine.matrixProjectionY)
             self.vbLower.addItem(self.lowerSpe)
-            self.dataToPlot = self.matrixProjectionY
+            self.dataToPlot = self.engine.matrixProjectionY
+
+    ## projections of memory mapped matrix are ready
+    def projectionScanDone(self, projectionX, projectionY, storedMatrix):
+        self.projectionScanThread = None
+        self.loadStatus.setText(' ')
+        self.engine.setScanResult(projectionX, projectionY, storedMatrix)
+        if storedMatrix is not None:
+            self.requestGateUpdate()
+        self.upperSpe.setSpectrum(self.engine.matrixProjectionX)
+        if not (self.plusRoiList or self.groupRoiList): #no gate yet
+            self.dataToPlot = self.engine.matrixProjectionY
+            self.lowerSpe.setSpectrum(self.engine.matrixProjectionY)
+        print 'matrix projections ready'
+
+    def memoryMappedFunct(self):
+        if self.memoryMappedLoad:
+            print 'memory-mapped loading: OFF'
+            self.memoryMappedLoad = False
+            self.memoryMapped.setText("Memory-mapped loading: OFF")
+        else:
+            print 'memory-mapped loading: ON'
+            self.memoryMappedLoad = True
+            self.memoryMapped.setText("Memory-mapped loading: ON")
+
+    def symmetricStorageFunct(self):
+        if self.engine.symmetricStorage:
+            print 'packed symmetric matrices: OFF'
+            self.engine.symmetricStorage = False
+            self.symmetricStorage.setText("Packed symmetric matrices: OFF")
+        else:
+            print 'packed symmetric matrices: ON'
+            self.engine.symmetricStorage = True
+            self.symmetricStorage.setText("Packed symmetric matrices: ON")
+
+    def setSparseThresholdFunct(self):
+        DialogWindow = QtGui.QInputDialog(self)
+        value, ok = DialogWindow.getDouble(
+            self, "Sparse storage threshold",
+            "Store matrix sparse below occupancy (0 - never, 1 - always)",
+            self.engine.sparseThreshold, 0., 1., 3)
+        if ok:
+            self.engine.sparseThreshold = value
+            print 'applied on next matrix load'
+        else:
+            print 'canceled or input error'
+
+    def matrixStorageReportFunct(self):
+        if self.engine.matrix is None:
+            print 'no matrix loaded'
+            return
+        report = storageReport(self.engine.matrix)
+        print report
+        QtGui.QMessageBox.information(self, 'Matrix storage report', report)
+
+    def setGateIndexFunct(self):
+        DialogWindow = QtGui.QInputDialog(self)
+        indexTypes = ['off', 'uint32', 'int64']
+        Text, ok = DialogWindow.getItem(
+            self, "Gate index precision",
+            "off - no extra memory\n"
+            + "uint32 - 2x uint16 matrix size, gate < 2**32 counts\n"
+            + "int64 - 4x uint16 matrix size, exact",
+            indexTypes, indexTypes.index(self.engine.gateIndexType), False)
+        if ok:
+            self.engine.gateIndexType = str(Text)
+            self.engine.buildGateIndex()
+        else:
+            print 'canceled or input error'
                                             
     def saveSpeFunct(self): # saves gated spe, error spe and rois list to file
         fileTypes = ("Radware SPE (*.spe);;Text file (*.txt)")
@@ -977,22 +2017,10 @@ class MainWindow(QtGui.QMainWindow):
                 FileName1 = FileName + str('.spe')
                 FileName2 = FileName + str('.err') 
                 self.saveRoiListToFileFunct(FileName)
-            inSpeName = str(8*' ') + str(FileName1)
-            speHeader = sct.pack(
-                'I8s6I',24,inSpeName[-8:],4096,1,1,1,24,16384)
-            if len(self.groupRoiList) == 0:                
-                speToPack = self.caclGatedSpe()
-                errToPack = self.calcErrSpe()
-            else:
-                speToPack = self.calcGatedSpeGroups()
-                errToPack = self.calcErrSpeGroups()
-            packedSpe = sct.pack('<'+4096*'f',*speToPack)
-            speEnding = sct.pack('I',16384)
-            with open(FileName1, 'wb') as f:
-                f.write(speHeader + packedSpe + speEnding)
-            packedErr = sct.pack('<'+4096*'f',*errToPack)
-            with open(FileName2, 'wb') as f:
-                f.write(speHeader + packedErr + speEnding)
+            speToPack, errToPack = self.gateSpectra(
+                len(self.groupRoiList) > 0)[:2]
+            writeSpe(FileName1, speToPack)
+            writeSpe(FileName2, errToPack, FileName1)
         if filter == 'Text file (*.txt)':
             FileName1 = FileName + str('.txt')
             toSaveText1 = self.caclGatedSpe()
@@ -1069,12 +2097,12 @@ class MainWindow(QtGui.QMainWindow):
         DialogWindow = QtGui.QInputDialog(self)
         Text, ok = DialogWindow.getText(
             self, "set refresh interval in ms",
-            "Time in ms", 
+            "Time in ms (gate changes within it are merged)", 
             QtGui.QLineEdit.Normal,
             "0 for instant refreshing")
         if ok and len(Text):
-            self.resfreshTime = int(Text)
-            timer.setInterval(self.resfreshTime)
+            self.refreshTime = int(Text)
+            timer.setInterval(self.refreshTime)
         else:
             print 'canceled or input error'
         
@@ -1087,28 +2115,47 @@ class MainWindow(QtGui.QMainWindow):
                 iniText + " | not working - press Ctrl+X to start")
             timer.stop()
         else:
+            self.gateDirty = True
             self.lowerPlotUpdate()
             self.programRunning = True
             print 'Start'
             iniText = self.windowTitle
             self.setWindowTitle(iniText.replace(
                 " | not working - press Ctrl+X to start",''))
-            timer.start()
 
+    ## polynomial calibration E = a0 + a1 ch + a2 ch^2 ... of both axes,
+    ## single number is keV/channel as before
     def setCalibrationFunct(self):
         print 'set calibration'
-        DialogWindow = QtGui.QInputDialog(self)
-        Text, ok = DialogWindow.getText(
-            self, "Energy calibration",
-            "keV/channel", 
-            QtGui.QLineEdit.Normal,
-            "0.5 default")
-        if ok and len(Text):
-            self.energyCalibAxis = float(Text)
-            self.energyAxisUpper.setScale(self.energyCalibAxis)
-            self.energyAxisLower.setScale(self.energyCalibAxis)
-        else:
-            print 'canceled or input error'
+        calibrations = []
+        for axisName, calibration in (
+                ('projection (X)', self.engine.calibrationX),
+                ('gated spectrum (Y)', self.engine.calibrationY)):
+            Text, ok = QtGui.QInputDialog.getText(
+                self, "Energy calibration",
+                "a0 a1 a2 ... of " + axisName + " axis, keV",
+                QtGui.QLineEdit.Normal, str(calibration))
+            try:
+                calibrations.append(energyCalibration.fromText(Text))
+            except ValueError:
+                ok = False
+            if not ok or not len(Text):
+                print 'canceled or input error'
+                return
+        for calibration, length in zip(
+                calibrations, self.engine.axisLengths()):
+            if not calibration.grows(length):
+                QtGui.QMessageBox.warning(self, 'Energy calibration',
+                    'calibration ' + str(calibration) + ' does not grow'
+                    ' on 0..' + str(length) + ' channels, not set')
+                return
+        self.engine.calibrationX, self.engine.calibrationY = calibrations
+        self.updateCalibrationAxes()
+
+    def updateCalibrationAxes(self):
+        lengthX, lengthY = self.engine.axisLengths()
+        self.energyAxisUpper.setCalibration(self.engine.calibrationX, lengthX)
+        self.energyAxisLower.setCalibration(self.engine.calibrationY, lengthY)
 
     def peakFindFunct(self):
         print 'pf start'
@@ -1118,67 +2165,165 @@ class MainWindow(QtGui.QMainWindow):
         except AttributeError:
             print "no gates found - gated spectrum doesn't exist"
         
+    def autoPeakFindFunct(self):
+        if self.peakFindActive:
+            print 'auto peak find: OFF'
+            self.peakFindActive = False
+            self.autoPeakFind.setText("Auto peak find: OFF")
+        else:
+            print 'auto peak find: ON'
+            self.peakFindActive = True
+            self.autoPeakFind.setText("Auto peak find: ON")
+            self.peakFindFunct()
+
+    ## compares cwt and derivative peak search on displayed spectra
+    def peakFindBenchmarkFunct(self):
+        if self.engine.matrix is None:
+            print 'no matrix loaded'
+            return
+        report = benchmarkPeakFind(
+            [('projection', self.engine.matrixProjectionX),
+             ('gated spectrum', self.dataToPlot)],
+            np.arange(self.engine.minPeakWidth, self.engine.maxPeakWidth),
+            self.engine.noisePeakWidth)
+        print report
+        QtGui.QMessageBox.information(self, 'Peak find benchmark', report)
+
     def peakFindUpper(self):#executed on pf activation and on pf params change
         print 'upper PF'
-        for label in self.peaksLabelsUpper:
-            self.vbUpper.removeItem(label) 
-        self.peaksListUpper = find_peaks_cwt(
-            self.matrixProjectionX, 
-            np.arange(self.minPeakWidth,self.maxPeakWidth), 
-            noise_perc=self.noisePeakWidth)           
-        for peak0 in self.peaksListUpper:
-            peak = peak0
-            self.roiLabel = pg.TextItem(
-                text = str(peak*self.energyCalibAxis),
-                color=(200, 200, 200), angle=0)
-            self.roiLabel.setZValue(20)
-            top = self.matrixProjectionX[peak]
-            position = peak
-            self.roiLabel.setPos(position, top)
-            self.vbUpper.addItem(self.roiLabel)
-            self.peaksLabelsUpper.append(self.roiLabel)
+        self.upperPeakWorker.findPeaks(self.engine.matrixProjectionX)
 
     #executed together with self.peakFindUpper()
     #and on lower plot refresh if self.peakFindActive = True
-    #auto peak find disabled, freezes everyting
     def peakFindLower(self):
         print 'lower PF'
-        #clear labels
-        for label in self.peaksLabelsLower:
-            self.vbLower.removeItem(label)
-            
-        #create peak list
-        self.peaksListLower = find_peaks_cwt(
-            self.dataToPlot, 
-            np.arange(self.minPeakWidth,self.maxPeakWidth), 
-            noise_perc=self.noisePeakWidth)
-        for peak0 in self.peaksListLower:
-            peak = peak0
+        self.lowerPeakWorker.findPeaks(self.dataToPlot)
+
+    ## peaks found in background, labels are put over them
+    def showPeaksUpper(self, requestId, spectrum, peaks):
+        if self.upperPeakWorker.isStale(requestId):
+            return
+        self.peaksListUpper = peaks
+        self.peaksLabelsUpper = self.showPeakLabels(
+            self.vbUpper, self.peaksLabelsUpper, spectrum, peaks,
+            self.engine.calibrationX)
+
+    def showPeaksLower(self, requestId, spectrum, peaks):
+        if self.lowerPeakWorker.isStale(requestId): #gate changed meanwhile
+            return
+        self.peaksListLower = peaks
+        self.peaksLabelsLower = self.showPeakLabels(
+            self.vbLower, self.peaksLabelsLower, spectrum, peaks,
+            self.engine.calibrationY)
+
+    def showPeakLabels(self, plot, oldLabels, spectrum, peaks, calibration):
+        for label in oldLabels:
+            plot.removeItem(label)
+        labels = []
+        for peak in peaks:
             self.roiLabel = pg.TextItem(
-                text = str(peak*self.energyCalibAxis),
+                text = '%.1f' % calibration.energy(peak),
                 color=(200, 200, 200), angle=0)
             self.roiLabel.setZValue(20)
-            top = self.dataToPlot[peak]
+            top = spectrum[peak]
             position = peak
             self.roiLabel.setPos(position, top)
-            self.vbLower.addItem(self.roiLabel)
-            self.peaksLabelsLower.append(self.roiLabel)
+            plot.addItem(self.roiLabel)
+            labels.append(self.roiLabel)
+        return labels
 
     def peakFindParamsFunct(self):
         print 'pf params change'
         self.pfWindow = pfParamsWindow()
         self.pfWindow.show()
 
+    def showMatrixMapFunct(self):
+        if self.engine.matrix is None:
+            print 'no matrix loaded'
+            return
+        if self.matrixMap is None:
+            self.matrixMap = matrixMapWindow()
+            self.matrixMap.setMatrix(self.engine)
+            self.matrixMap.syncRois()
+        self.matrixMap.show()
+        self.matrixMap.raise_()
+
+    ## gamma-gamma-gamma cube: gates of loaded matrix projection are set
+    ## as second gate, new rois are the first one and lower plot shows
+    ## double gated cube spectrum
+    def loadCubeFunct(self):
+        fileName = str(QtGui.QFileDialog.getOpenFileName(
+            self, "Load cube", "", "Any file(*)"))
+        if not fileName:
+            return
+        text, ok = QtGui.QInputDialog.getText(
+            self, "Cube format",
+            "size, cell type, endian, symmetric or full, skipped bytes",
+            QtGui.QLineEdit.Normal, "4096 I < symmetric 0")
+        if not ok:
+            return
+        try:
+            size, dataType, dataEndian, storage, skipFirstBytes = \
+                str(text).split()
+            self.setCube(openCubeFile(fileName, int(size), dataType,
+                dataEndian, storage == 'symmetric', int(skipFirstBytes)))
+        except (IOError, ValueError) as error:
+            print 'cube: ' + str(error)
+
+    def setCube(self, cube):
+        self.engine.cube = cube
+        print 'cube %d^3, %s storage %.1f GB' % (cube.size,
+            'symmetric' if cube.symmetric else 'full',
+            cube.cells.nbytes/2.**30)
+        self.requestGateUpdate()
+
+    def setSecondGateFunct(self):
+        if self.engine.cube is None:
+            print 'load cube first'
+            return
+        self.engine.secondPlusRois = [
+            r.roiRegion.getRegion() for r in self.plusRoiList]
+        self.engine.secondMinusRois = [
+            r.roiRegion.getRegion() for r in self.minusRoiList]
+        self.engine.secondGroupRois = [
+            r.roiRegion.getRegion() for r in self.groupRoiList]
+        self.removeAllRoisFunct()
+        self.drawSecondGate()
+        self.requestGateUpdate()
+
+    def clearSecondGateFunct(self):
+        self.engine.secondPlusRois = []
+        self.engine.secondMinusRois = []
+        self.engine.secondGroupRois = []
+        self.drawSecondGate()
+        self.requestGateUpdate()
+
+    def drawSecondGate(self): #fixed, paler than rois
+        for item in self.secondGateItems:
+            self.vbUpper.removeItem(item)
+        self.secondGateItems = []
+        for regions, color in ((self.engine.secondPlusRois, (255,0,0,35)),
+                               (self.engine.secondMinusRois, (0,0,255,35)),
+                               (self.engine.secondGroupRois, (0,255,0,25))):
+            for region in regions:
+                item = pg.LinearRegionItem(region, brush=color,
+                                           movable=False)
+                item.setZValue(-10)
+                self.vbUpper.addItem(item)
+                self.secondGateItems.append(item)
+
     def transposeMatrixFunct(self):
         print 'transpose matrix'
-        self.matrix = self.matrix.transpose()
+        self.engine.transpose()
+        self.updateCalibrationAxes()
+        self.requestGateUpdate()
         self.showMatrix()
-        if self.ifTranspose:
-            self.ifTranspose = False
-            self.transposeStatus.setText(' ')
-        else:
-            self.ifTranspose = True
+        if self.matrixMap is not None:
+            self.matrixMap.transpose()
+        if self.engine.ifTranspose:
             self.transposeStatus.setText('TRANSPOSED')
+        else:
+            self.transposeStatus.setText(' ')
 
     def displayLegendFunct(self):
         if self.legendVisible:
@@ -1190,89 +2335,37 @@ class MainWindow(QtGui.QMainWindow):
             self.vbLower.legend.show()
             self.legendVisible = True
 
+    ## copies roi regions to engine and gates the matrix
+    ## with cube and second gate set, rois are the first gate of cube
+    def calcGate(self, useGroups):
+        self.engine.plusRois = [
+            r.roiRegion.getRegion() for r in self.plusRoiList]
+        self.engine.minusRois = [
+            r.roiRegion.getRegion() for r in self.minusRoiList]
+        self.engine.groupRois = [
+            r.roiRegion.getRegion() for r in self.groupRoiList]
+        if self.engine.cube is not None and (self.engine.secondPlusRois
+                or self.engine.secondGroupRois):
+            return self.engine.doubleGate(useGroups)
+        return self.engine.gate(useGroups)
+
+    ## gating result is kept until next gate change
+    def gateSpectra(self, useGroups):
+        if useGroups not in self.gateResults:
+            self.gateResults[useGroups] = self.calcGate(useGroups)
+        return self.gateResults[useGroups]
+
     def calcErrSpe(self): #calculates error spectrum ^2
-        backgroundSpe = np.zeros(4096)
-        if(len(self.plusRoiList)):
-            rawSpe = self.plusRoiList[0].sliceMatrix()
-            suppresionUp = self.plusRoiList[0].askWidth()
-            self.plusRoiList[0].updateRoiLabel()
-            for roiPlus in self.plusRoiList[1:]:
-                rawSpe += roiPlus.sliceMatrix()
-                suppresionUp += roiPlus.askWidth()
-            dataToPlot = rawSpe
-        if(len(self.minusRoiList)): 
-            suppresionDown = self.minusRoiList[0].askWidth()
-            backgroundSpe = self.minusRoiList[0].sliceMatrix()
-            self.minusRoiList[0].updateRoiLabel()
-            for roiMinus in self.minusRoiList[1:]:
-                backgroundSpe += roiMinus.sliceMatrix()
-                suppresionDown += roiMinus.askWidth()
-            suppresionFactor = float(suppresionUp)/float(suppresionDown)
-            dataToPlot = rawSpe + suppresionFactor**2*backgroundSpe
-        return dataToPlot        
+        return self.gateSpectra(False)[1]
 
     def caclGatedSpe(self): #calculates gated spectrum
-        backgroundSpe = np.zeros(4096)
-        if(len(self.plusRoiList)):
-            rawSpe = self.plusRoiList[0].sliceMatrix()
-            suppresionUp = self.plusRoiList[0].askWidth()
-            self.plusRoiList[0].updateRoiLabel()
-            for roiPlus in self.plusRoiList[1:]:
-                rawSpe += roiPlus.sliceMatrix()
-                suppresionUp += roiPlus.askWidth()
-            dataToPlot = rawSpe
-        if(len(self.minusRoiList)): 
-            suppresionDown = self.minusRoiList[0].askWidth()
-            backgroundSpe = self.minusRoiList[0].sliceMatrix()
-            self.minusRoiList[0].updateRoiLabel()
-            for roiMinus in self.minusRoiList[1:]:
-                backgroundSpe += roiMinus.sliceMatrix()
-                suppresionDown += roiMinus.askWidth()
-            suppresionFactor = float(suppresionUp)/float(suppresionDown)
-            dataToPlot = rawSpe - suppresionFactor*backgroundSpe
-        return dataToPlot
+        return self.gateSpectra(False)[0]
 
     def calcGatedSpeGroups(self): #calculates gated spe with groups
-        finalSpe = np.zeros(4096)
-        for group in self.groupRoiList:
-            plusRegions = [roi for roi in self.plusRoiList \
-                if roi.isInRegion(group.roiRegion.getRegion())]
-            minusRegions = [roi for roi in self.minusRoiList \
-                if roi.isInRegion(group.roiRegion.getRegion())]
-            plusSpe = np.zeros(4096)
-            minusSpe = np.zeros(4096)
-            upFactor = 0.
-            downFactor = 0.            
-            for roi in plusRegions:
-                plusSpe += roi.sliceMatrix()
-                upFactor += roi.askWidth()
-            for roi in minusRegions:
-                minusSpe += roi.sliceMatrix()
-                downFactor += roi.askWidth()
-            supFact = float(upFactor)/float(downFactor)
-            finalSpe = finalSpe + plusSpe - supFact*minusSpe
-        return finalSpe
+        return self.gateSpectra(True)[0]
 
     def calcErrSpeGroups(self): #calculates error spe^2 with groups
-        finalSpe = np.zeros(4096)
-        for group in self.groupRoiList:
-            plusRegions = [roi for roi in self.plusRoiList \
-                if roi.isInRegion(group.roiRegion.getRegion())]
-            minusRegions = [roi for roi in self.minusRoiList \
-                if roi.isInRegion(group.roiRegion.getRegion())]
-            plusSpe = np.zeros(4096)
-            minusSpe = np.zeros(4096)
-            upFactor = 0.
-            downFactor = 0.            
-            for roi in plusRegions:
-                plusSpe += roi.sliceMatrix()
-                upFactor += roi.askWidth()
-            for roi in minusRegions:
-                minusSpe += roi.sliceMatrix()
-                downFactor += roi.askWidth()
-            supFact = float(upFactor)/float(downFactor)
-            finalSpe = finalSpe + plusSpe + supFact**2*minusSpe
-        return finalSpe
+        return self.gateSpectra(True)[1]
 
     #saves all rois to text file with ".rl" ext
     def saveRoiListToFileFunct(self, *args):
@@ -1282,50 +2375,25 @@ class MainWindow(QtGui.QMainWindow):
             FileName0 = QtGui.QFileDialog.getSaveFileName(
                 self, "Save ROI list", "", "Text file (*.rl)")
         FileName = FileName0 + str('.rl')
-        ToSaveText = str('PlusRois: ') + str(len(self.plusRoiList)) + '\n' + \
-        str('MinusRois: ') + str(len(self.minusRoiList)) + '\n' + \
-        str('GroupRois: ') + str(len(self.groupRoiList)) + '\n'
-        for roi in self.plusRoiList:
-            ToSaveText += str(int(roi.roiRegion.getRegion()[0])) + ' ' + \
-            str(int(roi.roiRegion.getRegion()[1])) + '\n'
-        for roi in self.minusRoiList:
-            ToSaveText += str(int(roi.roiRegion.getRegion()[0])) + ' ' + \
-            str(int(roi.roiRegion.getRegion()[1])) + '\n'
-        for roi in self.groupRoiList:
-            ToSaveText += str(int(roi.roiRegion.getRegion()[0])) + ' ' + \
-            str(int(roi.roiRegion.getRegion()[1])) + '\n'
-        with open(FileName, 'w') as f:
-            f.write(ToSaveText)
+        writeRoiList(
+            FileName,
+            [r.roiRegion.getRegion() for r in self.plusRoiList],
+            [r.roiRegion.getRegion() for r in self.minusRoiList],
+            [r.roiRegion.getRegion() for r in self.groupRoiList])
 
     def loadRoiListFunct(self): #lazy, but works
         fileName = QtGui.QFileDialog.getOpenFileName(
             self, "Open file","", "Roi list(*.rl);;any(*)")
-        with open(fileName, 'r') as f:
-            roiFromFile = f.read().splitlines()
-        pCount = int((roiFromFile[0]).split()[-1]) 
-        mCount = int((roiFromFile[1]).split()[-1]) 
-        gCount = int((roiFromFile[2]).split()[-1]) 
-        for roiLine in roiFromFile[3:3+pCount]:
-            viewBoxRange = roiLine.split()
-            roiCenter = (int(viewBoxRange[1]) + int(viewBoxRange[0]))//2
-            roiWidth = int(viewBoxRange[1]) - int(viewBoxRange[0])
-            color = (255,0,0,90)
-            newRoi = roi(roiCenter, roiWidth, color, 1, 'plus')
-            self.plusRoiList.append(newRoi)
-        for roiLine in roiFromFile[3+pCount:3+pCount+mCount]:
-            viewBoxRange = roiLine.split()
-            roiCenter = (int(viewBoxRange[1]) + int(viewBoxRange[0]))//2
-            roiWidth = int(viewBoxRange[1]) - int(viewBoxRange[0])
-            color = (0,0,255,90)
-            newRoi = roi(roiCenter, roiWidth, color, 1, 'minus')
-            self.minusRoiList.append(newRoi)
-        for roiLine in roiFromFile[3+pCount+mCount:3+pCount+mCount+gCount]:
-            viewBoxRange = roiLine.split()
-            roiCenter = (int(viewBoxRange[1]) + int(viewBoxRange[0]))//2
-            roiWidth = int(viewBoxRange[1]) - int(viewBoxRange[0])
-            color = (0,255,0,90)
-            newRoi = roi(roiCenter, roiWidth, color, 1, 'group')
-            self.groupRoiList.append(newRoi)
+        plusRois, minusRois, groupRois = readRoiList(str(fileName))
+        for regions, color, roiType, roiList in (
+                (plusRois, (255,0,0,90), 'plus', self.plusRoiList),
+                (minusRois, (0,0,255,90), 'minus', self.minusRoiList),
+                (groupRois, (0,255,0,90), 'group', self.groupRoiList)):
+            for region in regions:
+                roiCenter = (region[1] + region[0])//2
+                roiWidth = region[1] - region[0]
+                newRoi = roi(roiCenter, roiWidth, color, 1, roiType)
+                roiList.append(newRoi)
 
     #### Display additional spectrum ###
     def addSpectrumFunct(self):
@@ -1381,6 +2449,7 @@ class MainWindow(QtGui.QMainWindow):
         self.vbLower.addItem(self.utiRoi)
 
     def utiRoiRemoveFunct(self):
+        self.removeMultipletItems()
         try:
             self.vbLower.removeItem(self.utiRoi)
             self.vbLower.removeItem(self.fitBackground)
@@ -1398,63 +2467,27 @@ class MainWindow(QtGui.QMainWindow):
             self.bgLimits = self.bgRoi.getRegion()
         except:
             self.bgLimits = self.roiLimits
-        self.bgLen = int(self.bgLimits[1]) - int(self.bgLimits[0]) + 1
-        self.speRegion = self.dataToPlot[
-            int(self.roiLimits[0]):int(self.roiLimits[1] + 1)]
-        #level of background
-        self.bgPoints = self.dataToPlot[
-            int(self.bgLimits[0])],self.dataToPlot[int(self.bgLimits[1])]
-        fitBgParams = np.polyfit([0,self.bgLen],self.bgPoints,1)
-        self.bgSpe = np.arange(self.bgLen)
-        self.bgSpe = self.bgSpe*fitBgParams[0] + fitBgParams[1]
+        try:
+            self.firstFit = self.engine.fitPeak(
+                self.dataToPlot, self.roiLimits, self.bgLimits)
+        except ValueError as error:
+            print error
+            return
+        self.speRegion = self.firstFit.speRegion
+        self.gaussToPlot = self.firstFit.fitSpe
         self.fitSpeAxis = np.arange(
             int(self.roiLimits[0]),int(self.roiLimits[1] + 1)+1,1)    
         self.fitBgAxis = np.arange(
             int(self.bgLimits[0]),int(self.bgLimits[1] + 1)+1,1)
         
         try:
-            self.fitBackground.setData(self.fitBgAxis, self.bgSpe)
+            self.fitBackground.setData(self.fitBgAxis, self.firstFit.bgSpe)
         except:
             self.fitBackground = pg.PlotCurveItem(
-                self.fitBgAxis, self.bgSpe, stepMode = True)
+                self.fitBgAxis, self.firstFit.bgSpe, stepMode = True)
             self.fitBackground.setPen(0,0,255)
             self.vbLower.addItem(self.fitBackground)
 
-        def gaussToFit(x,a,mu,sig):
-            return a*np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))\
-                +self.bgSpeCut[x]
-            
-        def guassToFitErr(p,x,y):
-            return y - gaussToFit(x,*p)
-
-        if int(self.roiLimits[0]) - int(self.bgLimits[0]) >= 0:
-            bgLeft = int(self.roiLimits[0]) - int(self.bgLimits[0])
-        else:
-            print 'Left Peak ROI out of Background ROI'
-            return
-        if int(self.bgLimits[1]) - int(self.roiLimits[1]) >= 0:
-            bgRight = int(self.bgLimits[1]) - int(self.roiLimits[1])
-        else:
-            print 'Right Peak ROI out of Background ROI'
-            return
-        
-        if bgRight and bgLeft:
-            self.bgSpeCut = self.bgSpe[bgLeft:-bgRight]
-        elif bgLeft:
-            self.bgSpeCut = self.bgSpe[bgLeft:]
-        elif bgRight:
-            self.bgSpeCut = self.bgSpe[:-bgRight]
-        else:
-            self.bgSpeCut = self.bgSpe[:]
-            
-        guess = np.max(self.speRegion), self.roiLimits[1]-self.roiLimits[0], 5.
-        x = xrange(len(self.speRegion))   
-        y = self.speRegion
-                    
-        out = leastsq(guassToFitErr, guess, args = (x,y))
-        self.firstSigma = out[0][2] #for 2nd peak fitting
-
-        self.gaussToPlot = gaussToFit(xrange(len(self.speRegion)),*out[0])
         try:
             self.fitGauss.setData(self.fitSpeAxis, self.gaussToPlot)
         except:
@@ -1464,57 +2497,13 @@ class MainWindow(QtGui.QMainWindow):
             self.fitGauss.setZValue(10)
             self.vbLower.addItem(self.fitGauss)      
            
-        area = np.sum(self.gaussToPlot) - np.sum(self.bgSpeCut)
-        centroid1 = (out[0][1] + int(self.roiLimits[0]))*self.energyCalibAxis
-        fwhm = 2.355*abs(out[0][2])*self.energyCalibAxis
-        peaktext = str('Area=%d \nE=%.1fkeV \nFWHM=%.2fkeV' 
-            % (area, centroid1, fwhm))
         print '------\n 1st peak fit:'
-        print peaktext
-        try:
-            self.fitLabel.setText(peaktext)
-            top = self.dataToPlot[int(out[0][1])+ int(self.roiLimits[0])]
-            position = centroid1/self.energyCalibAxis
-            self.fitLabel.setPos(position, top)
-        except:
-            self.fitLabel = pg.TextItem(
-                text = peaktext,
-                color=(255, 255, 255), angle=0,
-                anchor=(0, 1))
-            top = self.dataToPlot[int(out[0][1])+ int(self.roiLimits[0])]
-            position = centroid1/self.energyCalibAxis
-            self.fitLabel.setZValue(10)
-            self.vbLower.addItem(self.fitLabel)
-            self.fitLabel.setPos(position, top)
+        self.fitLabel = self.showFitResult(self.firstFit, 'fitLabel')
 
     # fits another gaussian peak if possible
     def fitNextPeakFunct(self):
-        newSpeToFit = self.speRegion - self.gaussToPlot + self.bgSpeCut
-        
-        def gaussToFit(x,a,mu,sig):
-            return a*np.exp(-np.power(x - mu, 2.) \
-                /(2 * np.power(sig, 2.)))+self.bgSpeCut[x]
-            
-        def guassToFitErr(p,x,y):
-            penalize = 0.
-            if abs(p[2]) > self.firstSigma + 0.7 \
-                or abs(p[2]) < self.firstSigma - 0.7:
-                if abs(p[2]) < 1:
-                    penalize = 0#abs(p[2])**-5*np.sum(y - self.bgSpe)
-                else:
-                    penalize = 0#abs(p[2])**5*np.sum(y - self.bgSpe)
-            penalize1 = 0.
-            if p[0] < 0.:
-                penalize1 = 0#abs(p[0])*np.sum(y - self.bgSpe)
-            return y - gaussToFit(x,*p) + penalize + penalize1
-
-        guess = [np.max(newSpeToFit), self.roiLimits[1] - self.roiLimits[0],
-                 self.firstSigma]            
-        x = xrange(len(self.speRegion))   
-        y = newSpeToFit               
-        out = leastsq(guassToFitErr, guess, args = (x,y))
-
-        self.newGaussToPlot = gaussToFit(xrange(len(self.speRegion)),*out[0])
+        nextFit = self.engine.fitNextPeak(self.firstFit)
+        self.newGaussToPlot = nextFit.fitSpe
         try:
             self.newFitGauss.setData(self.fitSpeAxis, self.newGaussToPlot)
         except:
@@ -1524,31 +2513,111 @@ class MainWindow(QtGui.QMainWindow):
             self.newFitGauss.setZValue(10)
             self.vbLower.addItem(self.newFitGauss)       
 
-        area = np.sum(self.newGaussToPlot) - np.sum(self.bgSpeCut)
-        centroid1 = (out[0][1] + int(self.roiLimits[0]))*self.energyCalibAxis
-        fwhm = 2.355*abs(out[0][2])*self.energyCalibAxis
         print '------\n 2nd peak fit:'
-        '''print 'Area=' + str(area) + ' energy=' + str(centroid1) + \
-        ' FWHM=' + str(fwhm)'''
-        peaktext = str('Area=%d \nE=%.1fkeV \nFWHM=%.2fkeV' \
-            % (area, centroid1, fwhm))
-        print peaktext
+        self.fitLabel2 = self.showFitResult(nextFit, 'fitLabel2')
 
+    # fits all peaks in ROI together, peaks found in lower spectrum
+    # are start positions if their number is as requested
+    def fitMultipletFunct(self):
         try:
-            self.fitLabel2.setText(peaktext)
-            top = self.dataToPlot[int(out[0][1])+ int(self.roiLimits[0])]
-            position = centroid1/self.energyCalibAxis
-            self.fitLabel2.setPos(position, top)
-        except:
-            self.fitLabel2 = pg.TextItem(
+            self.roiLimits = self.utiRoi.getRegion()
+        except AttributeError:
+            print 'add fit ROI first'
+            return
+        peaksInRoi = [peak for peak in self.peaksListLower
+            if self.roiLimits[0] < peak < self.roiLimits[1]]
+        DialogWindow = QtGui.QInputDialog(self)
+        peakCount, ok = DialogWindow.getInt(
+            self, "Fit multiplet", "Number of peaks in ROI",
+            max(len(peaksInRoi), 2), 1, 20)
+        if not ok:
+            print 'canceled or input error'
+            return
+        centroids = peaksInRoi if len(peaksInRoi) == peakCount else None
+        try:
+            fit = self.engine.fitMultiplet(
+                self.dataToPlot, self.roiLimits, peakCount, centroids)
+        except ValueError as error:
+            print error
+            return
+
+        self.removeMultipletItems()
+        fitStart = int(self.roiLimits[0])
+        fitAxis = np.arange(fitStart, fitStart + len(fit.fitSpe) + 1)
+        curves = [(fit.bgSpeCut, (0,0,255)), (fit.fitSpe, (255,0,0))]
+        curves += [(peakSpe, (0,255,0)) for peakSpe in fit.peakSpectra]
+        for curveSpe, color in curves:
+            curve = pg.PlotCurveItem(fitAxis, curveSpe, stepMode = True)
+            curve.setPen(*color)
+            curve.setZValue(10)
+            self.vbLower.addItem(curve)
+            self.multipletItems.append(curve)
+
+        print '------\n multiplet fit, reduced chi2 = %.2f' % fit.chiSquare
+        for i in xrange(len(fit.centroids)):
+            peaktext = str('Area=%d(%d) \nE=%.1fkeV \nFWHM=%.2fkeV' % (
+                fit.areas[i], fit.areaErrors[i],
+                self.engine.calibrationY.energy(fit.centroids[i]),
+                fit.fwhms[i]*self.engine.calibrationY.slope(fit.centroids[i])))
+            print peaktext
+            label = pg.TextItem(
+                text = peaktext, color=(255, 255, 255), angle=0,
+                anchor=(0, 1))
+            label.setZValue(10)
+            label.setPos(fit.centroids[i], np.max(fit.peakSpectra[i]))
+            self.vbLower.addItem(label)
+            self.multipletItems.append(label)
+
+    # fits every peak found in lower spectrum, close peaks together
+    def fitAllPeaksFunct(self):
+        if len(self.peaksListLower) == 0:
+            print 'no peaks, run peak find on gated spectrum first'
+            return
+        if self.fitTable is None:
+            self.fitTable = fitTableWindow()
+        self.fitTable.clear()
+        self.fitTable.show()
+        self.fitTable.raise_()
+        self.fitAllWorker.fitAll(self.dataToPlot, self.peaksListLower)
+
+    def showFitAllResult(self, requestId, fit, error):
+        if self.fitAllWorker.isStale(requestId): #fit all started again
+            return
+        if error is None:
+            self.fitTable.addFit(fit, self.engine.calibrationY)
+        else:
+            self.fitTable.addError(error)
+
+    def fitAllDone(self, requestId):
+        if not self.fitAllWorker.isStale(requestId):
+            self.fitTable.showStatus(done=True)
+
+    def removeMultipletItems(self):
+        for item in self.multipletItems:
+            self.vbLower.removeItem(item)
+        self.multipletItems = []
+
+    ## prints fit result and puts it in label over the peak
+    def showFitResult(self, fit, labelName):
+        centroid1 = self.engine.calibrationY.energy(fit.centroid)
+        fwhm = fit.fwhm*self.engine.calibrationY.slope(fit.centroid)
+        peaktext = str('Area=%d \nE=%.1fkeV \nFWHM=%.2fkeV' 
+            % (fit.area, centroid1, fwhm))
+        print peaktext
+        top = self.dataToPlot[int(fit.centroid)]
+        position = fit.centroid
+        try:
+            fitLabel = getattr(self, labelName)
+            fitLabel.setText(peaktext)
+        except AttributeError:
+            fitLabel = pg.TextItem(
                 text = peaktext,
                 color=(255, 255, 255), angle=0,
-                anchor=(0,1))
-            top = self.dataToPlot[int(out[0][1])+ int(self.roiLimits[0])]
-            position = centroid1/self.energyCalibAxis
-            self.fitLabel2.setZValue(10)
-            self.vbLower.addItem(self.fitLabel2)
-            self.fitLabel2.setPos(position, top)
+                anchor=(0, 1))
+            fitLabel.setZValue(10)
+            self.vbLower.addItem(fitLabel)
+        fitLabel.setPos(position, top)
+        return fitLabel
 
     def areaUnderPeakFunct(self):
         print 'calc area'
@@ -1634,25 +2703,41 @@ class MainWindow(QtGui.QMainWindow):
         for roi in self.groupRoiList:
             roi.updateRoiLabel()
 
+    ## gate changed (roi moved, added, removed, new matrix), 
+    ## recompute once the refresh interval passes
+    def requestGateUpdate(self, *args):
+        self.gateDirty = True
+        self.gateResults = {}
+        if self.programRunning and not timer.isActive():
+            timer.start()
+
+    ## view range changed, roi labels must follow the top of the plot
+    def requestLabelUpdate(self, *args):
+        self.labelsDirty = True
+        if self.programRunning and not timer.isActive():
+            timer.start()
+
     def lowerPlotUpdate(self):
-        self.refreshAllLabels()
+        if self.gateDirty or self.labelsDirty:
+            self.refreshAllLabels()
+            self.labelsDirty = False
+        if not self.gateDirty:
+            return
+        self.gateDirty = False
+        if self.matrixMap is not None:
+            self.matrixMap.syncRois()
         try:
             if len(self.groupRoiList) == 0:
                 self.dataToPlot = self.caclGatedSpe()
             else:
                 self.dataToPlot = self.calcGatedSpeGroups()
-            self.lowerSpe.setData(
-                np.arange(0,len(self.dataToPlot)+1), 
-                self.dataToPlot)
+            self.lowerSpe.setSpectrum(self.dataToPlot)
+            #auto-peak find runs in background thread
+            if self.peakFindActive: 
+                self.peakFindLower()
         except:
             # does nothing
             0
-                                      
-        #auto-peak find disabled, too heavy for cpu
-        '''if self.peakFindActive: 
-            for label in self.peaksLabelsLower:
-                self.vbLower.removeItem(label)
-            threading.Thread(target=self.peakFindLower()).start()'''
                     
     def closeEvent(self, event):
         reply = QtGui.QMessageBox.question(
@@ -1661,6 +2746,10 @@ class MainWindow(QtGui.QMainWindow):
             QtGui.QMessageBox.No, QtGui.QMessageBox.No)
 
         if reply == QtGui.QMessageBox.Yes:
+            self.upperPeakWorker.stop()
+            self.lowerPeakWorker.stop()
+            self.fitAllWorker.stop()
+            self.stopLiveFunct()
             event.accept()
             print 'MakeMyGate: "bye, bye"'
         else:
@@ -1669,9 +2758,11 @@ class MainWindow(QtGui.QMainWindow):
           
 ### auto refreshing init
 def refreshInit():
+    # single shot timer merges bursts of gate changes into one update
+    timer.setSingleShot(True)
     timer.setInterval(window.refreshTime)
-    timer.timeout.connect(window.lowerPlotUpdate)    
-    timer.start()       
+    timer.timeout.connect(window.lowerPlotUpdate)
+    window.vbUpper.sigYRangeChanged.connect(window.requestLabelUpdate)
   
 def run():
     # PySide fix: Check if QApplication already exists. 
@@ -1685,9 +2776,14 @@ def run():
     app.exec_()
 
 if __name__ == "__main__":
+    #pool processes are forked here, before Qt starts its threads and
+    #display connection, never from running GUI
+    workerPool = multiprocessing.Pool()
     app = QtGui.QApplication(sys.argv)
     window = MainWindow()
     window.show()
     timer = QtCore.QTimer()
     refreshInit()
-    sys.exit(app.exec_())
+    exitCode = app.exec_()
+    workerPool.terminate()
+    sys.exit(exitCode)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+MakeMyGate batch gating: every matrix is gated with every roi list (.rl)
+and gated spectra are written without GUI.
+
+Example:
+    python MakeMyGate_batch.py -m run*.mat -r gates/*.rl -o spectra -j 8
+
+writes spectra/<matrix>_<roi list>.spe and .err (and .txt, err.txt
+with "-f spe txt"). Matrix format is taken from file extension
+(MakeMyGate_mattype.inp formats included) or given with -t.
+Matrices are memory mapped read-only, so all worker processes share
+the same pages of system file cache instead of copies of the matrix.
+Compressed matrices (.gz, .bz2, .xz) are decompressed, and 'sym' or
+'symmetrise' formats packed, into memory of every worker that gates
+them; each worker keeps at most two matrices open.
+Matrices or roi lists with the same file name in different
+directories would write the same spectra, such runs are refused.
+"""
+
+from __future__ import division
+from collections import OrderedDict
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+from MakeMyGate_engine import gatingEngine, readMattypeFile, \
+    readMatrixType, readRoiList, writeSpe, compression, matrixExtension, \
+    matrixFormatRegistry, matTypeSymmetry
+
+workerEngines = OrderedDict() #matrices open in this worker, newest last
+workerEngineCount = 2 #older ones are dropped, memory stays bounded
+
+def openMatrix(matrixFile, matType, transpose):
+    key = (matrixFile, transpose)
+    if key in workerEngines:
+        workerEngines[key] = workerEngines.pop(key) #now the newest
+    else:
+        while len(workerEngines) >= workerEngineCount:
+            workerEngines.popitem(last=False)
+        engine = gatingEngine()
+        engine.sparseThreshold = 0. #gates read only few pages, keep mmap
+        #'sym' and 'symmetrise' formats are packed while scanned, as in GUI
+        symmetry = matTypeSymmetry(matType)
+        engine.setMatrix(readMatrixType(matrixFile, matType),
+                         scanLater=(symmetry == 'auto'), symmetry=symmetry)
+        if transpose:
+            engine.transpose()
+        workerEngines[key] = engine
+    return workerEngines[key]
+
+## single job: one matrix gated with one roi list, run in worker process
+def gateJob(job):
+    matrixFile, matType, roiFile, outputBase, formats, transpose = job
+    try:
+        engine = openMatrix(matrixFile, matType, transpose)
+        engine.plusRois, engine.minusRois, engine.groupRois = \
+            readRoiList(roiFile)
+        gatedSpe, errSpe = engine.gate()[:2]
+        if 'spe' in formats:
+            writeSpe(outputBase + '.spe', gatedSpe)
+            writeSpe(outputBase + '.err', errSpe, outputBase + '.spe')
+        if 'txt' in formats:
+            np.savetxt(outputBase + '.txt', gatedSpe, fmt='%s')
+            np.savetxt(outputBase + 'err.txt', errSpe, fmt='%s')
+    except Exception as error:
+        return outputBase, str(error)
+    return outputBase, None
+
+def expandFiles(patterns): #globs are expanded here also on Windows
+    fileNames = []
+    for pattern in patterns:
+        fileNames.extend(sorted(glob.glob(pattern)) or [pattern])
+    return fileNames
+
+def findMatType(matrixFile, mattypeList, typeName=None):
+    extension = matrixExtension(matrixFile)
+    for matType in mattypeList:
+        if typeName is not None:
+            if typeName in (str(matType[0]), str(matType[1])):
+                return matType
+        elif str(matType[1]) == extension:
+            return matType
+    if typeName is None: #unknown extension, format from size and first KB
+        matType = matrixFormatRegistry(mattypeList).bestFormat(matrixFile)
+        if matType is not None:
+            return matType
+    raise ValueError('unknown matrix format of ' + matrixFile
+        + ', use -t with name or extension from MakeMyGate_mattype.inp')
+
+def createJobs(matrixFiles, roiFiles, outputDir, formats, typeName=None,
+               transpose=False):
+    mattypeList = readMattypeFile()
+    jobs = []
+    sources = {} #output base -> (matrix, roi list) writing it
+    for matrixFile in matrixFiles:
+        matType = findMatType(matrixFile, mattypeList, typeName)
+        matrixName = os.path.basename(matrixFile)
+        if compression(matrixName) is not None: #60Co.mat.gz -> 60Co
+            matrixName = os.path.splitext(matrixName)[0]
+        matrixName = os.path.splitext(matrixName)[0]
+        for roiFile in roiFiles:
+            roiName = os.path.splitext(os.path.basename(roiFile))[0]
+            outputBase = os.path.join(outputDir, matrixName + '_' + roiName)
+            if outputBase in sources:
+                raise ValueError('%s would be written for %s with %s and '
+                    'again for %s with %s, rename or run them apart'
+                    % ((outputBase,) + sources[outputBase]
+                       + (matrixFile, roiFile)))
+            sources[outputBase] = (matrixFile, roiFile)
+            jobs.append((matrixFile, matType, roiFile, outputBase, formats,
+                         transpose))
+    return jobs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Gate many matrices with many roi lists (.rl).')
+    parser.add_argument('-m', '--matrices', nargs='+', required=True,
+        help='matrix files')
+    parser.add_argument('-r', '--rois', nargs='+', required=True,
+        help='roi list files (.rl), as saved by MakeMyGate')
+    parser.add_argument('-o', '--output', default='.',
+        help='directory for gated spectra')
+    parser.add_argument('-t', '--type', default=None,
+        help='matrix format name or extension, default: from extension')
+    parser.add_argument('-f', '--formats', nargs='+', default=['spe'],
+        choices=['spe', 'txt'], help='output formats')
+    parser.add_argument('-j', '--jobs', type=int,
+        default=multiprocessing.cpu_count(), help='worker processes')
+    parser.add_argument('--transpose', action='store_true',
+        help='gate on the other matrix axis')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    try:
+        jobs = createJobs(
+            expandFiles(args.matrices), expandFiles(args.rois), args.output,
+            args.formats, args.type, args.transpose)
+    except ValueError as error:
+        parser.error(str(error))
+    print str(len(jobs)) + ' gates, ' + str(args.jobs) + ' processes'
+    start = time.time()
+    failed = 0
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        #jobs of one matrix are next to each other, so workers
+        #mostly reuse the matrix they already have opened
+        for outputBase, error in pool.imap_unordered(gateJob, jobs):
+            if error is None:
+                print 'saved ' + outputBase
+            else:
+                failed += 1
+                print 'failed ' + outputBase + ': ' + error
+    finally:
+        pool.close()
+        pool.join()
+    print 'done in %.1f s, %d failed' % (time.time() - start, failed)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2189 @@
+# -*- coding: utf-8 -*-
+"""
+MakeMyGate engine: matrix storage, gating, peak finding and fitting.
+
+Engine does not need Qt or display, so gates can be scripted,
+profiled or run in parallel on analysis nodes. MakeMyGate.py window
+is a view over gatingEngine object. ROIs are plain (start, end)
+pairs in channels, same as pyqtgraph LinearRegionItem.getRegion().
+
+Example:
+    from MakeMyGate_engine import gatingEngine
+    engine = gatingEngine()
+    engine.loadMatrix('60Co.mat', 4096, 4096)
+    engine.plusRois = [(2343, 2350)]
+    engine.minusRois = [(2360, 2375)]
+    gatedSpe, errSpe, suppresionFactors = engine.gate()
+    peaks = engine.findPeaks(gatedSpe)
+"""
+
+from __future__ import division
+import numpy as np
+import io
+import os
+import time
+import struct as sct
+import threading
+import zlib
+import bz2
+from collections import OrderedDict, deque
+from scipy import sparse
+from scipy.signal import find_peaks_cwt
+from scipy.ndimage import maximum_filter1d
+from scipy.optimize import leastsq
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None #.xz matrices need backports.lzma on python 2
+
+
+### known matrix formats: name, extension, X, Y, order, type, endian,
+### skip first bytes, skip last bytes. Extra formats are read from
+### MakeMyGate_mattype.inp, 9 lines per format
+basicMatType = [['2byte uint matrix','mat',4096,4096,'C','H','<',0,0],
+                ['4byte uint matrix','m4b',4096,4096,'C','I','<',0,0]]
+
+def readMattypeFile(fileName='MakeMyGate_mattype.inp'):
+    mattypeList = [list(matType) for matType in basicMatType]
+    try:
+        with open (fileName,'r') as f:
+            mattypeFile = np.loadtxt(f, dtype=str, delimiter='\n')
+        mattypeFile = np.array(mattypeFile).reshape(-1,9)
+        mattypeList.extend(mattypeFile.tolist())
+    except IOError:
+        print (
+        fileName + ' not found.\n'\
+        + 'Only basic type of matrices available.')
+    except ValueError:
+        print (
+        fileName + ' structure not matching required pattern.\n'
+        +' Only basic types of matrices available')
+    except:
+        print (
+        'unknown error occurred while trying\n'\
+        +'to load ' + fileName)
+    return mattypeList
+
+def readMatrixType(fileName, matType, memoryMapped=True): #matType as above
+    return readMatrixFile(
+        fileName, int(matType[2]), int(matType[3]),
+        str(matType[4]).split()[0], str(matType[5]), str(matType[6]),
+        int(matType[7]), int(matType[8]), memoryMapped)
+
+## order field of a format may be followed by 'sym' (file is symmetric,
+## e.g. 'C sym') or 'symmetrise' (raw matrix, summed with its transpose
+## while loading). Otherwise square matrices are checked on load
+def matTypeSymmetry(matType):
+    words = str(matType[4]).split()
+    if len(words) > 1 and words[1] == 'sym':
+        return 'symmetric'
+    if len(words) > 1 and words[1] == 'symmetrise':
+        return 'symmetrise'
+    return 'auto'
+
+### compressed matrix files (e.g. 60Co.mat.gz) are decompressed piece
+### by piece straight into matrix memory, never whole file at once
+compressedExtensions = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+def compression(fileName): #'gzip', 'bz2', 'xz' or None
+    return compressedExtensions.get(
+        os.path.splitext(str(fileName))[1].lower())
+
+def matrixExtension(fileName): #'mat' also for 60Co.mat.gz
+    if compression(fileName) is not None:
+        fileName = os.path.splitext(str(fileName))[0]
+    return os.path.splitext(str(fileName))[1][1:]
+
+class decompressedFile(object):
+    def __init__(self, fileName, chunkSize=2**16):
+        self.kind = compression(fileName)
+        if self.kind == 'xz' and lzma is None:
+            raise IOError('.xz matrix needs lzma module, '
+                          + 'e.g. pip install backports.lzma')
+        self.file = io.open(fileName, 'rb')
+        self.chunkSize = chunkSize #compressed bytes decompressed at once
+        self.pieces = self.decompressedPieces()
+        self.piece = b''
+        self.piecePosition = 0
+
+    def newDecompressor(self):
+        if self.kind == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.kind == 'bz2':
+            return bz2.BZ2Decompressor()
+        return lzma.LZMADecompressor()
+
+    ## pieces of at most chunkSize bytes. bz2 and lzma decompressors of
+    ## python 2 have no output limit, so after highly compressed data
+    ## they get less input at once (bz2 still gives whole block at once,
+    ## at most 900 kB, or tens of MB for long runs of one byte)
+    def decompressedPieces(self):
+        decompressor = self.newDecompressor()
+        inputSize = self.chunkSize #compressed bytes given at once
+        outputLimit = 16*self.chunkSize
+        while True:
+            data = self.file.read(inputSize)
+            if not data:
+                if self.kind == 'gzip':
+                    yield decompressor.flush()
+                return
+            while data:
+                if self.kind == 'gzip': #output limited, rest stays in tail
+                    piece = decompressor.decompress(data, outputLimit)
+                    data = decompressor.unconsumed_tail
+                else:
+                    piece = decompressor.decompress(data)
+                    data = b''
+                    if len(piece) > outputLimit:
+                        inputSize = max(
+                            inputSize*outputLimit//len(piece), 64)
+                    else:
+                        inputSize = min(2*inputSize, self.chunkSize)
+                for start in xrange(0, len(piece), self.chunkSize):
+                    yield piece[start:start + self.chunkSize]
+                if decompressor.unused_data: #next stream, e.g. pigz -i
+                    data = decompressor.unused_data + data
+                    decompressor = self.newDecompressor()
+
+    def readinto(self, block): #block: contiguous numpy array
+        target = block.reshape(-1).view(np.uint8)
+        filled = 0
+        while filled < len(target):
+            if self.piecePosition >= len(self.piece):
+                self.piece = next(self.pieces, None)
+                self.piecePosition = 0
+                if self.piece is None: #end of file
+                    self.piece = b''
+                    break
+                continue
+            count = min(len(target) - filled,
+                        len(self.piece) - self.piecePosition)
+            target[filled:filled + count] = np.frombuffer(
+                self.piece, np.uint8, count, self.piecePosition)
+            filled += count
+            self.piecePosition += count
+        return filled
+
+    def seek(self, offset): #only forward from start, skips header bytes
+        skipped = np.empty(min(offset, 2**20), dtype=np.uint8)
+        while offset > 0:
+            offset -= self.readinto(skipped[:offset])
+            if not self.piece and offset > 0:
+                raise ValueError('compressed file shorter than header')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def openMatrixStream(fileName, chunkSize=2**16): #for readinto
+    if compression(fileName) is not None:
+        return decompressedFile(fileName, chunkSize)
+    return io.open(fileName, 'rb')
+
+### matrix format detection from file size and first few KB only.
+### Registry starts with basicMatType and MakeMyGate_mattype.inp formats,
+### square matrices of common cell types are tried too
+def readFileSample(fileName, sampleSize=4096): #decompressed if needed
+    sample = np.zeros(sampleSize, dtype=np.uint8)
+    #compressed file is read in small steps, only until sample is full
+    with openMatrixStream(fileName, min(sampleSize, 2**16)//4) as f:
+        count = f.readinto(sample)
+    return sample[:count]
+
+def matrixDataSize(fileName): #bytes after decompression, None if unknown
+    kind = compression(fileName)
+    if kind is None:
+        return os.path.getsize(fileName)
+    if kind == 'gzip': #size modulo 2**32 is stored in last 4 bytes
+        with io.open(fileName, 'rb') as f:
+            f.seek(-4, 2)
+            return sct.unpack('<I', f.read(4))[0]
+    return None
+
+def isTextSample(sample): #no zero bytes, almost only printable ascii
+    if len(sample) == 0 or np.any(sample == 0):
+        return False
+    printable = (sample >= 32) & (sample < 127) | np.in1d(sample, (9,10,13))
+    return np.mean(printable) > 0.95
+
+def sampleValues(sample, dataType, dataEndian, skipFirstBytes=0):
+    dataFormat = np.dtype(dataEndian + dataType)
+    cells = sample[skipFirstBytes:]
+    cells = cells[:len(cells)//dataFormat.itemsize*dataFormat.itemsize]
+    return np.frombuffer(cells.tostring(), dtype=dataFormat)
+
+## fraction of sample cells which look like matrix counts
+def countsLikeness(sample, dataType, dataEndian, skipFirstBytes=0):
+    values = sampleValues(sample, dataType, dataEndian, skipFirstBytes)
+    if len(values) == 0:
+        return 0.
+    if values.dtype.kind == 'f':
+        with np.errstate(invalid='ignore', over='ignore'):
+            magnitude = np.abs(values.astype(np.float64))
+            plausible = np.isfinite(magnitude) & ((magnitude == 0)
+                | ((magnitude > 1e-6) & (magnitude < 1e9)))
+        return np.mean(plausible)
+    #small counts with empty low byte are float or swapped bits
+    values = values.astype(np.uint64)
+    return np.mean((values < 2**24) & ((values == 0) | (values & 255 > 0)))
+
+## mean log of counts, right reading gives the smallest when tied
+def countsMagnitude(sample, dataType, dataEndian, skipFirstBytes=0):
+    values = sampleValues(sample, dataType, dataEndian, skipFirstBytes)
+    with np.errstate(invalid='ignore', over='ignore'):
+        magnitude = np.log1p(np.abs(values.astype(np.float64)))
+    magnitude = magnitude[np.isfinite(magnitude)]
+    return np.mean(magnitude) if len(magnitude) else np.inf
+
+class matrixFormatRegistry(object):
+    def __init__(self, mattypeList=None):
+        if mattypeList is None:
+            mattypeList = readMattypeFile()
+        self.formats = [list(matType) for matType in mattypeList]
+        self.squareTypes = ['H', 'I', 'f'] #cell types of guessed matrices
+
+    def register(self, matType):
+        self.formats.append(list(matType))
+
+    ## formats matching the file, best first, as (score, matType)
+    def detect(self, fileName, sampleSize=4096):
+        sample = readFileSample(fileName, sampleSize)
+        if isTextSample(sample):
+            return []
+        dataSize = matrixDataSize(fileName)
+        extension = matrixExtension(fileName)
+        candidates = []
+        for matType in self.formats:
+            itemSize = np.dtype(str(matType[5])).itemsize
+            expected = int(matType[2])*int(matType[3])*itemSize \
+                + int(matType[7]) + int(matType[8])
+            sizeMatches = dataSize is not None and \
+                expected % 2**32 == dataSize % 2**32 #gzip size wraps
+            extensionMatches = str(matType[1]) == extension
+            if not (sizeMatches or extensionMatches and dataSize is None):
+                continue
+            cellFormat = (sample, str(matType[5]), str(matType[6]),
+                int(matType[7]))
+            score = 3*sizeMatches + 2*extensionMatches \
+                + countsLikeness(*cellFormat)
+            candidates.append((score, countsMagnitude(*cellFormat),
+                list(matType)))
+        if dataSize is not None and not candidates:
+            for dataType in self.squareTypes:
+                itemSize = np.dtype(dataType).itemsize
+                side = int(round(np.sqrt(dataSize//itemSize)))
+                if side*side*itemSize != dataSize:
+                    continue
+                #the endian giving plausible counts wins
+                endians = sorted('<>', key=lambda endian: (
+                    -countsLikeness(sample, dataType, endian),
+                    countsMagnitude(sample, dataType, endian)))
+                cellFormat = (sample, dataType, endians[0])
+                candidates.append((1 + countsLikeness(*cellFormat),
+                    countsMagnitude(*cellFormat), [
+                    'detected %dx%d %s' % (side, side, dataType), extension,
+                    side, side, 'C', dataType, endians[0], 0, 0]))
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        return [(score, matType) for score, magnitude, matType in candidates]
+
+    def bestFormat(self, fileName): #matType or None
+        candidates = self.detect(fileName)
+        if not candidates:
+            return None
+        return candidates[0][1]
+
+def matrixFileFormat(fileName, sizeX, sizeY, dataType, dataEndian,
+                     skipFirstBytes, skipLastBytes): #checks file size
+    dataFormat = np.dtype(dataEndian + dataType)
+    if compression(fileName) is not None: #size known after reading
+        return dataFormat
+    cellCount = (os.path.getsize(fileName) - skipFirstBytes
+        - skipLastBytes)//dataFormat.itemsize
+    if cellCount < sizeX*sizeY:
+        raise ValueError(
+            str(fileName) + ' too small for ' + str(sizeX) + 'x'
+            + str(sizeY) + ' ' + dataFormat.str + ' matrix')
+    return dataFormat
+
+### reading matrix from binary file
+def readMatrixFile(fileName, sizeX, sizeY, dataOrder='C', dataType='H',
+                   dataEndian='<', skipFirstBytes=0, skipLastBytes=0,
+                   memoryMapped=True):
+    # memory mapped matrix is not read at once,
+    # pages are loaded from disk when gate or projection touches them
+    dataFormat = matrixFileFormat(fileName, sizeX, sizeY, dataType,
+                                  dataEndian, skipFirstBytes, skipLastBytes)
+    if compression(fileName) is not None: #no memory map of compressed
+        matrix = np.empty((sizeX, sizeY), dtype=dataFormat, order=dataOrder)
+        stored = matrix.T if dataOrder == 'F' else matrix
+        with decompressedFile(fileName) as f:
+            f.seek(skipFirstBytes)
+            if f.readinto(stored) < stored.nbytes:
+                raise ValueError(str(fileName) + ' too small for '
+                    + str(sizeX) + 'x' + str(sizeY) + ' matrix')
+        return matrix
+    if memoryMapped:
+        return np.memmap(
+            fileName, dtype=dataFormat, mode='r', offset=skipFirstBytes,
+            shape=(sizeX, sizeY), order=dataOrder)
+    with open(fileName, 'rb') as f:
+        f.seek(skipFirstBytes)
+        matrix = np.fromfile(f, dtype=dataFormat, count=sizeX*sizeY)
+    return matrix.reshape((sizeX, sizeY), order=dataOrder)
+
+### sparse (compressed sparse column) storage of low occupancy matrices
+def toSparseMatrix(matrix, blockSize=256):
+    blocks = [sparse.csr_matrix(np.asarray(matrix[first:first + blockSize]))
+              for first in xrange(0, matrix.shape[0], blockSize)]
+    return sparse.vstack(blocks, format='csc')
+
+## gate columns a..b-1 clipped to 0..length, the same for every storage
+def clipColumns(a, b, length):
+    a = min(max(int(a), 0), length)
+    return a, min(max(int(b), a), length)
+
+def sliceSparseMatrix(matrix, a, b): #sum of csc columns a..b-1
+    a, b = clipColumns(a, b, matrix.shape[1])
+    first, last = matrix.indptr[a], matrix.indptr[b]
+    return np.bincount(
+        matrix.indices[first:last], weights=matrix.data[first:last],
+        minlength=matrix.shape[0])
+
+def matrixProjections(matrix): #works for dense and sparse matrices
+    return (np.asarray(matrix.sum(axis = 0)).ravel(),
+            np.asarray(matrix.sum(axis = 1)).ravel())
+
+## sizes of dense and sparse storage of matrix and timings of its
+## stored form. Nonzero cells are counted block by block, no copy of
+## matrix in other storage is made
+def storageReport(matrix, gateCount=200, gateWidth=10, blockSize=256):
+    sizeY, sizeX = matrix.shape
+    if sparse.issparse(matrix):
+        nonZero = matrix.nnz
+    else:
+        nonZero = sum(np.count_nonzero(np.asarray(matrix[first:first
+            + blockSize])) for first in xrange(0, sizeY, blockSize))
+    itemSize = matrix.dtype.itemsize
+    indexSize = 4 if nonZero < 2**31 else 8 #scipy index type
+    sizes = {'dense': sizeX*sizeY*itemSize,
+             'sparse': nonZero*(itemSize + indexSize)
+                 + (sizeX + 1)*indexSize}
+    if sparse.issparse(matrix):
+        stored = 'sparse'
+        sliceGate = lambda a, b: sliceSparseMatrix(matrix, a, b)
+        projections = lambda: matrixProjections(matrix)
+    elif isinstance(matrix, packedSymmetricMatrix):
+        stored = 'packed'
+        sizes['packed'] = matrix.nbytes
+        sliceGate = matrix.sliceColumns
+        projections = matrix.projections
+    else:
+        stored = 'dense'
+        sliceGate = lambda a, b: np.sum(matrix[:,a:b], axis = 1)
+        projections = lambda: matrixProjections(matrix)
+    gates = np.random.randint(0, max(1, sizeX - gateWidth), gateCount)
+    start = time.time()
+    for a in gates:
+        sliceGate(a, a + gateWidth)
+    gateTime = time.time() - start
+    start = time.time()
+    projections()
+    projectionTime = time.time() - start
+    lines = ['matrix ' + str(sizeY) + 'x' + str(sizeX)
+             + ', occupancy %.2f%%' % (100.*nonZero/max(sizeX*sizeY, 1))]
+    for storage in ('dense', 'sparse', 'packed'):
+        if storage not in sizes:
+            continue
+        line = '%-7s %.1f MB' % (storage + ':', sizes[storage]/2.**20)
+        if storage == stored:
+            line += ', %d gates (width %d) in %.3f s, projections %.3f s' \
+                % (gateCount, gateWidth, gateTime, projectionTime)
+        else:
+            line += ' (not stored, size only)'
+        lines.append(line)
+    return '\n'.join(lines)
+
+### symmetric matrix stored as packed upper triangle, row by row:
+### row r holds columns r..n-1. Slicing gives dense blocks of the full
+### matrix, so gates, gate index and 2D view work as for ndarray
+class packedSymmetricMatrix(object):
+    def __init__(self, packed, size):
+        self.packed = packed
+        self.shape = (size, size)
+        self.dtype = packed.dtype
+        self.ndim = 2
+        rows = np.arange(size + 1, dtype=np.int64)
+        self.offsets = rows*size - rows*(rows - 1)//2 #row starts
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    @property
+    def T(self): #transposition does nothing
+        return self
+
+    def transpose(self):
+        return self
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        size = self.shape[0]
+        if not all(isinstance(index, slice) for index in key):
+            raise IndexError('packed matrix supports only slices')
+        rowStart, rowStop, rowStep = key[0].indices(size)
+        columnStart, columnStop, columnStep = key[1].indices(size)
+        if rowStep != 1 or columnStep != 1:
+            raise IndexError('packed matrix supports only plain slices')
+        rows = np.arange(rowStart, max(rowStop, rowStart))[:,None]
+        columns = np.arange(columnStart, max(columnStop, columnStart))
+        #element (r, c) is at row min(r, c), column max(r, c)
+        return self.packed[self.offsets[np.minimum(rows, columns)]
+                           + np.abs(rows - columns)]
+
+    @property
+    def sumType(self): #fractional counts are not truncated
+        return np.float64 if self.dtype.kind == 'f' else np.int64
+
+    def sliceColumns(self, a, b, blockSize=64): #sum of columns a..b-1
+        a, b = clipColumns(a, b, self.shape[1])
+        gated = np.zeros(self.shape[0], dtype=self.sumType)
+        for first in xrange(a, b, blockSize):
+            gated += np.sum(self[:, first:min(first + blockSize, b)],
+                            axis=1, dtype=self.sumType)
+        return gated
+
+    def projections(self, blockSize=2**22): #row sums, same as column sums
+        size = self.shape[0]
+        rowSums = np.add.reduceat(
+            self.packed, self.offsets[:-1], dtype=self.sumType)
+        #sums of upper triangle columns, blockwise over packed rows
+        columnSums = np.zeros(size, dtype=self.sumType)
+        first = 0
+        while first < size:
+            last = max(np.searchsorted(
+                self.offsets, self.offsets[first] + blockSize), first + 1)
+            last = min(last, size)
+            rows = np.arange(first, last)
+            lengths = size - rows
+            columns = np.arange(self.offsets[last] - self.offsets[first]) \
+                - np.repeat(self.offsets[first:last] - rows, lengths) \
+                + self.offsets[first]
+            columnSums += np.bincount(columns, minlength=size,
+                weights=self.packed[self.offsets[first]:self.offsets[last]]
+                ).astype(self.sumType)
+            first = last
+        diagonal = self.packed[self.offsets[:-1]].astype(self.sumType)
+        projection = rowSums + columnSums - diagonal
+        return projection, projection.copy()
+
+## packs square matrix in one pass over row blocks.
+## symmetry: 'auto' - checked, None is returned for asymmetric matrix,
+## 'symmetric' - lower triangle is not read,
+## 'symmetrise' - matrix + transposed matrix (raw matrices)
+def packSymmetric(matrix, symmetry='auto', blockSize=256, isCanceled=None,
+                  progress=None):
+    size = matrix.shape[0]
+    if matrix.ndim != 2 or matrix.shape[1] != size:
+        return None
+    if symmetry == 'auto': #few random pairs first, reject early
+        sample = np.random.randint(0, size, (2, 4096))
+        if np.any(matrix[sample[0], sample[1]]
+                  != matrix[sample[1], sample[0]]):
+            return None
+    dtype = matrix.dtype
+    if symmetry == 'symmetrise' and dtype.kind in 'ui': #sums need room
+        dtype = np.result_type(dtype, np.uint32)
+    result = packedSymmetricMatrix(
+        np.zeros(size*(size + 1)//2, dtype=dtype), size)
+    packed, offsets = result.packed, result.offsets
+    columns = np.arange(size)
+    for first in xrange(0, size, blockSize):
+        if isCanceled is not None and isCanceled():
+            return None
+        block = np.asarray(matrix[first:first + blockSize])
+        rows = np.arange(first, first + len(block))[:,None]
+        #upper triangle of block rows is contiguous part of packed
+        packed[offsets[first]:offsets[first + len(block)]] = \
+            block[columns >= rows]
+        if progress is not None:
+            progress(first + len(block), size, None)
+        if symmetry == 'symmetric':
+            continue
+        lower = columns <= rows #diagonal too, symmetrised one is doubled
+        if symmetry == 'auto':
+            lower[:, first:] = columns[first:] < rows
+        lowerRows, lowerColumns = np.nonzero(lower)
+        lowerRows += first
+        mirrored = offsets[lowerColumns] + lowerRows - lowerColumns
+        if symmetry == 'symmetrise':
+            packed[mirrored] += block[lower]
+        elif np.any(packed[mirrored] != block[lower]):
+            return None
+    return result
+
+### one pass over (memory mapped) matrix: both projections, and sparse
+### form of the matrix while its occupancy stays below sparseThreshold.
+### Symmetric matrix (see packSymmetric) is packed instead.
+### isCanceled() is checked between blocks, scan returns None if true.
+### progress(rows done, rows, projection X so far or None) is called
+### after every block. readBlock(first, last) gives rows of matrix in
+### storage order, when they are not read just by slicing (see below)
+def scanMatrix(matrix, sparseThreshold=0., blockSize=256, isCanceled=None,
+               symmetry='off', progress=None, readBlock=None):
+    if symmetry != 'off':
+        packed = packSymmetric(
+            matrix, symmetry, blockSize, isCanceled, progress)
+        if isCanceled is not None and isCanceled():
+            return None
+        if packed is not None:
+            return packed.projections() + (packed,)
+    scanned = matrix
+    if matrix.flags.f_contiguous and not matrix.flags.c_contiguous:
+        scanned = matrix.T #walk the file in storage order
+    projectionX = np.zeros(scanned.shape[1], dtype=np.int64)
+    projectionY = np.zeros(scanned.shape[0], dtype=np.int64)
+    sparseBlocks = []
+    maxNonZero = sparseThreshold*scanned.size
+    nonZero = 0
+    for first in xrange(0, scanned.shape[0], blockSize):
+        if isCanceled is not None and isCanceled():
+            return None
+        last = min(first + blockSize, scanned.shape[0])
+        if readBlock is None:
+            block = np.asarray(scanned[first:last])
+        else:
+            block = readBlock(first, last)
+        projectionX += np.sum(block, axis = 0, dtype=np.int64)
+        projectionY[first:last] = np.sum(block, axis = 1, dtype=np.int64)
+        if progress is not None: #projection X of matrix, not of scanned
+            progress(last, scanned.shape[0],
+                     projectionX if scanned is matrix else projectionY)
+        if sparseBlocks is not None:
+            sparseBlocks.append(sparse.csr_matrix(block))
+            nonZero += sparseBlocks[-1].nnz
+            if nonZero >= maxNonZero: #too dense, keep memory map
+                sparseBlocks = None
+    sparseMatrix = None
+    if sparseBlocks:
+        sparseMatrix = sparse.vstack(sparseBlocks, format='csr')
+    if scanned is not matrix:
+        projectionX, projectionY = projectionY, projectionX
+        if sparseMatrix is not None:
+            sparseMatrix = sparseMatrix.T #csr transposed is csc
+    elif sparseMatrix is not None:
+        sparseMatrix = sparseMatrix.tocsc()
+    return projectionX, projectionY, sparseMatrix
+
+## matrix file read into memory block by block, projections (and sparse
+## or packed form) are summed from each block while it is fresh, so the
+## file is read once. Returns matrix and scan result (as scanMatrix) or
+## None if canceled
+def streamMatrixFile(fileName, sizeX, sizeY, dataOrder='C', dataType='H',
+                     dataEndian='<', skipFirstBytes=0, skipLastBytes=0,
+                     sparseThreshold=0., symmetry='off', blockSize=256,
+                     isCanceled=None, progress=None):
+    dataFormat = matrixFileFormat(fileName, sizeX, sizeY, dataType,
+                                  dataEndian, skipFirstBytes, skipLastBytes)
+    matrix = np.empty((sizeX, sizeY), dtype=dataFormat, order=dataOrder)
+    stored = matrix.T if dataOrder == 'F' else matrix #rows as in file
+    with openMatrixStream(fileName) as f:
+        f.seek(skipFirstBytes)
+        def readBlock(first, last):
+            if f.readinto(stored[first:last]) < stored[first:last].nbytes:
+                raise ValueError(str(fileName) + ' too small for '
+                    + str(sizeX) + 'x' + str(sizeY) + ' matrix')
+            return stored[first:last]
+        scanResult = scanMatrix(matrix, sparseThreshold, blockSize,
+            isCanceled, progress=progress, readBlock=readBlock)
+    if scanResult is None:
+        return None
+    if symmetry != 'off': #in memory now, no second read of file
+        packed = packSymmetric(matrix, symmetry, blockSize, isCanceled)
+        if isCanceled is not None and isCanceled():
+            return None
+        if packed is not None:
+            return matrix, packed.projections() + (packed,)
+    return matrix, scanResult
+
+### text matrix: dense grid (matrix row per line, values separated by
+### spaces, tabs, commas or semicolons) or sparse "x y count" lines.
+### Blocks of whole lines are converted by numpy, header lines (comments,
+### column names) before the first number line are skipped
+def isNumberLine(line):
+    fields = line.replace(',', ' ').replace(';', ' ').split()
+    try:
+        return len([float(field) for field in fields]) > 0
+    except ValueError:
+        return False
+
+## first line of text (counted from firstLine) without width numbers
+def badTextLine(text, width, firstLine):
+    for number, line in enumerate(text.split('\n'), firstLine):
+        fields = line.replace(',', ' ').replace(';', ' ').split()
+        if fields and (len(fields) != width or not isNumberLine(line)):
+            return number, line
+    return None
+
+def textMatrixBlocks(fileName, chunkSize=2**22, isCanceled=None,
+                     progress=None):
+    dataSize = matrixDataSize(fileName)
+    buffer = np.empty(chunkSize, dtype=np.uint8)
+    rest, width, done = '', None, 0
+    lineNumber = 1 #of first line in text, for errors
+    with openMatrixStream(fileName) as f:
+        while isCanceled is None or not isCanceled():
+            count = f.readinto(buffer)
+            done += count
+            text = rest + buffer[:count].tostring()
+            cut = text.rfind('\n') + 1 if count else len(text)
+            text, rest = text[:cut], text[cut:]
+            while width is None and text: #header lines
+                line, _, text = text.partition('\n')
+                if isNumberLine(line):
+                    width = len(line.replace(',', ' ').replace(';', ' ')
+                        .split())
+                    text = line + '\n' + text
+                else:
+                    lineNumber += 1
+            if text:
+                values = np.fromstring(
+                    text.replace(',', ' ').replace(';', ' '), sep=' ')
+                lineCount = text.count('\n') + (text[-1] != '\n')
+                #every line must hold width values, lines are checked one
+                #by one only if count differs (blank lines, bad lines)
+                if len(values) != lineCount*width:
+                    bad = badTextLine(text, width, lineNumber)
+                    if bad is not None:
+                        raise ValueError('%s line %d: %r is not a row of %d'
+                            ' numbers' % (fileName, bad[0], bad[1], width))
+                    if len(values) % width:
+                        raise ValueError(str(fileName)
+                            + ': not numeric values in text matrix')
+                lineNumber += lineCount
+                yield values.reshape(-1, width)
+            if progress is not None and dataSize:
+                progress(min(done, dataSize), dataSize, None)
+            if not count:
+                return
+
+def isCountsBlock(values): #fits uint32 matrix
+    return len(values) == 0 or (values.min() >= 0 and values.max() < 2**32
+        and np.all(values == np.floor(values)))
+
+## layout: 'dense', 'sparse' or 'auto' (sparse for 3 column files),
+## sizes of 0 are taken from file. Returns matrix or None if canceled
+def readTextMatrix(fileName, sizeX=0, sizeY=0, layout='auto',
+                   chunkSize=2**22, isCanceled=None, progress=None):
+    blocks = textMatrixBlocks(fileName, chunkSize, isCanceled, progress)
+    matrix, filled, triplets = None, 0, []
+    for block in blocks:
+        if layout == 'auto':
+            layout = 'sparse' if block.shape[1] == 3 else 'dense'
+        if layout == 'sparse':
+            if block.shape[1] != 3:
+                raise ValueError(str(fileName) + ': not "x y count" lines')
+            triplets.append(block)
+            continue
+        if matrix is None: #rows from size of file if not given
+            if sizeY and block.shape[1] != sizeY:
+                raise ValueError(str(fileName) + ': ' + str(block.shape[1])
+                    + ' columns, expected ' + str(sizeY))
+            rows = sizeX or max(len(block), int(1.1*len(block)
+                *(matrixDataSize(fileName) or 0)/chunkSize) + 1)
+            matrix = np.zeros((rows, block.shape[1]), dtype=np.uint32)
+        if matrix.dtype.kind == 'u' and not isCountsBlock(block):
+            matrix = matrix.astype(np.float64)
+        if filled + len(block) > len(matrix):
+            if sizeX:
+                raise ValueError(str(fileName) + ': more than '
+                    + str(sizeX) + ' rows')
+            grown = np.zeros((2*(filled + len(block)), matrix.shape[1]),
+                dtype=matrix.dtype)
+            grown[:filled] = matrix[:filled]
+            matrix = grown
+        matrix[filled:filled + len(block)] = block
+        filled += len(block)
+    if isCanceled is not None and isCanceled():
+        return None
+    if layout != 'sparse':
+        if matrix is None:
+            raise ValueError(str(fileName) + ': no numbers in text matrix')
+        return matrix if sizeX else matrix[:filled].copy()
+    if not triplets:
+        raise ValueError(str(fileName) + ': no numbers in text matrix')
+    triplets = np.vstack(triplets)
+    x, y = triplets[:,0].astype(np.int64), triplets[:,1].astype(np.int64)
+    shape = (sizeX or x.max() + 1, sizeY or y.max() + 1)
+    if x.min() < 0 or y.min() < 0 or x.max() >= shape[0] \
+            or y.max() >= shape[1]:
+        raise ValueError(str(fileName) + ': channel outside of '
+            + str(shape[0]) + 'x' + str(shape[1]) + ' matrix')
+    counts = triplets[:,2]
+    if isCountsBlock(counts):
+        counts = counts.astype(np.uint32)
+    return sparse.coo_matrix((counts, (x, y)), shape=shape).toarray()
+
+### live acquisition: changed cells of matrix file against matrix in
+### memory (with file orientation), compared block by block. Events from
+### socket are (x, y, count) little endian uint32 triplets
+liveEventFormat = np.dtype('<u4')
+
+def matrixFileDelta(matrix, fileArgs, blockSize=256): #rows, columns, counts
+    (fileName, sizeX, sizeY, dataOrder, dataType, dataEndian,
+     skipFirstBytes, skipLastBytes) = fileArgs
+    dataFormat = matrixFileFormat(fileName, sizeX, sizeY, dataType,
+                                  dataEndian, skipFirstBytes, skipLastBytes)
+    stored = matrix.T if dataOrder == 'F' else matrix #rows as in file
+    deltaType = np.float64 if matrix.dtype.kind == 'f' else np.int64
+    block = np.empty((blockSize, stored.shape[1]), dtype=dataFormat)
+    rows, columns, counts = [], [], []
+    with openMatrixStream(fileName) as f:
+        f.seek(skipFirstBytes)
+        for first in xrange(0, stored.shape[0], blockSize):
+            fileRows = block[:min(blockSize, stored.shape[0] - first)]
+            if f.readinto(fileRows) < fileRows.nbytes:
+                raise ValueError(str(fileName) + ' too small for '
+                    + str(sizeX) + 'x' + str(sizeY) + ' matrix')
+            delta = fileRows.astype(deltaType) \
+                - stored[first:first + len(fileRows)]
+            changedRows, changedColumns = np.nonzero(delta)
+            rows.append(changedRows + first)
+            columns.append(changedColumns)
+            counts.append(delta[changedRows, changedColumns])
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    if dataOrder == 'F':
+        rows, columns = columns, rows
+    return rows, columns, np.concatenate(counts)
+
+## 'symmetrise' formats: file holds raw matrix, engine holds m + m.T.
+## Delta is taken against raw snapshot of file (updated here) and every
+## change is added at (x, y) and (y, x), diagonal twice as when loaded
+def symmetrisedFileDelta(rawMatrix, fileArgs, blockSize=256):
+    rows, columns, counts = matrixFileDelta(rawMatrix, fileArgs, blockSize)
+    rawMatrix[rows, columns] += counts.astype(rawMatrix.dtype)
+    return (np.concatenate((rows, columns)),
+            np.concatenate((columns, rows)), np.concatenate((counts, counts)))
+
+def parseEvents(data): #triplets from received bytes, and bytes left
+    tripletSize = 3*liveEventFormat.itemsize
+    used = len(data)//tripletSize*tripletSize
+    events = np.frombuffer(data[:used], dtype=liveEventFormat)
+    return events.reshape(-1, 3), data[used:]
+
+### list-mode data: fixed size events of eventLength channels (one per
+### detector), every pair of channels in event is one count of size x size
+### matrix (both orders if symmetrised). Gains, coefficients a0, a1, ...
+### for every detector (or one for all), calibrate dithered channels.
+### Plain files are split into ranges for pool processes, compressed
+### ones are read in this process
+def applyGains(channels, gains, random):
+    values = channels + random.random_sample(channels.shape)
+    calibrated = np.zeros(values.shape)
+    for position in xrange(channels.shape[1]): #Horner scheme
+        for coefficient in reversed(gains[position % len(gains)]):
+            calibrated[:,position] *= values[:,position]
+            calibrated[:,position] += coefficient
+    return np.floor(calibrated)
+
+def histogramEvents(events, matrix, gains=None, symmetrise=False, seed=0):
+    size = matrix.shape[0]
+    if gains:
+        channels = applyGains(events, gains, np.random.RandomState(seed))
+    else:
+        channels = events.astype(np.int64)
+    cells = []
+    for first in xrange(events.shape[1]):
+        for second in xrange(first + 1, events.shape[1]):
+            x, y = channels[:,first], channels[:,second]
+            inside = (x >= 0) & (x < size) & (y >= 0) & (y < size)
+            x, y = x[inside].astype(np.int64), y[inside].astype(np.int64)
+            cells.append(x*size + y)
+            if symmetrise:
+                cells.append(y*size + x)
+    if not cells:
+        return
+    #only touched cells are added, temporary memory scales with events
+    cells, counts = np.unique(np.concatenate(cells), return_counts=True)
+    flat = matrix.reshape(-1)
+    flat[cells] += counts.astype(matrix.dtype)
+
+## events read from f are given to histogram(events, seed), all of them
+## if eventCount is None. Returns events read, None if canceled
+def histogramStream(f, histogram, eventLength, dataFormat, eventCount=None,
+                    chunkEvents=2**22, seed=0, isCanceled=None,
+                    progress=None):
+    events = np.empty((chunkEvents, eventLength), dtype=dataFormat)
+    done = 0
+    while eventCount is None or done < eventCount:
+        if isCanceled is not None and isCanceled():
+            return None
+        chunk = events if eventCount is None \
+            else events[:min(chunkEvents, eventCount - done)]
+        count = f.readinto(chunk)//(eventLength*dataFormat.itemsize)
+        histogram(chunk[:count], (seed + done) % 2**32)
+        done += count
+        if progress is not None and eventCount is not None:
+            progress(done, eventCount, None)
+        if count < len(chunk): #end of file
+            break
+    return done
+
+def histogramListModeRange(job): #module level, so pool processes can run it
+    (fileName, eventLength, dataFormat, firstEvent, eventCount, skipFirstBytes,
+     size, gains, symmetrise, chunkEvents) = job
+    matrix = np.zeros((size, size), dtype=np.uint32)
+    with io.open(fileName, 'rb') as f:
+        f.seek(skipFirstBytes + firstEvent*eventLength*dataFormat.itemsize)
+        done = histogramStream(f, lambda events, seed: histogramEvents(
+            events, matrix, gains, symmetrise, seed), eventLength,
+            dataFormat, eventCount, chunkEvents, firstEvent)
+    #sparse ranges go back to main process as cells and counts
+    cells = np.flatnonzero(matrix)
+    if len(cells)*(cells.itemsize + matrix.itemsize) < matrix.nbytes:
+        return done, (cells, matrix.reshape(-1)[cells])
+    return done, matrix
+
+## results of function(job) from pool in order of jobs. At most ahead
+## jobs are queued, so a shared pool is free soon after caller stops
+def poolResults(pool, function, jobs, ahead=8):
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+## size x size uint32 matrix from list-mode file, None if canceled.
+## With pool, ranges of rangeEvents events are histogrammed in parallel
+def histogramListMode(fileName, eventLength=2, size=4096, dataType='H',
+                      dataEndian='<', skipFirstBytes=0, gains=None,
+                      symmetrise=False, pool=None, chunkEvents=2**22,
+                      rangeEvents=2**25, isCanceled=None, progress=None):
+    dataFormat = np.dtype(dataEndian + dataType)
+    matrix = np.zeros((size, size), dtype=np.uint32)
+    if compression(fileName) is not None: #no seeking in compressed file
+        with openMatrixStream(fileName) as f:
+            f.seek(skipFirstBytes)
+            if histogramStream(f, lambda events, seed: histogramEvents(
+                    events, matrix, gains, symmetrise, seed), eventLength,
+                    dataFormat, None, chunkEvents,
+                    isCanceled=isCanceled) is None:
+                return None
+        return matrix
+    eventBytes = eventLength*dataFormat.itemsize
+    eventCount = (os.path.getsize(fileName) - skipFirstBytes)//eventBytes
+    jobs = [(fileName, eventLength, dataFormat, first,
+             min(rangeEvents, eventCount - first), skipFirstBytes, size,
+             gains, symmetrise, chunkEvents)
+            for first in xrange(0, eventCount, rangeEvents)]
+    if pool is not None:
+        results = poolResults(pool, histogramListModeRange, jobs)
+    else:
+        results = (histogramListModeRange(job) for job in jobs)
+    done = 0
+    flat = matrix.reshape(-1)
+    for count, rangeMatrix in results:
+        if isinstance(rangeMatrix, tuple): #(cells, counts)
+            flat[rangeMatrix[0]] += rangeMatrix[1]
+        else:
+            matrix += rangeMatrix
+        done += count
+        if progress is not None:
+            progress(done, eventCount, None)
+        if isCanceled is not None and isCanceled():
+            return None
+    return matrix
+
+## matrix written row blocks at a time, counts over the largest
+## value of integer cell type are clipped
+def writeMatrixFile(fileName, matrix, dataType='H', dataEndian='<',
+                    blockSize=256):
+    dataFormat = np.dtype(dataEndian + dataType)
+    maxCount = np.iinfo(dataFormat).max if dataFormat.kind in 'ui' else None
+    clipped = 0
+    with open(fileName, 'wb') as f:
+        for first in xrange(0, matrix.shape[0], blockSize):
+            block = np.asarray(matrix[first:first + blockSize])
+            if maxCount is not None:
+                clipped += np.count_nonzero(block > maxCount)
+                block = np.minimum(block, maxCount)
+            block.astype(dataFormat).tofile(f)
+    if clipped:
+        print str(clipped) + ' cells clipped to ' + str(maxCount)
+
+### gamma-gamma-gamma cube, full (size^3 cells, [x, y, z]) or symmetric:
+### only blocks of blockSize^3 cells with block coordinates X <= Y <= Z
+### are stored (1/6 of full size), plane of X after plane, Z runs along
+### rows of (X, Y). Line of cells along any axis reads one block per
+### blockSize channels, not one page per channel. Cells are usually
+### memory mapped; double gate reads only cells of gated (x, y) pairs
+def sortedTriples(count): #x <= y <= z triples before plane x
+    rest = count - np.arange(count + 1, dtype=np.int64)
+    return count*(count + 1)*(count + 2)//6 - rest*(rest + 1)*(rest + 2)//6
+
+def cubeCellCount(size, symmetric=True, blockSize=8):
+    if not symmetric:
+        return size**3
+    return int(sortedTriples(-(-size//blockSize))[-1])*blockSize**3
+
+class gammaCube(object):
+    def __init__(self, cells, size, symmetric=True, blockSize=8):
+        self.cells = cells #flat if symmetric, else size x size x size
+        self.size = size
+        self.symmetric = symmetric
+        self.blockSize = blockSize
+        self.dtype = cells.dtype
+        self.blockCount = -(-size//blockSize) #blocks along axis
+        self.planeStarts = sortedTriples(self.blockCount)
+        self.localOffsetCache = {} #block order -> offsets inside block
+
+    def blockIndex(self, blockA, blockB, blockC): #blockA <= B <= C
+        count = self.blockCount
+        return self.planeStarts[blockA] + (blockB - blockA)*count \
+            - (blockB*(blockB - 1) - blockA*(blockA - 1))//2 \
+            + (blockC - blockB)
+
+    def cellOffsets(self, x, y, z): #flat positions, int64 arrays
+        if not self.symmetric:
+            return (x*self.size + y)*self.size + z
+        a = np.minimum(np.minimum(x, y), z)
+        c = np.maximum(np.maximum(x, y), z)
+        b = x + y + z - a - c
+        size = self.blockSize
+        block = self.blockIndex(a//size, b//size, c//size)
+        return ((block*size + a%size)*size + b%size)*size + c%size
+
+    ## offsets inside stored block of local cells (x, y, z), for blocks
+    ## of x, y, z ordered as ranks (equal ranks - the same block)
+    def localOffsets(self, ranks):
+        if ranks not in self.localOffsetCache:
+            size = self.blockSize
+            local = np.indices((size, size, size)).reshape(3, -1)
+            values = np.sort(
+                np.array(ranks)[:,None]*size + local, axis=0)%size
+            self.localOffsetCache[ranks] = ((values[0]*size + values[1])
+                *size + values[2]).reshape(size, size, size)
+        return self.localOffsetCache[ranks]
+
+    ## third axis spectrum gated on x in regionX and y in regionY,
+    ## (start, end) channels included as in gatingEngine.sliceMatrix.
+    ## Symmetric cube is read by blocks: for every pair of x, y blocks
+    ## the stored blocks along z are read once and summed over the gate
+    def doubleSlice(self, regionX, regionY):
+        limits = [clipColumns(region[0], region[1] + 1, self.size)
+                  for region in (regionX, regionY)]
+        (x0, x1), (y0, y1) = limits
+        if not self.symmetric: #contiguous slab of rows
+            return np.sum(self.cells[x0:x1, y0:y1], axis=(0, 1),
+                          dtype=np.float64)
+        size, count = self.blockSize, self.blockCount
+        blockCells = size**3
+        spectrum = np.zeros(count*size)
+        blocksZ = np.arange(count, dtype=np.int64)
+        for blockX in xrange(x0//size, -(-x1//size)):
+            localX = slice(max(x0 - blockX*size, 0),
+                           min(x1 - blockX*size, size))
+            for blockY in xrange(y0//size, -(-y1//size)):
+                localY = slice(max(y0 - blockY*size, 0),
+                               min(y1 - blockY*size, size))
+                low, high = sorted((blockX, blockY))
+                blocks = self.blockIndex(*np.sort(np.array(
+                    np.broadcast_arrays(blockX, blockY, blocksZ)), axis=0))
+                #z blocks with the same order of x, y, z blocks
+                for inRange in (blocksZ < low, blocksZ == low,
+                        (blocksZ > low) & (blocksZ < high),
+                        (blocksZ == high) & (high > low), blocksZ > high):
+                    if not inRange.any():
+                        continue
+                    blockZ = blocksZ[inRange][0]
+                    distinct = sorted(set((blockX, blockY, blockZ)))
+                    inside = self.localOffsets(tuple(distinct.index(block)
+                        for block in (blockX, blockY, blockZ)))
+                    inside = inside[localX, localY].reshape(-1)
+                    firstCells = blocks[inRange]*blockCells
+                    read = np.asarray(
+                        self.cells[firstCells[:,None] + inside[None,:]])
+                    zs = blocksZ[inRange][:,None]*size + np.arange(size)
+                    spectrum[zs.ravel()] += np.sum(
+                        read.reshape(len(firstCells), -1, size),
+                        axis=1, dtype=np.float64).ravel()
+        return spectrum[:self.size]
+
+    def addCounts(self, offsets, counts): #offsets without repeats
+        flat = self.cells.reshape(-1)
+        flat[offsets] = flat[offsets] + counts.astype(flat.dtype)
+
+## cube file without header (after skipFirstBytes), mode 'w+' creates it
+def openCubeFile(fileName, size, dataType='I', dataEndian='<',
+                 symmetric=True, skipFirstBytes=0, mode='r', blockSize=8):
+    dataFormat = np.dtype(dataEndian + dataType)
+    cellCount = cubeCellCount(size, symmetric, blockSize)
+    if mode != 'w+' and os.path.getsize(fileName) \
+            < skipFirstBytes + cellCount*dataFormat.itemsize:
+        raise ValueError(str(fileName) + ' too small for ' + str(size)
+            + '^3 ' + ('symmetric ' if symmetric else '') + 'cube')
+    shape = (cellCount,) if symmetric else (size, size, size)
+    cells = np.memmap(fileName, dtype=dataFormat, mode=mode,
+                      offset=skipFirstBytes, shape=shape)
+    return gammaCube(cells, size, symmetric, blockSize)
+
+def histogramCubeEvents(events, cube, gains=None, seed=0):
+    size = cube.size
+    if gains:
+        channels = applyGains(events, gains, np.random.RandomState(seed))
+    else:
+        channels = events.astype(np.int64)
+    cells = []
+    for first in xrange(events.shape[1]):
+        for second in xrange(first + 1, events.shape[1]):
+            for third in xrange(second + 1, events.shape[1]):
+                x, y, z = (channels[:,first], channels[:,second],
+                           channels[:,third])
+                inside = (x >= 0) & (x < size) & (y >= 0) & (y < size) \
+                    & (z >= 0) & (z < size)
+                cells.append(cube.cellOffsets(x[inside].astype(np.int64),
+                    y[inside].astype(np.int64), z[inside].astype(np.int64)))
+    if cells:
+        cube.addCounts(*np.unique(np.concatenate(cells),
+                                  return_counts=True))
+
+## every triple of channels in list-mode event adds one count to cube,
+## read in this process (cube cells are shared). Returns events read
+def histogramListModeCube(fileName, cube, eventLength=3, dataType='H',
+                          dataEndian='<', skipFirstBytes=0, gains=None,
+                          chunkEvents=2**20, isCanceled=None, progress=None):
+    dataFormat = np.dtype(dataEndian + dataType)
+    eventCount = None
+    if compression(fileName) is None:
+        eventCount = (os.path.getsize(fileName) - skipFirstBytes) \
+            //(eventLength*dataFormat.itemsize)
+    with openMatrixStream(fileName) as f:
+        f.seek(skipFirstBytes)
+        return histogramStream(f, lambda events, seed: histogramCubeEvents(
+            events, cube, gains, seed), eventLength, dataFormat, eventCount,
+            chunkEvents, isCanceled=isCanceled, progress=progress)
+
+## (plus rois, minus rois, suppression factor) for every group, or for
+## all rois if groups are not used; same rules as gatingEngine.gate
+def gateTerms(plusRois, minusRois, groupRois, useGroups):
+    if not useGroups:
+        if not plusRois:
+            raise ValueError('no ROI+ to gate on')
+        if not minusRois:
+            return [(list(plusRois), [], 0.)]
+        suppresionFactor = sum(roiWidth(region) for region in plusRois) \
+            /float(sum(roiWidth(region) for region in minusRois))
+        return [(list(plusRois), list(minusRois), suppresionFactor)]
+    plusIndex = roiIntervalIndex(plusRois, None)
+    minusIndex = roiIntervalIndex(minusRois, None)
+    terms = []
+    for group in groupRois:
+        region = sorted(group)
+        plusPositions = plusIndex.roisInRegion(region)
+        minusPositions = minusIndex.roisInRegion(region)
+        upFactor = np.sum(plusIndex.widths[plusPositions])
+        downFactor = np.sum(minusIndex.widths[minusPositions])
+        terms.append((plusIndex.regions[plusPositions],
+                      minusIndex.regions[minusPositions],
+                      upFactor/downFactor if downFactor else 0.))
+    return terms
+
+### polynomial energy calibration E(ch) = a0 + a1 ch + a2 ch^2 + ...,
+### position ch in channel units (channel n covers n..n+1). Must grow
+### with channel, inverse is interpolated
+class energyCalibration(object):
+    def __init__(self, coefficients=(0., 0.5)):
+        self.coefficients = tuple(float(a) for a in coefficients)
+        self.inverseEdges = None #energies of channel grid for inverse
+
+    @classmethod
+    def fromText(cls, text): #'a0 a1 a2 ...', single number is keV/channel
+        coefficients = [float(a) for a in str(text).replace(',', ' ').split()]
+        if len(coefficients) == 1:
+            coefficients = [0.] + coefficients
+        return cls(coefficients)
+
+    def __str__(self):
+        return ' '.join('%g' % a for a in self.coefficients)
+
+    def __eq__(self, other):
+        return isinstance(other, energyCalibration) \
+            and self.coefficients == other.coefficients
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.coefficients)
+
+    def energy(self, channels): #Horner scheme, works on arrays
+        channels = np.asarray(channels, dtype=np.float64)
+        energies = np.zeros(channels.shape)
+        for coefficient in reversed(self.coefficients):
+            energies = energies*channels + coefficient
+        return energies
+
+    def slope(self, channels): #keV/channel at channels, for widths
+        channels = np.asarray(channels, dtype=np.float64)
+        slopes = np.zeros(channels.shape)
+        for power in xrange(len(self.coefficients) - 1, 0, -1):
+            slopes = slopes*channels + power*self.coefficients[power]
+        return slopes
+
+    def grows(self, length): #energy increases over channels 0..length
+        return bool(np.all(np.diff(self.energy(np.arange(length + 1))) > 0))
+
+    def binEdges(self, length): #energies of channel edges 0..length
+        edges = self.energy(np.arange(length + 1))
+        if np.any(np.diff(edges) <= 0):
+            raise ValueError('calibration ' + str(self)
+                + ' does not grow on 0..' + str(length) + ' channels')
+        return edges
+
+    def channel(self, energies, length): #inverse, on spectrum 0..length
+        if self.inverseEdges is None or len(self.inverseEdges) != length + 1:
+            self.inverseEdges = self.binEdges(length)
+        return np.interp(energies, self.inverseEdges,
+                         np.arange(length + 1, dtype=np.float64))
+
+rebinCache = OrderedDict() #(source, target, lengths) -> sparse matrix
+rebinCacheSize = 16
+rebinCacheLock = threading.Lock()
+
+## sparse targetLength x sourceLength matrix moving counts from channels
+## of source calibration to channels of target one, shared by energy
+## overlap (counts spread evenly within channel). Built once per
+## calibration pair, then any spectrum is gain matched by one product
+def rebinMatrix(source, target, sourceLength, targetLength=None):
+    if targetLength is None:
+        targetLength = sourceLength
+    key = (source, target, sourceLength, targetLength)
+    with rebinCacheLock:
+        if key in rebinCache:
+            rebin = rebinCache.pop(key)
+            rebinCache[key] = rebin #now the newest
+            return rebin
+    sourceEdges = source.binEdges(sourceLength)
+    targetEdges = target.binEdges(targetLength)
+    #every piece between two neighbouring edges is in one source channel
+    #and at most one target channel
+    edges = np.union1d(sourceEdges, targetEdges)
+    edges = edges[(edges >= sourceEdges[0]) & (edges <= sourceEdges[-1])]
+    middles = (edges[:-1] + edges[1:])/2
+    sourceChannels = np.searchsorted(sourceEdges, middles) - 1
+    targetChannels = np.searchsorted(targetEdges, middles) - 1
+    inside = (targetChannels >= 0) & (middles < targetEdges[-1])
+    weights = np.diff(edges)/np.diff(sourceEdges)[sourceChannels]
+    rebin = sparse.csr_matrix((weights[inside],
+        (targetChannels[inside], sourceChannels[inside])),
+        shape=(targetLength, sourceLength))
+    with rebinCacheLock:
+        rebinCache[key] = rebin
+        while len(rebinCache) > rebinCacheSize:
+            rebinCache.popitem(last=False)
+    return rebin
+
+def gainMatch(spectrum, source, target, targetLength=None):
+    spectrum = np.asarray(spectrum, dtype=np.float64)
+    return rebinMatrix(source, target, len(spectrum), targetLength).dot(
+        spectrum)
+
+## matrix (rows - gated spectrum axis Y, columns - gate axis X) gain
+## matched on both axes: rebinY . matrix . rebinX^T
+def gainMatchMatrix(matrix, sourceX, sourceY, targetX, targetY,
+                    targetShape=None):
+    if targetShape is None:
+        targetShape = matrix.shape
+    rebinY = rebinMatrix(sourceY, targetY, matrix.shape[0], targetShape[0])
+    rebinX = rebinMatrix(sourceX, targetX, matrix.shape[1], targetShape[1])
+    if sparse.issparse(matrix):
+        return (rebinY*matrix*rebinX.T).tocsc()
+    rebinned = rebinY.dot(np.asarray(matrix, dtype=np.float64)) #rows
+    return rebinX.dot(rebinned.T).T #then columns
+
+### roi list (.rl) file: counts of plus, minus and group rois,
+### then one "start end" line for every roi
+def readRoiList(fileName):
+    with open(fileName, 'r') as f:
+        roiFromFile = f.read().splitlines()
+    counts = [int(line.split()[-1]) for line in roiFromFile[:3]]
+    regions = [tuple(int(x) for x in line.split()[:2])
+               for line in roiFromFile[3:3 + sum(counts)]]
+    pCount, mCount = counts[0], counts[1]
+    return (regions[:pCount], regions[pCount:pCount + mCount],
+            regions[pCount + mCount:])
+
+def writeRoiList(fileName, plusRois, minusRois, groupRois):
+    ToSaveText = str('PlusRois: ') + str(len(plusRois)) + '\n' + \
+    str('MinusRois: ') + str(len(minusRois)) + '\n' + \
+    str('GroupRois: ') + str(len(groupRois)) + '\n'
+    for region in list(plusRois) + list(minusRois) + list(groupRois):
+        ToSaveText += str(int(region[0])) + ' ' + str(int(region[1])) + '\n'
+    with open(fileName, 'w') as f:
+        f.write(ToSaveText)
+
+### Radware .spe file: header record (24 bytes: name, length, 1, 1, 1),
+### float32 data record, record ending. Fortran record lengths are
+### checked to find byte order and spectrum length (4k, 8k, 16k...)
+speHeaderType = np.dtype([('headLength', '<u4'), ('name', 'S8'),
+                          ('length', '<u4'), ('ones', '<u4', 3),
+                          ('headEnd', '<u4'), ('dataLength', '<u4')])
+
+def readSpeHeader(fileName): #returns (name, length, byte order)
+    with open(fileName, 'rb') as f:
+        raw = f.read(speHeaderType.itemsize)
+    if len(raw) < speHeaderType.itemsize:
+        raise ValueError('%s: too short for spe header' % fileName)
+    for byteOrder in '<>':
+        headerType = speHeaderType.newbyteorder(byteOrder)
+        header = np.frombuffer(raw, headerType)[0]
+        if header['headLength'] == 24 and header['headEnd'] == 24:
+            break
+    else:
+        raise ValueError('%s: not a Radware spe file' % fileName)
+    #header length word and data record length must agree,
+    #neither is trusted alone
+    length = int(header['dataLength']) // 4
+    if int(header['length']) != length:
+        raise ValueError('%s: spe header length %d, data record %d floats'
+            % (fileName, header['length'], length))
+    if os.path.getsize(fileName) \
+            < speHeaderType.itemsize + 4*length + 4:
+        raise ValueError('%s: spe data record is truncated' % fileName)
+    return header['name'].strip(), length, byteOrder
+
+## memmap=True maps data record read only (no copy, file stays open)
+def readSpe(fileName, memmap=False):
+    name, length, byteOrder = readSpeHeader(fileName)
+    dataType = np.dtype(byteOrder + 'f4')
+    if memmap:
+        return np.memmap(fileName, dataType, 'r',
+                         speHeaderType.itemsize, (length,))
+    with open(fileName, 'rb') as f:
+        f.seek(speHeaderType.itemsize)
+        return np.fromfile(f, dataType, length)
+
+def writeSpe(fileName, spectrum, speName=None):
+    if speName is None:
+        speName = fileName
+    spectrum = np.ascontiguousarray(spectrum, '<f4')
+    header = np.zeros(1, speHeaderType)
+    header['headLength'] = header['headEnd'] = 24
+    header['name'] = (8*' ' + str(speName))[-8:]
+    header['length'] = len(spectrum)
+    header['ones'] = 1
+    header['dataLength'] = 4*len(spectrum)
+    with open(fileName, 'wb') as f:
+        header.tofile(f)
+        spectrum.tofile(f)
+        header['dataLength'].tofile(f)
+
+### peak search alternative to find_peaks_cwt: spectrum is convolved
+### with ricker wavelets (smoothed negative second derivative) of all
+### widths at once by FFT, peaks are local maxima of the best response.
+### Peak must pass the same noise test as in find_peaks_cwt (response
+### over noise_perc percentile of the smallest width response nearby)
+### and stand peakSignificance sigmas above poisson noise of counts
+def rickerBank(widths, length): #same wavelets as scipy.signal.ricker
+    t = np.arange(length) - (length - 1)/2.
+    a = np.asarray(widths, dtype=float)[:,None]
+    amplitude = 2/(np.sqrt(3*a)*np.pi**0.25)
+    return amplitude*(1 - (t/a)**2)*np.exp(-t**2/(2*a**2))
+
+## 'same' convolution with every kernel. Spectrum is reflected over
+## its ends, so background does not step down to zero padding there
+def convolveBank(spectrum, kernels):
+    speLength, kernelLength = len(spectrum), kernels.shape[1]
+    pad = min(kernelLength, speLength - 1)
+    padded = np.pad(spectrum, pad, mode='reflect')
+    fftLength = 2**int(np.ceil(np.log2(len(padded) + kernelLength - 1)))
+    response = np.fft.irfft(
+        np.fft.rfft(padded, fftLength)[None,:]
+        *np.fft.rfft(kernels, fftLength, axis=1), fftLength, axis=1)
+    first = (kernelLength - 1)//2 + pad
+    return response[:,first:first + speLength]
+
+def findPeaksDerivative(spectrum, widths, noisePerc=10.,
+                        peakSignificance=4.):
+    spectrum = np.asarray(spectrum, dtype=float)
+    speLength = len(spectrum)
+    widths = np.asarray(widths, dtype=float)
+    if speLength < 3 or not len(widths):
+        return np.array([], dtype=int)
+    kernelLength = min(int(10*widths.max()), speLength)
+    kernelLength -= 1 - kernelLength % 2 #odd, centred on a channel
+    kernels = rickerBank(widths, kernelLength)
+    response = convolveBank(spectrum, kernels)
+    variance = convolveBank(np.absolute(spectrum), kernels**2)
+    bestWidth = np.argmax(response, axis=0)
+    channels = np.arange(speLength)
+    best = response[bestWidth, channels]
+    significance = best/np.sqrt(
+        np.maximum(variance[bestWidth, channels], 1.))
+    #noise: percentile of smallest width response in windows of N/20
+    window = max(int(np.ceil(speLength/20.)), 1)
+    blockCount = int(np.ceil(speLength/float(window)))
+    smallest = np.pad(np.absolute(response[0]),
+        (0, blockCount*window - speLength), mode='edge')
+    noise = np.repeat(np.percentile(
+        smallest.reshape(blockCount, window), noisePerc, axis=1),
+        window)[:speLength]
+    #local maxima, at most one peak within the width of matched ridge
+    isMax = np.zeros(speLength, dtype=bool)
+    for index, width in enumerate(widths):
+        matched = bestWidth == index
+        isMax[matched] = best[matched] >= maximum_filter1d(
+            best, size=max(int(width), 1) | 1, mode='nearest')[matched]
+    isMax[[0, -1]] = False
+    isPeak = isMax & (best > 0) & (best >= noise) \
+        & (significance >= peakSignificance)
+    return channels[isPeak]
+
+### speed and agreement of both peak searches for reference spectra
+def benchmarkPeakFind(spectra, widths, noisePerc=10., tolerance=3):
+    lines = []
+    for name, spectrum in spectra:
+        start = time.time()
+        cwtPeaks = np.asarray(find_peaks_cwt(
+            spectrum, widths, noise_perc=noisePerc), dtype=int)
+        cwtTime = time.time() - start
+        start = time.time()
+        fastPeaks = findPeaksDerivative(spectrum, widths, noisePerc)
+        fastTime = time.time() - start
+        if len(cwtPeaks) and len(fastPeaks):
+            distance = np.absolute(cwtPeaks[:,None] - fastPeaks[None,:])
+            cwtFound = np.sum(distance.min(axis=1) <= tolerance)
+            fastConfirmed = np.sum(distance.min(axis=0) <= tolerance)
+        else:
+            cwtFound = fastConfirmed = 0
+        lines.append(
+            '%s (%d channels): cwt %d peaks in %.3f s, derivative %d peaks'
+            ' in %.3f s (%.0fx faster); %d/%d cwt peaks found,'
+            ' %d derivative peaks not in cwt (tolerance %d channels)'
+            % (name, len(spectrum), len(cwtPeaks), cwtTime, len(fastPeaks),
+               fastTime, cwtTime/max(fastTime, 1e-6), cwtFound,
+               len(cwtPeaks), len(fastPeaks) - fastConfirmed, tolerance))
+    missed, false = peakFindBackgroundCheck(widths, noisePerc, tolerance)
+    lines.append('background check: %s (missed %s, false %s)'
+        % ('OK' if not len(missed) and not len(false) else 'FAILED',
+           list(missed), list(false)))
+    return '\n'.join(lines)
+
+### regression check: known peaks on falling background, doublet just
+### resolvable with largest width, no false peaks at spectrum ends.
+### Returns (missed, false) peak channels
+def peakFindBackgroundCheck(widths, noisePerc=10., tolerance=3,
+                            speLength=4096):
+    channels = np.arange(speLength, dtype=float)
+    doublet = 501 + max(20, 2*int(np.max(widths)))
+    known = np.array([501, doublet, 1300, 2000, 3500])
+    spectrum = 100. + 400.*np.exp(-channels/1000.)
+    for position, height in zip(known, [1000., 800., 600., 1000., 400.]):
+        spectrum += height*np.exp(-(channels - position)**2/(2*3.**2))
+    found = findPeaksDerivative(spectrum, widths, noisePerc)
+    if not len(found):
+        return known, found
+    distance = np.absolute(known[:,None] - found[None,:])
+    return (known[distance.min(axis=1) > tolerance],
+            found[distance.min(axis=0) > tolerance])
+
+### step plot data for channels start..stop-1 drawn on given number of
+### pixels. With more channels than pixels, channels are grouped in
+### bins and every bin is drawn as its max and min, so narrow peaks
+### stay visible. Bins are aligned to channel multiples of bin size,
+### so they do not jump while panning.
+stepAxes = {} #x axes of step plots, shared between curves
+
+def stepAxis(length): #0..length, created once per spectrum length
+    if length not in stepAxes:
+        stepAxes[length] = np.arange(length + 1, dtype=float)
+    return stepAxes[length]
+
+def decimateSteps(spectrum, start, stop, pixels):
+    start, stop = max(int(start), 0), min(int(stop), len(spectrum))
+    if stop <= start:
+        return stepAxis(0), spectrum[:0]
+    binSize = (stop - start)//max(int(pixels), 1)
+    if binSize < 2: #every channel fits on screen, no copies needed
+        return stepAxis(len(spectrum))[start:stop + 1], spectrum[start:stop]
+    start -= start % binSize
+    binStarts = np.arange(start, stop, binSize)
+    region = spectrum[start:stop]
+    binEnds = np.append(binStarts[1:], stop)
+    x = np.empty(2*len(binStarts) + 1)
+    x[0:-1:2] = binStarts
+    x[1::2] = (binStarts + binEnds)/2
+    x[-1] = stop
+    y = np.empty(2*len(binStarts), dtype=region.dtype)
+    y[0::2] = np.maximum.reduceat(region, binStarts - start)
+    y[1::2] = np.minimum.reduceat(region, binStarts - start)
+    return x, y
+
+### 2D matrix view: levels of 2x binned matrix, level n bins 2**n
+### channels in both axes. Coarse levels (at most storedSide pixels
+### per side) are summed once, finer tiles are summed from matrix when
+### they are first viewed and kept in LRU cache. Images are float32
+### [row, column], rows are gated spectrum channels (Y), columns are
+### projection channels (X)
+def matrixBlock(matrix, rowStart, rowStop, columnStart, columnStop):
+    block = matrix[rowStart:rowStop, columnStart:columnStop]
+    if sparse.issparse(block):
+        return block.toarray()
+    return np.asarray(block)
+
+def binBlock(block, factor): #sums of factor x factor bins, last ones cut
+    if factor == 1:
+        return block.astype(np.float32)
+    rowStarts = np.arange(0, block.shape[0], factor)
+    columnStarts = np.arange(0, block.shape[1], factor)
+    binned = np.add.reduceat(block, rowStarts, axis=0, dtype=np.float64)
+    return np.add.reduceat(
+        binned, columnStarts, axis=1).astype(np.float32)
+
+class matrixPyramid(object):
+    def __init__(self, matrix, tileSize=256, storedSide=2048,
+                 cacheSize=256):
+        self.matrix = matrix
+        self.tileSize = tileSize
+        self.tileCache = OrderedDict() #(level, row, column): tile
+        self.cacheSize = cacheSize
+        self.cacheLock = threading.Lock()
+        longSide = max(matrix.shape)
+        self.levelCount = 1 #smallest level has less than tileSize pixels
+        while (longSide - 1)//2**(self.levelCount - 1) >= tileSize:
+            self.levelCount += 1
+        self.firstStored = 1 #finer levels are summed from matrix tiles
+        while (longSide - 1)//2**self.firstStored >= storedSide:
+            self.firstStored += 1
+        self.levels = {} #stored levels
+        self.isTransposed = False
+
+    ## sums stored levels, first one in row blocks of matrix as it was
+    ## given (not transposed), so the rows are read contiguously
+    def build(self, isCanceled=None):
+        factor = 2**self.firstStored
+        matrix = self.matrix.T if self.isTransposed else self.matrix
+        rows, columns = matrix.shape
+        blockRows = factor*max(2**20//columns, 1) #~1M matrix cells
+        firstLevel = np.zeros((-(-rows//factor), -(-columns//factor)),
+                              dtype=np.float32)
+        for first in xrange(0, rows, blockRows):
+            if isCanceled is not None and isCanceled():
+                return False
+            block = matrixBlock(matrix, first, first + blockRows,
+                                0, columns)
+            firstLevel[first//factor:(first + len(block) - 1)//factor + 1] \
+                = binBlock(block, factor)
+        levels = {self.firstStored: firstLevel}
+        for level in xrange(self.firstStored + 1, self.levelCount):
+            levels[level] = binBlock(levels[level - 1], 2)
+        if self.isTransposed: #also when transposed meanwhile
+            levels = dict((level, image.T) for level, image in levels.items())
+        self.levels = levels
+        return True
+
+    def isBuilt(self):
+        return bool(self.levels)
+
+    def levelShape(self, level):
+        rows, columns = self.matrix.shape
+        return (-(-rows//2**level), -(-columns//2**level))
+
+    def transpose(self): #views, nothing is summed again
+        self.matrix = self.matrix.T
+        self.isTransposed = not self.isTransposed
+        self.levels = dict((level, image.T)
+                           for level, image in self.levels.items())
+        with self.cacheLock:
+            self.tileCache.clear()
+
+    def tile(self, level, row, column):
+        size = self.tileSize
+        if level in self.levels: #view of stored level
+            return self.levels[level][row*size:(row + 1)*size,
+                                      column*size:(column + 1)*size]
+        key = (level, row, column)
+        with self.cacheLock:
+            if key in self.tileCache:
+                image = self.tileCache.pop(key)
+                self.tileCache[key] = image #now most recent
+                return image
+        factor = 2**level
+        image = binBlock(matrixBlock(
+            self.matrix, row*size*factor, (row + 1)*size*factor,
+            column*size*factor, (column + 1)*size*factor), factor)
+        with self.cacheLock:
+            self.tileCache[key] = image
+            while len(self.tileCache) > self.cacheSize:
+                self.tileCache.popitem(last=False)
+        return image
+
+    ## level with about one bin per screen pixel for channel range
+    def levelForView(self, xRange, yRange, pixels):
+        binsPerPixel = max((xRange[1] - xRange[0])/max(pixels[0], 1),
+                           (yRange[1] - yRange[0])/max(pixels[1], 1), 1.)
+        level = int(np.floor(np.log2(binsPerPixel)))
+        return min(level, self.levelCount - 1)
+
+    ## image of tiles intersecting channel ranges, returns image and
+    ## channel rectangle (x, y, width, height) it covers
+    def viewImage(self, level, xRange, yRange):
+        size = self.tileSize
+        levelRows, levelColumns = self.levelShape(level)
+        factor = 2**level
+        def tileRange(channelRange, levelSide):
+            first = int(max(channelRange[0], 0)//(size*factor))
+            last = int(max(channelRange[1], 0)//(size*factor))
+            return first, max(min(last, (levelSide - 1)//size), first - 1)
+        firstRow, lastRow = tileRange(yRange, levelRows)
+        firstColumn, lastColumn = tileRange(xRange, levelColumns)
+        image = np.zeros((
+            min((lastRow + 1)*size, levelRows) - firstRow*size,
+            min((lastColumn + 1)*size, levelColumns) - firstColumn*size),
+            dtype=np.float32)
+        for row in xrange(firstRow, lastRow + 1):
+            for column in xrange(firstColumn, lastColumn + 1):
+                tile = self.tile(level, row, column)
+                top, left = (row - firstRow)*size, (column - firstColumn)*size
+                image[top:top + tile.shape[0],
+                      left:left + tile.shape[1]] = tile
+        rectangle = (firstColumn*size*factor, firstRow*size*factor,
+                     image.shape[1]*factor, image.shape[0]*factor)
+        return image, rectangle
+
+def roiWidth(region): #width in channels, as roi.askWidth
+    return np.absolute(int(region[1]) - int(region[0])) + 1
+
+### sorted roi boundaries for finding rois inside a group ###
+class roiIntervalIndex(object):
+    def __init__(self, regions, sliceRegion):
+        regions = np.sort(
+            np.array(regions, dtype=float).reshape(-1, 2), axis=1)
+        order = np.argsort(regions[:,0], kind='mergesort')
+        self.regions = regions[order]
+        self.starts = self.regions[:,0]
+        self.ends = self.regions[:,1]
+        self.widths = np.absolute(
+            np.trunc(self.ends) - np.trunc(self.starts)) + 1 #as roiWidth
+        self.sliceRegion = sliceRegion
+        self.slices = {} #every roi is sliced at most once
+
+    def roisInRegion(self, region): #roi inside group, both ends excluded
+        first = np.searchsorted(self.starts, region[0], side='right')
+        last = np.searchsorted(self.starts, region[1], side='left')
+        return first + np.nonzero(self.ends[first:last] < region[1])[0]
+
+    def sliceMatrix(self, position):
+        if position not in self.slices:
+            self.slices[position] = self.sliceRegion(self.regions[position])
+        return self.slices[position]
+
+    def sumInRegion(self, region, speLength): #summed slices and widths
+        spectrum = np.zeros(speLength)
+        positions = self.roisInRegion(region)
+        for position in positions:
+            spectrum += self.sliceMatrix(position)
+        return spectrum, float(np.sum(self.widths[positions]))
+
+### result of single gaussian fit, positions and widths in channels
+class peakFit(object):
+    def __init__(self, params, roiLimits, speRegion, bgLimits, bgSpe,
+                 bgSpeCut, fitSpe):
+        self.params = params #amplitude, centroid - roi start, sigma
+        self.roiLimits = roiLimits
+        self.speRegion = speRegion
+        self.bgLimits = bgLimits
+        self.bgSpe = bgSpe #linear background under whole bg roi
+        self.bgSpeCut = bgSpeCut #background under peak roi
+        self.fitSpe = fitSpe #gaussian + background in peak roi
+        self.sigma = params[2]
+        self.area = np.sum(fitSpe) - np.sum(bgSpeCut)
+        self.centroid = params[1] + int(roiLimits[0])
+        self.fwhm = 2.355*abs(params[2])
+
+## start positions of multiplet fit: highest local maxima of smoothed
+## spectrum, missing peaks are spread evenly over the region
+def guessCentroids(speRegion, peakCount):
+    smooth = np.convolve(speRegion, np.ones(3)/3., mode='same')
+    isMax = np.zeros(len(smooth), dtype=bool)
+    isMax[1:-1] = (smooth[1:-1] >= smooth[:-2]) & (smooth[1:-1] > smooth[2:])
+    candidates = np.nonzero(isMax)[0]
+    candidates = candidates[np.argsort(smooth[candidates])[::-1]][:peakCount]
+    missing = peakCount - len(candidates)
+    if missing > 0:
+        spread = np.linspace(0, len(speRegion) - 1, missing + 2)[1:-1]
+        candidates = np.concatenate((candidates, spread))
+    return np.sort(candidates).astype(float)
+
+### N gaussians with common or own widths on linear background
+class multipletFit(object):
+    def __init__(self, params, covariance, peakCount, sharedWidth,
+                 roiLimits, speRegion, fitSpe, bgSpeCut, chiSquare):
+        self.params = params #bg level, bg slope, amplitudes, centroids, sigmas
+        self.covariance = covariance #scaled by reduced chi square
+        self.roiLimits = roiLimits
+        self.speRegion = speRegion
+        self.fitSpe = fitSpe #sum of all peaks and background in roi
+        self.bgSpeCut = bgSpeCut
+        self.chiSquare = chiSquare #reduced
+        n = peakCount
+        self.amplitudes = params[2:2 + n]
+        self.centroids = params[2 + n:2 + 2*n] #in channels
+        sigmaIndex = 2 + 2*n + (np.zeros(n, dtype=int) if sharedWidth
+                                else np.arange(n))
+        self.sigmas = np.abs(params[sigmaIndex])
+        self.fwhms = 2.355*self.sigmas
+        self.areas = np.sqrt(2*np.pi)*self.amplitudes*self.sigmas
+        #area errors from amplitude and sigma with their correlation
+        ampIndex = np.arange(2, 2 + n)
+        #sigma parameter may end negative, model uses its abs value
+        sigmaSigns = np.where(params[sigmaIndex] < 0, -1., 1.)
+        areaVar = 2*np.pi*(self.sigmas**2*covariance[ampIndex, ampIndex]
+            + self.amplitudes**2*covariance[sigmaIndex, sigmaIndex]
+            + 2*self.amplitudes*self.sigmas*sigmaSigns
+            *covariance[ampIndex, sigmaIndex])
+        self.areaErrors = np.sqrt(np.abs(areaVar))
+        self.centroidErrors = np.sqrt(np.abs(
+            np.diag(covariance)[2 + n:2 + 2*n]))
+        x = np.arange(len(speRegion)) + int(roiLimits[0])
+        self.peakSpectra = bgSpeCut + self.amplitudes[:,None]*np.exp(
+            -(x - self.centroids[:,None])**2/(2*self.sigmas[:,None]**2))
+
+## fits peakCount gaussians and linear background in roi at once,
+## centroids (channels) are start positions, guessed if None.
+## sharedWidth: all peaks have one sigma, otherwise each its own
+def fitMultiplet(spectrum, roiLimits, peakCount=2, centroids=None,
+                 sharedWidth=True, sigma=2.):
+    roiStart, roiEnd = int(roiLimits[0]), int(roiLimits[1])
+    speRegion = np.asarray(spectrum[roiStart:roiEnd + 1], dtype=float)
+    if centroids is None:
+        centroids = guessCentroids(speRegion, peakCount) + roiStart
+    centroids = np.sort(np.asarray(centroids, dtype=float))
+    n = len(centroids)
+    if len(speRegion) < 3*n + 3:
+        raise ValueError('ROI too narrow for ' + str(n) + ' peaks')
+    x = np.arange(roiStart, roiStart + len(speRegion), dtype=float)
+    xMiddle = (x[0] + x[-1])/2 #background slope around roi middle
+    weights = 1/np.sqrt(np.maximum(speRegion, 1.)) #poisson errors
+
+    level = (speRegion[0] + speRegion[-1])/2
+    slope = (speRegion[-1] - speRegion[0])/(x[-1] - x[0])
+    heights = speRegion[(centroids - roiStart).astype(int).clip(
+        0, len(speRegion) - 1)]
+    guess = np.concatenate(([level, slope],
+        np.maximum(heights - level, 1.), centroids,
+        [sigma]*(1 if sharedWidth else n)))
+
+    def components(p):
+        sig = np.abs(p[2 + 2*n:])[:,None]
+        dist = x - p[2 + n:2 + 2*n,None]
+        gauss = np.exp(-dist**2/(2*sig**2))
+        return p[2:2 + n,None], sig, dist, gauss
+
+    def multipletErr(p):
+        amp, sig, dist, gauss = components(p)
+        fit = p[0] + p[1]*(x - xMiddle) + np.sum(amp*gauss, axis=0)
+        return (speRegion - fit)*weights
+
+    def multipletJacobian(p): #one row per parameter
+        amp, sig, dist, gauss = components(p)
+        ampGauss = amp*gauss
+        #model uses abs(sigma), derivative has sign of sigma parameter
+        sigmaSigns = np.where(p[2 + 2*n:] < 0, -1., 1.)[:,None]
+        sigmaRows = ampGauss*dist**2/sig**3*sigmaSigns
+        if sharedWidth:
+            sigmaRows = np.sum(sigmaRows, axis=0)[None,:]
+        return -weights*np.vstack((np.ones_like(x), x - xMiddle, gauss,
+            ampGauss*dist/sig**2, sigmaRows))
+
+    out = leastsq(multipletErr, guess, Dfun=multipletJacobian,
+                  col_deriv=1, full_output=True)
+    params, covariance = out[0], out[1]
+    residuals = multipletErr(params)
+    chiSquare = np.sum(residuals**2)/max(len(speRegion) - len(params), 1)
+    if covariance is None: #singular, e.g. two peaks at one position
+        covariance = np.zeros((len(params), len(params)))
+    bgSpeCut = params[0] + params[1]*(x - xMiddle)
+    return multipletFit(params, covariance*chiSquare, n, sharedWidth,
+        roiLimits, speRegion, speRegion - residuals/weights, bgSpeCut,
+        chiSquare)
+
+## peaks closer than window are fitted together as one multiplet,
+## returns list of ((start, end), centroids) in channels
+def peakFitWindows(peaks, halfWidth, speLength):
+    windows = []
+    for peak in np.sort(peaks):
+        start = max(peak - halfWidth, 0)
+        end = min(peak + halfWidth, speLength - 1)
+        if windows and start <= windows[-1][0][1]:
+            (start, lastEnd), centroids = windows[-1]
+            windows[-1] = ((start, end), centroids + [peak])
+        else:
+            windows.append(((start, end), [peak]))
+    return windows
+
+def fitWindowJob(job): #module level, so pool processes can run it
+    index, spectrum, roiLimits, centroids, sigma = job
+    try:
+        fit = fitMultiplet(spectrum, roiLimits, len(centroids), centroids,
+                           True, sigma)
+    except Exception as error:
+        return index, None, str(error)
+    return index, fit, None
+
+### matrix, gates and spectrum analysis without GUI ###
+class gatingEngine(object):
+    def __init__(self):
+        self.matrix = None
+        self.matrixProjectionX = None
+        self.matrixProjectionY = None
+        self.ifTranspose = False
+        self.gateIndexType = 'off' #prefix-sum gate index: off, uint32, int64
+        self.gateIndex = None #prefix sums of matrix columns
+        self.sliceCache = OrderedDict() #(a, b) -> gated slice, oldest first
+        self.sliceCacheSize = 256
+        self.liveMatrix = None #writable matrix as in file, live mode only
+        self.sparseThreshold = 0.1 #store matrix sparse below this occupancy
+        self.symmetricStorage = True #pack symmetric matrices found on load
+        self.symmetry = 'off' #of matrix being loaded, see packSymmetric
+        self.plusRois = [] #(start, end) pairs in channels
+        self.minusRois = []
+        self.groupRois = []
+        self.calibrationX = energyCalibration() #gate axis (projection)
+        self.calibrationY = energyCalibration() #gated spectrum axis
+        self.cube = None #gammaCube for double gates
+        self.secondPlusRois = [] #rois on second gate axis of cube
+        self.secondMinusRois = []
+        self.secondGroupRois = []
+        self.minPeakWidth = 5 #for peak find
+        self.maxPeakWidth = 25 #for peak find
+        self.noisePeakWidth = 0.1 #for peak find
+        self.peakFindMethod = 'cwt' #'cwt' or faster 'derivative'
+        self.peakCache = OrderedDict() #recently found peaks, oldest first
+        self.peakCacheSize = 64
+        self.peakCacheLock = threading.Lock() #peaks found in GUI workers
+
+    def loadMatrix(self, fileName, sizeX, sizeY, dataOrder='C',
+                   dataType='H', dataEndian='<', skipFirstBytes=0,
+                   skipLastBytes=0, memoryMapped=True):
+        self.setMatrix(readMatrixFile(
+            fileName, sizeX, sizeY, dataOrder, dataType, dataEndian,
+            skipFirstBytes, skipLastBytes, memoryMapped))
+        return self.matrix
+
+    ## new matrix; memory mapped matrix can be scanned later
+    ## (e.g. in background thread, with scanMatrix(..., engine.symmetry)),
+    ## then setScanResult must be called. Result of scan done together
+    ## with reading (streamMatrixFile) is given as scanResult.
+    ## symmetry: 'auto' (checked if symmetricStorage is on), 'symmetric',
+    ## 'symmetrise' or 'off'
+    def setMatrix(self, matrix, scanLater=False, symmetry='auto',
+                  scanResult=None):
+        self.matrix = matrix
+        self.ifTranspose = False
+        self.gateIndex = None
+        self.liveMatrix = None
+        self.sliceCache.clear()
+        self.symmetry = self.storedSymmetry(symmetry)
+        if scanResult is not None: #already scanned, e.g. while reading
+            self.setScanResult(*scanResult)
+            return
+        if isinstance(matrix, np.memmap):
+            if scanLater:
+                self.matrixProjectionX = np.zeros(matrix.shape[1])
+                self.matrixProjectionY = np.zeros(matrix.shape[0])
+                return
+            self.setScanResult(*scanMatrix(
+                matrix, self.sparseThreshold, symmetry=self.symmetry))
+            return
+        if self.symmetry != 'off' and not sparse.issparse(matrix):
+            packed = packSymmetric(matrix, self.symmetry)
+            if packed is not None:
+                self.setScanResult(*(packed.projections() + (packed,)))
+                return
+        if self.sparseThreshold and not sparse.issparse(matrix):
+            occupancy = np.count_nonzero(matrix)/float(matrix.size)
+            if occupancy < self.sparseThreshold:
+                print 'occupancy %.2f%%, sparse storage' % (100*occupancy)
+                self.matrix = toSparseMatrix(matrix)
+        self.matrixProjectionX, self.matrixProjectionY = \
+            matrixProjections(self.matrix)
+        self.buildGateIndex()
+
+    ## channels of projection (X) and gated spectrum (Y) axes, for
+    ## calibration checks and inverses; 4096 before matrix is loaded
+    def axisLengths(self):
+        if self.matrixProjectionX is None:
+            return 4096, 4096
+        return len(self.matrixProjectionX), len(self.matrixProjectionY)
+
+    def storedSymmetry(self, symmetry): #'auto' needs symmetricStorage on
+        if symmetry == 'auto' and not self.symmetricStorage:
+            return 'off'
+        return symmetry
+
+    ## scan of matrix given to setMatrix (not transposed) is finished,
+    ## storedMatrix (sparse or packed symmetric) replaces memory map
+    def setScanResult(self, projectionX, projectionY, storedMatrix):
+        if isinstance(storedMatrix, packedSymmetricMatrix):
+            print 'symmetric matrix, packed storage %.1f MB' \
+                % (storedMatrix.nbytes/2.**20)
+            self.matrix = storedMatrix
+        elif storedMatrix is not None:
+            if self.ifTranspose:
+                projectionX, projectionY = projectionY, projectionX
+                storedMatrix = storedMatrix.T.tocsc()
+            print 'occupancy %.2f%%, sparse storage' \
+                % (100.*storedMatrix.nnz/np.prod(storedMatrix.shape))
+            self.matrix = storedMatrix
+        elif self.ifTranspose:
+            projectionX, projectionY = projectionY, projectionX
+        self.matrixProjectionX = projectionX
+        self.matrixProjectionY = projectionY
+        self.sliceCache.clear()
+        self.buildGateIndex()
+
+    def transpose(self):
+        self.sliceCache.clear()
+        self.calibrationX, self.calibrationY = \
+            self.calibrationY, self.calibrationX
+        if isinstance(self.matrix, packedSymmetricMatrix): #same matrix
+            self.ifTranspose = not self.ifTranspose
+            return
+        if sparse.issparse(self.matrix): #gates need csc columns
+            self.matrix = self.matrix.T.tocsc()
+        else:
+            self.matrix = self.matrix.transpose()
+        #projections of transposed matrix are swapped, no summing
+        self.matrixProjectionX, self.matrixProjectionY = \
+            self.matrixProjectionY, self.matrixProjectionX
+        self.ifTranspose = not self.ifTranspose
+        self.buildGateIndex()
+
+    ## prefix sums of matrix columns: gate [a,b) = index[b] - index[a]
+    ## stored transposed, so a gate reads two contiguous rows.
+    ## Not built for live matrix, it changes all the time
+    def buildGateIndex(self):
+        self.gateIndex = None
+        if self.gateIndexType == 'off' or self.matrix is None \
+                or self.liveMatrix is not None:
+            return
+        if sparse.issparse(self.matrix):
+            print 'sparse matrix gates are sliced directly, no gate index'
+            return
+        #fractional counts (float formats, gain matched matrices) would
+        #be truncated by integer sums, they get float64 prefix sums
+        if self.matrix.dtype.kind == 'f':
+            indexType = np.dtype(np.float64)
+        elif self.matrix.dtype.kind in 'iu':
+            indexType = np.dtype(self.gateIndexType)
+        else:
+            print 'no gate index for ' + str(self.matrix.dtype) + \
+                ' matrix, gates are sliced directly'
+            return
+        sizeY, sizeX = self.matrix.shape
+        print 'building gate index: ' + str(indexType) + ', ' \
+            + str((sizeX + 1)*sizeY*indexType.itemsize//2**20) + ' MB'
+        gateIndex = np.zeros((sizeX + 1, sizeY), dtype=indexType)
+        blockRows = 256 #rows summed at once, bounds temporary memory
+        for first in xrange(0, sizeY, blockRows):
+            last = min(first + blockRows, sizeY)
+            gateIndex[1:, first:last] = np.cumsum(
+                self.matrix[first:last], axis=1, dtype=indexType).T
+        self.gateIndex = gateIndex
+
+    ## gated slice from prefix sums, columns a..b-1
+    def sliceGateIndex(self, a, b):
+        a, b = clipColumns(a, b, self.gateIndex.shape[0] - 1)
+        #uint32 sums wrap around, but the difference stays exact
+        #as long as single gate holds less than 2**32 counts
+        gateSum = self.gateIndex[b] - self.gateIndex[a]
+        if gateSum.dtype.kind == 'f':
+            return gateSum
+        return gateSum.astype(np.int64)
+
+    ## spectrum gated on region (start, end), both channels included.
+    ## Recent slices are kept, so only moved or changed gates are summed
+    def sliceMatrix(self, region):
+        key = clipColumns(region[0], region[1] + 1, self.matrix.shape[1])
+        if key in self.sliceCache:
+            gateSlice = self.sliceCache.pop(key)
+        else:
+            gateSlice = self.sliceColumns(*key)
+        self.sliceCache[key] = gateSlice #now the newest
+        while len(self.sliceCache) > self.sliceCacheSize:
+            self.sliceCache.popitem(last=False)
+        return gateSlice
+
+    def sliceColumns(self, a, b): #columns a..b-1
+        a, b = clipColumns(a, b, self.matrix.shape[1])
+        if self.gateIndex is not None: #constant time slice
+            return self.sliceGateIndex(a, b)
+        if isinstance(self.matrix, packedSymmetricMatrix):
+            return self.matrix.sliceColumns(a, b)
+        if sparse.issparse(self.matrix): #csc column slice
+            return sliceSparseMatrix(self.matrix, a, b)
+        return np.sum(self.matrix[:,a:b], axis = 1)
+
+    ## live acquisition: matrix is made dense, writable and in memory,
+    ## gate index is dropped (it would be rebuilt on every change)
+    def startLive(self, blockSize=256):
+        matrix = self.matrix
+        if self.ifTranspose and not isinstance(matrix, packedSymmetricMatrix):
+            matrix = matrix.T
+        if isinstance(matrix, packedSymmetricMatrix): #unpacked in blocks
+            unpacked = np.empty(matrix.shape, dtype=matrix.dtype)
+            for first in xrange(0, matrix.shape[0], blockSize):
+                unpacked[first:first + blockSize] = \
+                    matrix[first:first + blockSize]
+            matrix = unpacked
+        elif sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        dataType = matrix.dtype
+        if dataType.kind != 'f': #room for counts coming
+            dataType = np.promote_types(dataType, np.uint32)
+        if isinstance(matrix, np.memmap) or dataType != matrix.dtype \
+                or not matrix.flags.writeable:
+            matrix = np.array(matrix, dtype=dataType)
+        self.liveMatrix = matrix
+        self.matrix = matrix.T if self.ifTranspose else matrix
+        self.symmetry = 'off'
+        self.gateIndex = None
+        self.sliceCache.clear()
+        return matrix
+
+    ## counts added to cells (rows, columns) of matrix as in file,
+    ## projections follow. Returns changed gate channels, sorted
+    def addCounts(self, rows, columns, counts):
+        if self.liveMatrix is None:
+            self.startLive()
+        matrix = self.liveMatrix
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.float64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= matrix.shape[0]
+                or columns.min() < 0 or columns.max() >= matrix.shape[1]):
+            raise ValueError('counts outside of matrix')
+        cells, where = np.unique(rows*matrix.shape[1] + columns,
+                                 return_inverse=True)
+        sums = np.bincount(where, weights=counts, minlength=len(cells))
+        cellRows, cellColumns = np.divmod(cells[sums != 0], matrix.shape[1])
+        sums = sums[sums != 0]
+        if matrix.dtype.kind == 'f':
+            matrix[cellRows, cellColumns] += sums
+        else: #unsigned cells wrap, sum stays right while not negative
+            matrix[cellRows, cellColumns] = (
+                matrix[cellRows, cellColumns].astype(np.int64)
+                + np.rint(sums).astype(np.int64)).astype(matrix.dtype)
+        rowSums = np.bincount(cellRows, sums, matrix.shape[0])
+        columnSums = np.bincount(cellColumns, sums, matrix.shape[1])
+        if self.ifTranspose: #gates are on rows of file
+            rowSums, columnSums = columnSums, rowSums
+            cellColumns = cellRows
+        self.matrixProjectionX = self.matrixProjectionX + columnSums
+        self.matrixProjectionY = self.matrixProjectionY + rowSums
+        changed = np.unique(cellColumns)
+        self.invalidateSlices(changed)
+        return changed
+
+    def invalidateSlices(self, channels): #channels sorted
+        for a, b in list(self.sliceCache):
+            if np.searchsorted(channels, a) < np.searchsorted(channels, b):
+                del self.sliceCache[(a, b)]
+
+    def gatesOverlap(self, channels): #any roi on changed channels?
+        for region in self.plusRois + self.minusRois:
+            a, b = int(region[0]), int(region[1] + 1)
+            if np.searchsorted(channels, a) < np.searchsorted(channels, b):
+                return True
+        return False
+
+    ## single pass over roi slices, returns gated spectrum,
+    ## error spectrum^2 and suppression factors (one for each group)
+    def gate(self, useGroups=None):
+        if useGroups is None:
+            useGroups = len(self.groupRois) > 0
+        speLength = self.matrix.shape[0]
+        if not useGroups:
+            if not self.plusRois:
+                raise ValueError('no ROI+ to gate on')
+            rawSpe = np.zeros(speLength)
+            suppresionUp = 0.
+            for region in self.plusRois:
+                rawSpe += self.sliceMatrix(region)
+                suppresionUp += roiWidth(region)
+            if not self.minusRois:
+                return rawSpe, rawSpe.copy(), [0.]
+            backgroundSpe = np.zeros(speLength)
+            suppresionDown = 0.
+            for region in self.minusRois:
+                backgroundSpe += self.sliceMatrix(region)
+                suppresionDown += roiWidth(region)
+            suppresionFactor = suppresionUp/suppresionDown
+            gatedSpe = rawSpe - suppresionFactor*backgroundSpe
+            errSpe = rawSpe + suppresionFactor**2*backgroundSpe
+            return gatedSpe, errSpe, [suppresionFactor]
+        gatedSpe = np.zeros(speLength)
+        errSpe = np.zeros(speLength)
+        suppresionFactors = []
+        plusIndex = roiIntervalIndex(self.plusRois, self.sliceMatrix)
+        minusIndex = roiIntervalIndex(self.minusRois, self.sliceMatrix)
+        for group in self.groupRois:
+            region = sorted(group)
+            plusSpe, upFactor = plusIndex.sumInRegion(region, speLength)
+            minusSpe, downFactor = minusIndex.sumInRegion(region, speLength)
+            if downFactor:
+                supFact = upFactor/downFactor
+            else: #group without background
+                supFact = 0.
+            gatedSpe += plusSpe - supFact*minusSpe
+            errSpe += plusSpe + supFact**2*minusSpe
+            suppresionFactors.append(supFact)
+        return gatedSpe, errSpe, suppresionFactors
+
+    ## cube gated on rois (first axis) and second rois, spectrum of third
+    ## axis. Gate rules apply on both axes: every (first, second) pair of
+    ## groups adds (plus1 - f1 minus1) x (plus2 - f2 minus2); factors are
+    ## (f1, f2) pairs. Second axis uses groups if it has any
+    def doubleGate(self, useGroups=None):
+        if useGroups is None:
+            useGroups = len(self.groupRois) > 0
+        slices = {} #every pair of rois is sliced once
+        def doubleSlice(first, second):
+            key = (tuple(first), tuple(second))
+            if key not in slices:
+                slices[key] = self.cube.doubleSlice(first, second)
+            return slices[key]
+        gatedSpe = np.zeros(self.cube.size)
+        errSpe = np.zeros(self.cube.size)
+        suppresionFactors = []
+        secondTerms = gateTerms(self.secondPlusRois, self.secondMinusRois,
+            self.secondGroupRois, len(self.secondGroupRois) > 0)
+        for plus1, minus1, f1 in gateTerms(self.plusRois, self.minusRois,
+                                           self.groupRois, useGroups):
+            for plus2, minus2, f2 in secondTerms:
+                for rois1, w1 in ((plus1, 1.), (minus1, -f1)):
+                    for rois2, w2 in ((plus2, 1.), (minus2, -f2)):
+                        for first in rois1:
+                            for second in rois2:
+                                part = doubleSlice(first, second)
+                                gatedSpe += w1*w2*part
+                                errSpe += (w1*w2)**2*part
+                suppresionFactors.append((f1, f2))
+        return gatedSpe, errSpe, suppresionFactors
+
+    ## peaks of spectrum already searched with the same parameters
+    ## are taken from bounded LRU cache
+    def findPeaks(self, spectrum):
+        spectrum = np.asarray(spectrum)
+        key = (hash(spectrum.tobytes()), spectrum.dtype.str, len(spectrum),
+               self.minPeakWidth, self.maxPeakWidth, self.noisePeakWidth,
+               self.peakFindMethod)
+        with self.peakCacheLock:
+            if key in self.peakCache:
+                peaks = self.peakCache.pop(key)
+                self.peakCache[key] = peaks #now the newest
+                return peaks
+        peaks = self.searchPeaks(spectrum)
+        with self.peakCacheLock:
+            self.peakCache[key] = peaks
+            while len(self.peakCache) > self.peakCacheSize:
+                self.peakCache.popitem(last=False)
+        return peaks
+
+    def searchPeaks(self, spectrum):
+        widths = np.arange(self.minPeakWidth,self.maxPeakWidth)
+        if self.peakFindMethod == 'derivative':
+            return findPeaksDerivative(
+                spectrum, widths, self.noisePeakWidth)
+        return find_peaks_cwt(
+            spectrum, widths, noise_perc=self.noisePeakWidth)
+
+    ## fits single gaussian peak on linear background, background is
+    ## drawn between spectrum values at bgLimits (roiLimits if None)
+    def fitPeak(self, spectrum, roiLimits, bgLimits=None):
+        if bgLimits is None:
+            bgLimits = roiLimits
+        roiStart, roiEnd = int(roiLimits[0]), int(roiLimits[1])
+        bgStart, bgEnd = int(bgLimits[0]), int(bgLimits[1])
+        if roiStart < bgStart:
+            raise ValueError('Left Peak ROI out of Background ROI')
+        if roiEnd > bgEnd:
+            raise ValueError('Right Peak ROI out of Background ROI')
+        speRegion = spectrum[roiStart:roiEnd + 1]
+        #level of background
+        bgLen = bgEnd - bgStart + 1
+        bgPoints = spectrum[bgStart], spectrum[bgEnd]
+        fitBgParams = np.polyfit([0,bgLen],bgPoints,1)
+        bgSpe = np.arange(bgLen)*fitBgParams[0] + fitBgParams[1]
+        bgSpeCut = bgSpe[roiStart - bgStart:roiStart - bgStart
+            + len(speRegion)]
+
+        def gaussToFit(x,a,mu,sig):
+            return a*np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))\
+                +bgSpeCut[x]
+
+        def guassToFitErr(p,x,y):
+            return y - gaussToFit(x,*p)
+
+        guess = np.max(speRegion), roiLimits[1]-roiLimits[0], 5.
+        x = np.arange(len(speRegion))
+        out = leastsq(guassToFitErr, guess, args = (x,speRegion))
+        return peakFit(out[0], roiLimits, speRegion, bgLimits, bgSpe,
+            bgSpeCut, gaussToFit(x,*out[0]))
+
+    ## fits another gaussian in residuals of firstFit
+    def fitNextPeak(self, firstFit):
+        bgSpeCut = firstFit.bgSpeCut
+        newSpeToFit = firstFit.speRegion - firstFit.fitSpe + bgSpeCut
+
+        def gaussToFit(x,a,mu,sig):
+            return a*np.exp(-np.power(x - mu, 2.) \
+                /(2 * np.power(sig, 2.)))+bgSpeCut[x]
+
+        def guassToFitErr(p,x,y):
+            return y - gaussToFit(x,*p)
+
+        roiLimits = firstFit.roiLimits
+        guess = [np.max(newSpeToFit), roiLimits[1] - roiLimits[0],
+                 firstFit.sigma]
+        x = np.arange(len(newSpeToFit))
+        out = leastsq(guassToFitErr, guess, args = (x,newSpeToFit))
+        return peakFit(out[0], roiLimits, newSpeToFit, firstFit.bgLimits,
+            firstFit.bgSpe, bgSpeCut, gaussToFit(x,*out[0]))
+
+    ## fits peakCount gaussians and linear background in roi at once,
+    ## start sigma from expected peak width
+    def fitMultiplet(self, spectrum, roiLimits, peakCount=2, centroids=None,
+                     sharedWidth=True):
+        return fitMultiplet(spectrum, roiLimits, peakCount, centroids,
+            sharedWidth, max(self.minPeakWidth/2.355, 1.))
+
+    ## fit windows around peaks, fitted in parallel by fitAllPeaks
+    def fitAllJobs(self, spectrum, peaks):
+        spectrum = np.asarray(spectrum, dtype=float)
+        sigma = max(self.minPeakWidth/2.355, 1.)
+        windows = peakFitWindows(peaks, int(3*self.minPeakWidth),
+                                 len(spectrum))
+        return [(i, spectrum, roiLimits, centroids, sigma)
+                for i, (roiLimits, centroids) in enumerate(windows)]
+
+    ## yields (window number, multipletFit or None, error or None)
+    ## as fits finish, in pool processes if pool is given
+    def fitAllPeaks(self, spectrum, peaks, pool=None):
+        jobs = self.fitAllJobs(spectrum, peaks)
+        if pool is None:
+            return (fitWindowJob(job) for job in jobs)
+        return pool.imap_unordered(fitWindowJob, jobs)
+